@@ -0,0 +1,293 @@
+'''
+
+Benchmarks of every public function in pyechomask.masks and
+pyechomask.manipulate
+
+Each function runs on the bundled echograms (data/krill-Sv38.pkl,
+data/PS_Sv18.pklz) and on synthetic echograms (pyechomask.synthetic, seed 0)
+of increasing numbers of pings. Wall time (best of repeats) and peak memory (tracemalloc) are
+recorded per function and dataset, and the scaling exponent k of
+time ~ pings**k is fitted over the synthetic sizes.
+
+usage (from the repository root):
+
+    python benchmarks/run.py                          ## 1k, 10k, 100k pings
+    python benchmarks/run.py --pings 1000 10000 --only binary_signal break_mask
+    python benchmarks/run.py --save benchmarks/baseline.json
+    python benchmarks/run.py --baseline benchmarks/baseline.json
+
+With --baseline, results are compared with the stored baseline and the
+script exits with status 1 when a function is slower (--time-tolerance),
+uses more memory (--memory-tolerance) or scales worse (--exponent-tolerance)
+than the baseline.
+
+Modification History:
+
+'''
+
+## import packages
+import argparse
+import inspect
+import json
+import os
+import platform
+import sys
+import time
+import tracemalloc
+
+import numpy as np
+
+## import pyechomask modules
+sys.path.insert(0,os.path.join(os.path.dirname(os.path.abspath(__file__)),'..'))
+import pyechomask
+from pyechomask import masks, manipulate
+from pyechomask.store import load_pickle
+from pyechomask.synthetic import synthetic_echogram
+
+DATA = os.path.join(os.path.dirname(os.path.abspath(__file__)),'..','data')
+
+
+################################################################## datasets
+
+def dataset(name):
+    '''
+    (Sv, sample_int, pl) of a dataset name: krill-Sv38, PS_Sv18 or
+    synthetic-<pings>
+    '''
+    if name == 'krill-Sv38':
+        return load_pickle(os.path.join(DATA,'krill-Sv38.pkl')).T,0.2,1.024
+    if name == 'PS_Sv18':
+        return load_pickle(os.path.join(DATA,'PS_Sv18.pklz')),0.2,1.024
+    if name.startswith('synthetic-'):
+        return synthetic_echogram(int(name.split('-')[1]),rows = 200,sample_int = 0.5,
+                                  truth = False)[0],0.5,1.024
+    raise ValueError('unknown dataset %s' % name)
+
+
+class Context(object):
+    '''
+    inputs of the benchmarked functions for one dataset (not timed)
+    '''
+
+    def __init__(self,Sv,sample_int,pl):
+        self.Sv            = np.ascontiguousarray(Sv,dtype = float)
+        self.sample_int    = sample_int
+        self.pl            = pl
+        self.min_sep       = 4*sample_int*5   ## 20 rows
+        self.max_thickness = 20*self.min_sep
+        rows,pings         = self.Sv.shape
+        self.window        = min(50,pings)
+        self.thickness     = min(5,rows)
+        self.mask          = masks.binary_threshold(self.Sv,-50,-75)
+        self.filtered      = manipulate.signal_row_filter(self.mask,self.window)
+        self.labels        = manipulate.break_mask(self.filtered)
+        self.table         = manipulate.feature_table(self.Sv,self.labels)
+        self.noise         = manipulate.get_signal_mask(self.Sv)
+        self.merged        = manipulate.merge_binary([self.mask,self.filtered,self.noise])
+        self.line          = np.ma.masked_equal(np.argmax(self.Sv,axis = 0),0)
+        self.start,self.stop = manipulate.median_1D_windows(pings,31)
+
+
+def consume(tiles):
+    ## run a tile generator to the end
+    for _ in tiles:
+        pass
+
+
+## one case per public function: function name -> call on a Context
+CASES = {
+    ## masks
+    'binary_threshold'       : lambda c: masks.binary_threshold(c.Sv,-50,-75),
+    'binary_signal'          : lambda c: masks.binary_signal(c.Sv,c.pl,c.sample_int,c.min_sep,
+                                                             c.max_thickness),
+    'binary_signal_agreement': lambda c: masks.binary_signal_agreement(c.Sv,c.pl,c.sample_int,
+                                                                       c.min_sep,c.max_thickness),
+    'binary_signal_tiles'    : lambda c: consume(masks.binary_signal_tiles(
+                                   c.Sv,c.pl,c.sample_int,c.min_sep,c.max_thickness)),
+    'binary_pulse'           : lambda c: masks.binary_pulse(c.Sv),
+    'binary_seabed'          : lambda c: masks.binary_seabed(c.Sv),
+    'binary_seabed_tiles'    : lambda c: consume(masks.binary_seabed_tiles(c.Sv)),
+    'binary_impulse'         : lambda c: masks.binary_impulse(c.Sv,10,'ping'),
+    'binary_impulse_tiles'   : lambda c: consume(masks.binary_impulse_tiles(c.Sv,10,'ping')),
+    ## manipulate
+    'label_dtype'            : lambda c: [manipulate.label_dtype(n) for n in range(1000)],
+    'mask_buffer'            : lambda c: manipulate.mask_buffer(c.Sv.shape),
+    'median_1D_windows'      : lambda c: manipulate.median_1D_windows(c.Sv.shape[1],31),
+    'windowed_median'        : lambda c: manipulate.windowed_median(c.line,c.start,c.stop),
+    'rolling_median'         : lambda c: manipulate.rolling_median(c.Sv,31),
+    'median_1D_filter'       : lambda c: manipulate.median_1D_filter(c.line,31),
+    'feature_table'          : lambda c: manipulate.feature_table(c.Sv,c.labels),
+    'paint_features'         : lambda c: manipulate.paint_features(c.labels,c.table,'median_Sv'),
+    'feature_median'         : lambda c: manipulate.feature_median(c.Sv,c.labels),
+    'fill_feature_gaps'      : lambda c: manipulate.fill_feature_gaps(c.filtered,100,
+                                   out = np.empty_like(c.filtered)),
+    'vertical_merge'         : lambda c: manipulate.vertical_merge(c.filtered,20),
+    'label_ping'             : lambda c: [manipulate.label_ping(p) for p in c.filtered.T[:200]],
+    'ping_runs'              : lambda c: manipulate.ping_runs(c.filtered),
+    'break_mask'             : lambda c: manipulate.break_mask(c.filtered),
+    'flag'                   : lambda c: manipulate.flag(c.filtered,100),
+    'flag_tiles'             : lambda c: consume(manipulate.flag_tiles(c.filtered,100)),
+    'feature_sizes'          : lambda c: manipulate.feature_sizes(c.labels),
+    'remove_features'        : lambda c: manipulate.remove_features(c.labels,100),
+    'signal_row_filter'      : lambda c: manipulate.signal_row_filter(c.mask,c.window),
+    'signal_column_filter'   : lambda c: manipulate.signal_column_filter(c.mask,c.thickness,1),
+    'signal_rect_filter'     : lambda c: manipulate.signal_rect_filter(c.mask,c.window,
+                                                                       c.thickness),
+    'remove_noise'           : lambda c: manipulate.remove_noise(c.mask,c.noise,
+                                   out = np.empty_like(c.mask)),
+    'get_signal_mask'        : lambda c: manipulate.get_signal_mask(c.Sv),
+    'merge_binary'           : lambda c: manipulate.merge_binary([c.mask,c.filtered,c.noise]),
+    'regrid_Sv'              : lambda c: manipulate.regrid_Sv(c.Sv,c.sample_int,
+                                                              1.5*c.sample_int),
+    'regrid_mask'            : lambda c: manipulate.regrid_mask(c.mask,c.sample_int,
+                                                                1.5*c.sample_int),
+    'stack_Sv'               : lambda c: manipulate.stack_Sv([c.Sv,c.Sv[::2]],
+                                                             [c.sample_int,2*c.sample_int]),
+    'test_bit'               : lambda c: manipulate.test_bit(c.merged,1,3),
+    'decode_binary'          : lambda c: manipulate.decode_binary(c.merged,3),
+    'mask_agreement'         : lambda c: manipulate.mask_agreement(c.mask,c.filtered),
+}
+
+
+def public_functions():
+    '''
+    names of the public functions of masks and manipulate
+    '''
+    names = []
+    for module in (masks,manipulate):
+        for name,f in inspect.getmembers(module,inspect.isfunction):
+            if not name.startswith('_') and f.__module__ == module.__name__:
+                names.append(name)
+    return sorted(names)
+
+
+################################################################## measurement
+
+def measure(f,context,min_time = 0.2,max_repeat = 5):
+    '''
+    best wall time (s) over repeats and tracemalloc peak (bytes) of f(context)
+    '''
+    tracemalloc.start()
+    try:
+        f(context)
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    times = []
+    while len(times) < max_repeat and (not times or sum(times) < min_time):
+        t0 = time.perf_counter()
+        f(context)
+        times.append(time.perf_counter() - t0)
+    return min(times),peak
+
+
+def scaling_exponent(pings,times):
+    '''
+    k of time ~ pings**k (least squares in log-log), None if < 2 sizes
+    '''
+    pings,times = np.asarray(pings,float),np.asarray(times,float)
+    ok          = times > 0
+    if ok.sum() < 2:
+        return None
+    return float(np.polyfit(np.log(pings[ok]),np.log(times[ok]),1)[0])
+
+
+def run(datasets,functions,verbose = True):
+    results = {'meta':{'python':platform.python_version(),'numpy':np.__version__,
+                       'machine':platform.machine(),'processor':platform.processor(),
+                       'pyechomask':getattr(pyechomask,'__version__',None)},
+               'functions':{name:{} for name in functions}}
+    for name in datasets:
+        context = Context(*dataset(name))
+        if verbose:
+            print('%s %s' % (name,context.Sv.shape))
+        for function in functions:
+            t,peak = measure(CASES[function],context)
+            results['functions'][function][name] = {'time':t,'peak':peak}
+            if verbose:
+                print('    %-24s %9.4f s %9.1f MB' % (function,t,peak/2.**20))
+        del context
+
+    ## scaling over the synthetic sizes
+    for function,entries in results['functions'].items():
+        sizes = sorted((int(n.split('-')[1]),e['time']) for n,e in entries.items()
+                       if n.startswith('synthetic-'))
+        entries['exponent'] = scaling_exponent(*zip(*sizes)) if len(sizes) > 1 else None
+    return results
+
+
+def compare(results,baseline,time_tolerance = 1.5,memory_tolerance = 1.25,
+            exponent_tolerance = 0.25,min_time = 0.01,min_bytes = 2**20):
+    '''
+    regressions of results against baseline: list of messages
+    '''
+    failures = []
+    for function,entries in results['functions'].items():
+        base = baseline['functions'].get(function)
+        if base is None:
+            continue
+        for name,e in entries.items():
+            b = base.get(name)
+            if name == 'exponent':
+                if e is not None and b is not None and e > b + exponent_tolerance:
+                    failures.append('%s: scaling exponent %.2f, baseline %.2f' % (function,e,b))
+                continue
+            if b is None:
+                continue
+            if e['time'] > b['time']*time_tolerance and e['time'] - b['time'] > min_time:
+                failures.append('%s on %s: %.4f s, baseline %.4f s (%.1fx)' %
+                                (function,name,e['time'],b['time'],e['time']/b['time']))
+            if e['peak'] > b['peak']*memory_tolerance and e['peak'] - b['peak'] > min_bytes:
+                failures.append('%s on %s: peak %.1f MB, baseline %.1f MB' %
+                                (function,name,e['peak']/2.**20,b['peak']/2.**20))
+    return failures
+
+
+def main(argv = None):
+    parser = argparse.ArgumentParser(description = __doc__.split('\n\n')[1])
+    parser.add_argument('--pings',type = int,nargs = '+',default = [1000,10000,100000],
+                        help = 'synthetic echogram sizes (pings)')
+    parser.add_argument('--no-bundled',action = 'store_true',
+                        help = 'skip data/krill-Sv38.pkl and data/PS_Sv18.pklz')
+    parser.add_argument('--only',nargs = '+',help = 'functions to run')
+    parser.add_argument('--save',help = 'write results (JSON)')
+    parser.add_argument('--baseline',help = 'compare with results (JSON)')
+    parser.add_argument('--time-tolerance',type = float,default = 1.5)
+    parser.add_argument('--memory-tolerance',type = float,default = 1.25)
+    parser.add_argument('--exponent-tolerance',type = float,default = 0.25)
+    args = parser.parse_args(argv)
+
+    missing = set(public_functions()) - set(CASES)
+    if missing:
+        raise SystemExit('no benchmark for %s' % ', '.join(sorted(missing)))
+    functions = args.only or sorted(CASES)
+    unknown   = set(functions) - set(CASES)
+    if unknown:
+        raise SystemExit('unknown functions %s' % ', '.join(sorted(unknown)))
+    datasets  = ([] if args.no_bundled else ['krill-Sv38','PS_Sv18']) + \
+                ['synthetic-%d' % n for n in args.pings]
+
+    results = run(datasets,functions)
+    print('\nscaling exponents (time ~ pings**k)')
+    for function in functions:
+        k = results['functions'][function]['exponent']
+        print('    %-24s %s' % (function,'-' if k is None else '%.2f' % k))
+    if args.save:
+        with open(args.save,'w') as f:
+            json.dump(results,f,indent = 1,sort_keys = True)
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        failures = compare(results,baseline,args.time_tolerance,args.memory_tolerance,
+                           args.exponent_tolerance)
+        if failures:
+            print('\nREGRESSIONS against %s' % args.baseline)
+            for failure in failures:
+                print('    ' + failure)
+            return 1
+        print('\nno regressions against %s' % args.baseline)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
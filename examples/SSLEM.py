@@ -145,7 +145,7 @@ plt.title('12kHz echogram SSL mask')
 plt.show()
 
 ## remove small SSLs
-signal = remove_features(signal.astype(int),min_size*min_thickness_rows)
+signal = remove_features(signal,min_size*min_thickness_rows)
 
 ## get median values of each SSL
 Sv_median = feature_median(Sv,signal)
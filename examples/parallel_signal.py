@@ -0,0 +1,51 @@
+'''
+
+Speedup of binary_signal with n_jobs (ping blocks run in a thread or 
+process pool) on the bundled echograms
+
+Modification History:
+
+'''
+
+## import packages
+import gzip
+import os
+import pickle
+import time
+
+import numpy as np
+
+## import pyechomask modules
+from pyechomask.masks import binary_signal
+
+## get Sv data
+def getSv(filepath):
+    f   = gzip.open(filepath,'rb')
+    obj = pickle.load(f,encoding = 'bytes')
+    f.close()
+    return obj
+
+## Sv and observation parameters (sample_int in m, pl in ms)
+datasets = {'PS_Sv18'   : (getSv('./data/PS_Sv18.pklz'),0.2,1.024),
+            'krill-Sv38': (pickle.load(open('./data/krill-Sv38.pkl','rb')).T,0.2,1.024)}
+
+## SSLEM optimization parameters
+min_sep       = 4     # minimum SSL seperation (m)
+max_thickness = 60    # Maximun SSL thickness  (m)
+
+## core counts to test
+cores = [n for n in [1,2,4,8,16,32] if n <= (os.cpu_count() or 1)]
+
+for name,(Sv,sample_int,pl) in datasets.items():
+    t0     = time.perf_counter()
+    serial = binary_signal(Sv,pl,sample_int,min_sep,max_thickness)
+    t_ser  = time.perf_counter() - t0
+    print('%s %s: serial %.2f s' % (name,Sv.shape,t_ser))
+    for executor in ['thread','process']:
+        for n in cores:
+            t0     = time.perf_counter()
+            signal = binary_signal(Sv,pl,sample_int,min_sep,max_thickness,
+                                   n_jobs = n,executor = executor)
+            t      = time.perf_counter() - t0
+            assert np.array_equal(signal,serial)
+            print('    %-7s n_jobs = %2d: %.2f s, speedup %.2fx' % (executor,n,t,t_ser/t))
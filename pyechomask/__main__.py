@@ -0,0 +1,10 @@
+# -*- coding: utf-8 -*-
+"""
+python -m pyechomask, see pyechomask.cli
+"""
+
+import sys
+
+from pyechomask.cli import main
+
+sys.exit(main())
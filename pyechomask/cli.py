@@ -0,0 +1,350 @@
+# -*- coding: utf-8 -*-
+"""
+.. :module:: cli
+    :synopsis: pyechomask command, SSLEM over many echogram files
+
+| Developed by: Roland Proud (RP) <rp43@st-andrews.ac.uk>
+|               Pelagic Ecology Research Group, University of St Andrews
+| Contributors:
+|
+| Maintained by:
+| Modification History:
+|
+
+usage:
+
+    pyechomask ./cruise/*.pklz -p params.json -o ./masks -j 4
+    python -m pyechomask ./cruise -p params.json -o ./masks
+
+Inputs are echogram files (gzip) pickles of (depth, ping) Sv arrays,
+echogram stores (store.write_echogram), directories holding either, or
+glob patterns. The parameter file is JSON: keyword arguments of
+pipeline.sslem_pipeline (pl and sample_int required, sample_int and
+noise_level default to those of a store) and optionally
+
+    "transpose": true          - pickles hold (ping, depth) arrays
+    "outputs": ["ssl", ...]    - results to write (OUTPUTS)
+
+For each input <name> the output directory gets
+
+    <name>.npz   - the mask results (np.load), e.g. ssl (SSL labels),
+                   signal, bottom
+    <name>.csv   - feature table (manipulate.feature_table) of the SSLs
+    <name>.json  - manifest: input size and time, parameters, timing
+
+The manifest is written last. Inputs with a manifest matching the input
+file and parameters are skipped (--force to redo), so an interrupted run
+continues where it stopped.
+
+Files are read (and decompressed) on a background thread, up to
+--prefetch files ahead, while --jobs worker processes run the pipeline.
+"""
+
+import argparse
+import glob
+import inspect
+import json
+import os
+import queue
+import sys
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+
+import numpy as np
+
+from pyechomask.manipulate import feature_table
+from pyechomask.pipeline import sslem_pipeline
+from pyechomask.store import HEADER, load_pickle, open_echogram
+
+OUTPUTS    = ('ssl','bottom','table')
+PICKLES    = ('.pkl','.pklz','.pickle')
+CLI_PARAMS = ('transpose','outputs')
+
+
+def _is_store(path):
+    return os.path.isfile(os.path.join(path,HEADER))
+
+
+def find_inputs(patterns):
+    '''
+    echogram files and stores of patterns (files, directories or globs),
+    in order, without repeats
+    '''
+    found = []
+    for pattern in patterns:
+        if os.path.isdir(pattern) and not _is_store(pattern):
+            names   = sorted(os.listdir(pattern))
+            matches = [os.path.join(pattern,n) for n in names
+                       if n.lower().endswith(PICKLES) or _is_store(os.path.join(pattern,n))]
+        elif os.path.exists(pattern):
+            matches = [pattern]
+        else:
+            matches = sorted(glob.glob(pattern,recursive = True))
+        for path in matches:
+            path = os.path.normpath(path)
+            if path not in found:
+                found.append(path)
+    return found
+
+
+def output_name(path):
+    '''
+    name of the outputs of input path (file name less extensions)
+    '''
+    name = os.path.basename(os.path.normpath(path))
+    while os.path.splitext(name)[1].lower() in PICKLES:
+        name = os.path.splitext(name)[0]
+    return name
+
+
+def _signature(path):
+    ## size and modification time of an input (all files of a store)
+    paths = [os.path.join(path,n) for n in sorted(os.listdir(path))] \
+            if os.path.isdir(path) else [path]
+    stats = [os.stat(p) for p in paths]
+    return {'size':sum(s.st_size for s in stats),'mtime':max(s.st_mtime for s in stats)}
+
+
+def _outputs(output,name,outputs):
+    ## output files of name
+    files = [os.path.join(output,name + '.json')]
+    if [o for o in outputs if o != 'table']:
+        files.append(os.path.join(output,name + '.npz'))
+    if 'table' in outputs:
+        files.append(os.path.join(output,name + '.csv'))
+    return files
+
+
+def is_current(path,output,params,outputs):
+    '''
+    outputs of path exist and were made from this input with params
+    '''
+    files = _outputs(output,output_name(path),outputs)
+    if not all(os.path.exists(f) for f in files):
+        return False
+    try:
+        with open(files[0]) as f:
+            manifest = json.load(f)
+    except (OSError,ValueError):
+        return False
+    return (manifest.get('input_signature') == _signature(path)
+            and manifest.get('params') == params and manifest.get('outputs') == list(outputs))
+
+
+def load(path,transpose = False):
+    '''
+    Sv and store metadata (sample_int, noise_level) of an input
+    '''
+    if _is_store(path):
+        e = open_echogram(path)
+        return np.asarray(e),{'sample_int':e.sample_int,'noise_level':e.noise_level}
+    Sv = np.asarray(load_pickle(path),dtype = float)
+    return (Sv.T if transpose else Sv),{}
+
+
+def _write(path,write):
+    ## write through a temporary file, so outputs are whole or missing
+    tmp = path + '.part'
+    with open(tmp,'wb') as f:
+        write(f)
+    os.replace(tmp,path)
+
+
+def process(path,Sv,meta,params,outputs,output):
+    '''
+    SSLEM of one echogram, outputs written to output: timing record
+    '''
+    t0     = time.time()
+    kwargs = {k:v for k,v in meta.items() if v is not None}
+    kwargs.update(params)
+    kwargs.setdefault('cache_bytes',0) ## one run, nothing to reuse
+    if 'pl' not in kwargs or 'sample_int' not in kwargs:
+        raise ValueError('pl and sample_int are required parameters')
+    names  = [o for o in outputs if o != 'table']
+    needed = set(names) | ({'ssl','Sv_clean'} if 'table' in outputs else set())
+    result = sslem_pipeline(**kwargs).run(Sv,outputs = sorted(needed))
+
+    name   = output_name(path)
+    if names:
+        _write(os.path.join(output,name + '.npz'),
+               lambda f: np.savez_compressed(f,**{n:result[n] for n in names}))
+    if 'table' in outputs:
+        table = feature_table(result['Sv_clean'],result['ssl'],kwargs.get('noise_level',-999))
+        _write(os.path.join(output,name + '.csv'),
+               lambda f: np.savetxt(f,table,fmt = '%s',delimiter = ',',
+                                    header = ','.join(table.dtype.names),comments = ''))
+    return {'shape':list(Sv.shape),'compute_time':time.time() - t0,
+            'n_ssl':int(result['ssl'].max()) if 'ssl' in result else None}
+
+
+def _prefetch(paths,transpose,q,stop):
+    ## load inputs onto q, None when done
+    for path in paths:
+        if stop.is_set():
+            break
+        t0 = time.time()
+        try:
+            item = (path,) + load(path,transpose) + (time.time() - t0,None)
+        except Exception as error:
+            item = (path,None,None,time.time() - t0,error)
+        q.put(item)
+    q.put(None)
+
+
+def run(paths,params,output,jobs = 1,prefetch = 2,force = False,verbose = True):
+    '''
+    :param paths: inputs (find_inputs)
+    :type  paths: list of str
+
+    :param params: parameter file contents (see module description)
+    :type  params: dict
+
+    :param output: output directory (created)
+    :type  output: str
+
+    :param jobs: worker processes (1: run in this process)
+    :type  jobs: int
+
+    :param prefetch: inputs read ahead of the workers
+    :type  prefetch: int
+
+    :param force: redo inputs with current outputs
+    :type  force: bool
+
+    return:
+    :param report: one record per input: path, status ('done', 'skipped'
+                   or 'failed'), shape, load_time, compute_time, n_ssl,
+                   error
+    :type  report: list of dict
+
+    desc: SSLEM of every input, see the module description
+
+    defined by RP
+
+    status: test
+    '''
+    params    = dict(params)
+    outputs   = list(params.pop('outputs',OUTPUTS))
+    recorded  = dict(params) ## compared with and written to manifests
+    transpose = bool(params.pop('transpose',False))
+    os.makedirs(output,exist_ok = True)
+    report    = []
+    todo      = []
+    for path in paths:
+        if not force and is_current(path,output,recorded,outputs):
+            report.append({'path':path,'status':'skipped'})
+            if verbose:
+                print('%-40s skipped (current)' % path)
+        else:
+            todo.append(path)
+
+    t_start   = time.time()
+    q         = queue.Queue(maxsize = max(1,prefetch))
+    stop      = threading.Event()
+    loader    = threading.Thread(target = _prefetch,args = (todo,transpose,q,stop),daemon = True)
+    pool      = ProcessPoolExecutor(max_workers = jobs) if jobs > 1 else None
+    running   = {}
+
+    def finish(path,load_time,compute):
+        ## record, manifest and progress line of a finished input
+        record = {'path':path,'load_time':load_time}
+        try:
+            record.update(compute())
+            record['status'] = 'done'
+            manifest = dict(record,input_signature = _signature(path),params = recorded,
+                            outputs = outputs)
+            name     = output_name(path)
+            _write(os.path.join(output,name + '.json'),
+                   lambda f: f.write(json.dumps(manifest,indent = 1).encode()))
+        except Exception as error:
+            record.update(status = 'failed',error = '%s: %s' % (type(error).__name__,error))
+        report.append(record)
+        if verbose:
+            if record['status'] == 'done':
+                pixels = np.prod(record['shape'])
+                print('%-40s %12s  load %7.2f s  compute %8.2f s  %7.2f Mpixel/s' %
+                      (path,'x'.join(map(str,record['shape'])),load_time,
+                       record['compute_time'],pixels/1e6/max(record['compute_time'],1e-9)))
+            else:
+                print('%-40s FAILED %s' % (path,record['error']))
+
+    def collect(block):
+        done,_ = wait(list(running),return_when = FIRST_COMPLETED) if block else \
+                 ([f for f in running if f.done()],None)
+        for future in done:
+            path,load_time = running.pop(future)
+            finish(path,load_time,future.result)
+
+    loader.start()
+    try:
+        while True:
+            item = q.get()
+            if item is None:
+                break
+            path,Sv,meta,load_time,error = item
+            if error is not None:
+                def failed(error = error):
+                    raise error
+                finish(path,load_time,failed)
+            elif pool is None:
+                finish(path,load_time,
+                       lambda: process(path,Sv,meta,params,outputs,output))
+            else:
+                while len(running) >= jobs:
+                    collect(True)
+                future          = pool.submit(process,path,Sv,meta,params,outputs,output)
+                running[future] = (path,load_time)
+                collect(False)
+            del Sv
+        while running:
+            collect(True)
+    finally:
+        stop.set()
+        if pool is not None:
+            pool.shutdown(cancel_futures = True)
+
+    if verbose:
+        done   = [r for r in report if r['status'] == 'done']
+        failed = [r for r in report if r['status'] == 'failed']
+        wall   = time.time() - t_start
+        pixels = sum(np.prod(r['shape']) for r in done)
+        print('\n%d done, %d skipped, %d failed in %.1f s (%.2f files/s, %.2f Mpixel/s)' %
+              (len(done),len(report) - len(done) - len(failed),len(failed),wall,
+               len(done)/max(wall,1e-9),pixels/1e6/max(wall,1e-9)))
+    return report
+
+
+def main(argv = None):
+    parser = argparse.ArgumentParser(prog = 'pyechomask',
+                                     description = 'SSLEM masks and feature tables of '
+                                                   'echogram files')
+    parser.add_argument('inputs',nargs = '+',
+                        help = 'echogram files, stores, directories or glob patterns')
+    parser.add_argument('-p','--params',required = True,help = 'parameter file (JSON)')
+    parser.add_argument('-o','--output',default = '.',help = 'output directory')
+    parser.add_argument('-j','--jobs',type = int,default = 1,
+                        help = 'worker processes (default 1, 0: one per core)')
+    parser.add_argument('--prefetch',type = int,default = 2,
+                        help = 'files read ahead of the workers (default 2)')
+    parser.add_argument('--force',action = 'store_true',help = 'redo current outputs')
+    parser.add_argument('-q','--quiet',action = 'store_true')
+    args = parser.parse_args(argv)
+
+    with open(args.params) as f:
+        params = json.load(f)
+    unknown = set(params) - set(inspect.signature(sslem_pipeline).parameters) - \
+              set(CLI_PARAMS)
+    if unknown:
+        parser.error('unknown parameters %s' % ', '.join(sorted(unknown)))
+    paths = find_inputs(args.inputs)
+    if not paths:
+        parser.error('no echogram files in %s' % ' '.join(args.inputs))
+
+    jobs   = args.jobs if args.jobs > 0 else (os.cpu_count() or 1)
+    report = run(paths,params,args.output,jobs,args.prefetch,args.force,not args.quiet)
+    return 1 if any(r['status'] == 'failed' for r in report) else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
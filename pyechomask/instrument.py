@@ -0,0 +1,308 @@
+# -*- coding: utf-8 -*-
+"""
+.. :module:: instrument
+    :synopsis: opt-in timing, memory and iteration counts of mask functions
+
+| Developed by: Roland Proud (RP) <rp43@st-andrews.ac.uk>
+|               Pelagic Ecology Research Group, University of St Andrews
+| Contributors:
+|
+| Maintained by:
+| Modification History:
+|
+
+Public functions of masks and manipulate that do array work are
+@instrumented (not small helpers such as mask_buffer). While no
+Recorder is active an instrumented function costs one extra call and a
+list test; while one is, each call produces a Call record with
+
+    time       - wall time (s), generators: time spent inside next()
+    self_time  - time less the time of the instrumented calls it made
+    bytes      - peak memory allocated during the call (Recorder(memory =
+                 True), tracemalloc)
+    inputs     - (shape, dtype) of the array arguments
+    outputs    - (shape, dtype) of the arrays returned (or yielded, first)
+    counts     - inner iteration counts, e.g. planes and window_samples
+                 (binary_signal: median planes computed, not cached, and
+                 the values their windows read), labels (feature_median),
+                 pings (binary_seabed), blocks (generators)
+
+span(name) records a section of code the same way (pipeline stages).
+
+e.g.
+    with Recorder(memory = True) as rec:
+        sslem_pipeline(...).run(Sv)
+    print(rec.report())
+
+    ## stream records instead of keeping them
+    with Recorder(callback = lambda call: log.info(call),keep = False):
+        ...
+"""
+
+import functools
+import inspect
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager
+
+_recorders = [] ## active Recorders
+_local     = threading.local() ## per thread stack of open Calls
+
+
+class Call(object):
+    '''
+    record of one instrumented call (see module description), depth is
+    the number of instrumented calls it was made from (per thread)
+    '''
+
+    __slots__ = ('name','time','self_time','bytes','inputs','outputs','counts','depth',
+                 'thread','_child_time','_peak','_start_bytes')
+
+    def __init__(self,name,inputs,depth):
+        self.name        = name
+        self.time        = 0.
+        self.self_time   = 0.
+        self.bytes       = None
+        self.inputs      = inputs
+        self.outputs     = []
+        self.counts      = {}
+        self.depth       = depth
+        self.thread      = threading.get_ident()
+        self._child_time = 0.
+        self._peak       = 0
+
+    def __repr__(self):
+        return 'Call(%s, time = %.6f, bytes = %s, counts = %s)' % (self.name,self.time,
+                                                                 self.bytes,self.counts)
+
+
+def _arrays(values):
+    ## (shape, dtype) of arrays (and Echograms) in values, one level into lists
+    out = []
+    for v in values:
+        if isinstance(v,(list,tuple)):
+            out.extend((tuple(x.shape),str(x.dtype)) for x in v
+                       if hasattr(x,'dtype') and hasattr(x,'shape'))
+        elif hasattr(v,'dtype') and hasattr(v,'shape'):
+            out.append((tuple(v.shape),str(v.dtype)))
+    return out
+
+
+def _stack():
+    stack = getattr(_local,'stack',None)
+    if stack is None:
+        stack = _local.stack = []
+    return stack
+
+
+def _enter(call):
+    ## start timing (and tracing) call, made from the top of the stack
+    stack = _stack()
+    stack.append(call)
+    if tracemalloc.is_tracing() and any(r.memory for r in _recorders):
+        current,peak = tracemalloc.get_traced_memory()
+        if len(stack) > 1:
+            stack[-2]._peak = max(stack[-2]._peak,peak)
+        call._start_bytes = current
+        tracemalloc.reset_peak()
+    return time.perf_counter()
+
+
+def _exit(call,t0):
+    ## stop timing call (one step of a generator), pass it to its caller
+    elapsed    = time.perf_counter() - t0
+    stack      = _stack()
+    stack.pop()
+    call.time += elapsed
+    if stack:
+        stack[-1]._child_time += elapsed
+    if hasattr(call,'_start_bytes'):
+        peak       = max(call._peak,tracemalloc.get_traced_memory()[1])
+        call.bytes = max(call.bytes or 0,peak - call._start_bytes)
+        call._peak = peak
+        if stack:
+            stack[-1]._peak = max(stack[-1]._peak,peak)
+        del call._start_bytes
+
+
+def _finish(call):
+    call.self_time = call.time - call._child_time
+    for recorder in list(_recorders):
+        recorder._add(call)
+
+
+def instrumented(f):
+    '''
+    decorator: record calls of f while a Recorder is active
+    '''
+    name = '%s.%s' % (f.__module__.split('.')[-1],f.__name__)
+
+    if inspect.isgeneratorfunction(f):
+        @functools.wraps(f)
+        def wrapper(*args,**kwargs):
+            if not _recorders:
+                return f(*args,**kwargs)
+            return _generator(f,name,args,kwargs)
+        return wrapper
+
+    @functools.wraps(f)
+    def wrapper(*args,**kwargs):
+        if not _recorders:
+            return f(*args,**kwargs)
+        call = Call(name,_arrays(args) + _arrays(kwargs.values()),len(_stack()))
+        t0   = _enter(call)
+        try:
+            result = f(*args,**kwargs)
+        finally:
+            _exit(call,t0)
+        call.outputs = _arrays(result if isinstance(result,tuple) else (result,))
+        _finish(call)
+        return result
+    return wrapper
+
+
+def _generator(f,name,args,kwargs):
+    ## instrumented generator: time inside next(), outputs of the first item
+    call = Call(name,_arrays(args) + _arrays(kwargs.values()),len(_stack()))
+    gen  = f(*args,**kwargs)
+    try:
+        while True:
+            t0 = _enter(call)
+            try:
+                item = next(gen)
+            except StopIteration:
+                return
+            finally:
+                _exit(call,t0)
+            if not call.outputs:
+                call.outputs = _arrays(item if isinstance(item,tuple) else (item,))
+            call.counts['blocks'] = call.counts.get('blocks',0) + 1
+            yield item
+    finally:
+        gen.close()
+        _finish(call)
+
+
+def count(name,n = 1):
+    '''
+    add n to the count name of the instrumented call in progress (nothing
+    while no Recorder is active)
+    '''
+    if _recorders:
+        stack = _stack()
+        if stack:
+            counts       = stack[-1].counts
+            counts[name] = counts.get(name,0) + n
+
+
+@contextmanager
+def span(name):
+    '''
+    record the code in the with block as a call of name
+    '''
+    if not _recorders:
+        yield None
+        return
+    call = Call(name,[],len(_stack()))
+    t0   = _enter(call)
+    try:
+        yield call
+    finally:
+        _exit(call,t0)
+        _finish(call)
+
+
+class Recorder(object):
+    '''
+    :param memory: record bytes allocated per call (starts tracemalloc,
+                   which slows allocation heavy code down)
+    :type  memory: bool
+
+    :param callback: called with each finished Call
+    :type  callback: function
+
+    :param keep: keep the Calls (.calls) for summary and report
+    :type  keep: bool
+
+    desc: collects the Calls of instrumented functions between start()
+          and stop(), or in a with block. Recorders can be nested; each
+          sees every call. Calls from other threads are recorded with
+          their own depth; bytes are not reliable while threads allocate
+          at once (tracemalloc peaks are global).
+
+    defined by RP
+
+    status: test
+    '''
+
+    def __init__(self,memory = False,callback = None,keep = True):
+        self.memory    = memory
+        self.callback  = callback
+        self.keep      = keep
+        self.calls     = []
+        self._tracing  = False
+        self._lock     = threading.Lock()
+
+    def _add(self,call):
+        if self.keep:
+            with self._lock:
+                self.calls.append(call)
+        if self.callback is not None:
+            self.callback(call)
+
+    def start(self):
+        if self.memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self._tracing = True
+        _recorders.append(self)
+        return self
+
+    def stop(self):
+        if self in _recorders:
+            _recorders.remove(self)
+        if self._tracing:
+            tracemalloc.stop()
+            self._tracing = False
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self,*exc):
+        self.stop()
+
+    def clear(self):
+        self.calls = []
+
+    def summary(self):
+        '''
+        per function name: calls, time, self_time, max_time (s), bytes
+        (max, None if not recorded) and counts (summed)
+        '''
+        out = {}
+        for call in self.calls:
+            s = out.setdefault(call.name,{'calls':0,'time':0.,'self_time':0.,'max_time':0.,
+                                          'bytes':None,'counts':{}})
+            s['calls']     += 1
+            s['time']      += call.time
+            s['self_time'] += call.self_time
+            s['max_time']   = max(s['max_time'],call.time)
+            if call.bytes is not None:
+                s['bytes'] = max(s['bytes'] or 0,call.bytes)
+            for name,n in call.counts.items():
+                s['counts'][name] = s['counts'].get(name,0) + n
+        return out
+
+    def report(self,sort = 'self_time',top = None):
+        '''
+        summary as a table (str), sorted by sort (descending)
+        '''
+        summary = sorted(self.summary().items(),key = lambda s: -(s[1][sort] or 0))[:top]
+        lines   = ['%-32s %7s %11s %11s %11s %10s  %s' % ('function','calls','time (s)',
+                   'self (s)','max (s)','peak (MB)','counts')]
+        for name,s in summary:
+            peak   = '-' if s['bytes'] is None else '%.1f' % (s['bytes']/2.**20)
+            counts = ' '.join('%s=%d' % c for c in sorted(s['counts'].items()))
+            lines.append('%-32s %7d %11.4f %11.4f %11.4f %10s  %s' % (name,s['calls'],s['time'],
+                         s['self_time'],s['max_time'],peak,counts))
+        return '\n'.join(lines)
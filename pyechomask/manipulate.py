@@ -15,14 +15,71 @@ TODO:
 UPDATE DESCRIPTIONS AND COMMENTS
 """
 
+import heapq
+
 import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
 from scipy import ndimage
 
+from pyechomask import instrument
+from pyechomask.instrument import instrumented
+
+## dtype policy: binary masks are MASK_DTYPE (0 - noise; 1 - signal), labels
+## the smallest unsigned integer type holding the largest label (label_dtype).
+## Functions returning an array accept out = to write into an existing array.
+MASK_DTYPE = np.uint8
+## rolling_median: windows wider than HEAP_WINDOW use the heap of 
+## windowed_median per line rather than sorting every window at once, 
+## sorted in blocks of at most MEDIAN_BLOCK values (the two take about 
+## the same time per value at w = 500)
+HEAP_WINDOW  = 401
+MEDIAN_BLOCK = 2**22
+
 
-def median_1D_filter(data,window_size,error_value = 0):
+def label_dtype(max_label):
     '''
-    Running 1D median filter on masked data, width = window_size
-    Return error_value where less than 3 data values
+    smallest unsigned integer dtype holding labels 0...max_label
+    '''
+    for dtype in (np.uint8,np.uint16,np.uint32):
+        if max_label <= np.iinfo(dtype).max:
+            return np.dtype(dtype)
+    return np.dtype(np.uint64)
+
+
+def mask_buffer(shape,out = None,fill = 0,dtype = MASK_DTYPE):
+    '''
+    out filled with fill, or a new array of dtype (binary mask by default)
+    '''
+    if out is None:
+        return np.full(shape,fill,dtype = dtype)
+    if out.shape != tuple(shape):
+        raise ValueError('out has shape %s, expected %s' % (out.shape,tuple(shape)))
+    out[...] = fill
+    return out
+
+
+def _ping_tiles(Sv,tile_pings):
+    '''
+    split Sv into blocks of at most tile_pings pings (columns)
+    
+    Sv can be a 2D array (blocks are views) or an iterable of 2D ping 
+    blocks with the same number of rows, which are re-split if larger
+    '''
+    if hasattr(Sv,'shape') and len(Sv.shape) == 2:
+        Sv = [Sv]
+    for block in Sv:
+        pings = block.shape[1]
+        size  = pings if tile_pings is None else max(1,int(tile_pings))
+        for p in range(0,pings,size):
+            yield block[:,p:p + size]
+
+
+def median_1D_windows(n,window_size,first = 0,last = None):
+    '''
+    start and stop (exclusive) of the median_1D_filter window of values 
+    first...last-1 of n values (default all): centred windows of width window_size (made odd, min 3), 
+    clipped at the ends. The first window_size/2 windows stop one value 
+    short of centred, as they always have.
     '''
     ## make window odd
     if window_size%2 == 0:
@@ -30,196 +87,820 @@ def median_1D_filter(data,window_size,error_value = 0):
     ## set min size of window to 3
     window_size = max([window_size,3]) ## min
     ## size of window to the left/right of evaluted pixel
-    size   = int(window_size/2)
+    size  = int(window_size/2)
+    idx   = np.arange(first,n if last is None else last)
+    start = np.maximum(idx - size,0)
+    stop  = np.minimum(idx + size + 1,n)
+    ## leading windows
+    lead  = idx < size
+    stop[lead] = np.minimum(idx[lead] + size,n)
+    return start,stop
+
+
+@instrumented
+def windowed_median(data,start,stop,error_value = 0,min_count = 3,out = None):
+    '''
+    median of the valid (unmasked, finite) values of data[start[i]:stop[i]]
+    for each window i. Return error_value where less than min_count data 
+    values. start and stop must be non-decreasing (sliding windows).
+    
+    One line at a time (e.g. a seabed line); rolling_median does whole
+    arrays. The window is held as two heaps (lower half max-heap, upper half 
+    min-heap) with lazy removal of values that have left it, so each 
+    value is added and removed once: O(n log w)
+    '''
     ## add mask
-    data   = np.ma.masked_invalid(data)  
-    result = []
-    ## calculate median for rolling window
-    ## if  less than 3 data values in window return error_value
-    for i in range(size):        
-        window      = data[0:size+i]
-        window_data = window[window.mask == False]
-        if len(window_data) > 2:
-            result.append(np.median(window_data))
-        else:
-            result.append(error_value)
-    for i in range(len(data) - 2*size):
-        window      = data[i:i+2*size+1]
-        window_data = window[window.mask == False]
-        if len(window_data) > 2:
-            result.append(np.median(window_data))
-        else:
-            result.append(error_value)           
-    for i in range(size):
-        window      = data[-2*size+i:]
-        window_data = window[window.mask == False]
-        if len(window_data) > 2:
-            result.append(np.median(window_data))
+    data   = np.ma.masked_invalid(data)
+    values = np.ma.getdata(data).astype(float).tolist()
+    valid  = (~np.ma.getmaskarray(data)).tolist()
+    result = np.empty(len(start)) if out is None else out
+    
+    lo,hi  = [],[]           ## lower half (-value,idx), upper half (value,idx)
+    in_lo  = [False]*len(values)
+    nlo    = nhi = 0         ## valid values in window on each side
+    a = b  = 0               ## current window data[a:b]
+    
+    for i,(s,e) in enumerate(zip(start,stop)):
+        s,e = int(s),int(e)
+        ## add values entering the window
+        for j in range(max(b,s),e):
+            if not valid[j]:
+                continue
+            while lo and lo[0][1] < s:
+                heapq.heappop(lo)
+            if lo and values[j] <= -lo[0][0]:
+                heapq.heappush(lo,(-values[j],j))
+                in_lo[j] = True
+                nlo     += 1
+            else:
+                heapq.heappush(hi,(values[j],j))
+                nhi     += 1
+        ## remove values leaving the window (lazily from the heaps)
+        for j in range(a,min(s,b)):
+            if valid[j]:
+                if in_lo[j]:
+                    nlo -= 1
+                else:
+                    nhi -= 1
+        a,b = s,max(b,e)
+        ## rebalance: nlo == nhi or nlo == nhi + 1
+        while True:
+            while lo and lo[0][1] < a:
+                heapq.heappop(lo)
+            while hi and hi[0][1] < a:
+                heapq.heappop(hi)
+            if nlo > nhi + 1:
+                v,j      = heapq.heappop(lo)
+                heapq.heappush(hi,(-v,j))
+                in_lo[j] = False
+                nlo,nhi  = nlo - 1,nhi + 1
+            elif nlo < nhi:
+                v,j      = heapq.heappop(hi)
+                heapq.heappush(lo,(-v,j))
+                in_lo[j] = True
+                nlo,nhi  = nlo + 1,nhi - 1
+            else:
+                break
+        ## median
+        if nlo + nhi < max(min_count,1):
+            result[i] = error_value
+        elif nlo > nhi:
+            result[i] = -lo[0][0]
         else:
-            result.append(error_value)
-        
-    return np.array(result)
+            result[i] = (-lo[0][0] + hi[0][0])/2.
+    return result
 
 
-def feature_median(Sv,mask,noise_level = -999):
+@instrumented
+def rolling_median(data,window_size,axis = -1,error_value = 0,min_count = 3,out = None):
+    '''
+    :param data: values (masked and non-finite values are skipped)
+    :type  data: numpy.array
+    
+    :param window_size: width of the running window (made odd, min 3)
+    :type  window_size: int
+    
+    :param axis: axis along which to filter
+    :type  axis: int
+    
+    :param error_value: value where less than min_count data values
+    :type  error_value: float
+    
+    :param out: array to write the result to
+    :type  out: numpy.array
+    
+    :return
+    :param result: running median, same shape as data
+    :type  result: numpy.array
+    
+    desc: NaN/mask aware running median along an axis. Windows are those
+          of median_1D_filter (median_1D_windows). Every line is done at 
+          once: the windows (blocks of MEDIAN_BLOCK values) are sorted, 
+          invalid values last, and the median taken at the valid count, 
+          O(n w log w) for n values and window w in numpy. Windows wider
+          than HEAP_WINDOW use windowed_median line by line, O(n log w) 
+          in python.
+    
+    defined by RP
+    
+    status: test
+    '''
+    data       = np.asanyarray(data)
+    if out is None:
+        out    = np.empty(data.shape)
+    result     = np.moveaxis(out,axis,-1)
+    n          = result.shape[-1]
+    ## make window odd, min 3
+    window     = max(window_size + (window_size%2 == 0),3)
+    if window > HEAP_WINDOW:
+        lines      = np.moveaxis(np.ma.masked_invalid(data),axis,-1)
+        start,stop = median_1D_windows(n,window_size)
+        for k in np.ndindex(lines.shape[:-1]):
+            result[k] = windowed_median(lines[k],start,stop,error_value,min_count)
+        return out
+    
+    ## lines padded with NaN (and NaN where invalid), window i covers 
+    ## i - size...i + size
+    size       = window//2
+    padded     = np.full(result.shape[:-1] + (n + 2*size,),np.nan)
+    inner      = padded[...,size:size + n]
+    inner[...] = np.moveaxis(np.ma.getdata(data),axis,-1)
+    inner[~np.isfinite(inner) | np.moveaxis(np.ma.getmaskarray(data),axis,-1)] = np.nan
+    padded     = padded.reshape(-1,n + 2*size)
+    medians    = result.reshape(-1,n) if result.flags.c_contiguous else \
+                 np.empty((len(padded),n))
+    cols       = max(1,min(n,MEDIAN_BLOCK//window))
+    block      = max(1,MEDIAN_BLOCK//(cols*window))
+    for r0 in range(0,len(padded),block):
+        for c0 in range(0,n,cols):
+            c1   = min(n,c0 + cols)
+            win  = sliding_window_view(padded[r0:r0 + block,c0:c1 + 2*size],window,
+                                       axis = -1).copy()
+            ## leading windows stop one value short of centred
+            win[:,:max(0,size - c0),-1] = np.nan
+            win.sort(axis = -1)
+            k    = window - np.isnan(win).sum(axis = -1)
+            lo   = np.take_along_axis(win,((k - 1)//2)[...,np.newaxis],-1)[...,0]
+            hi   = np.take_along_axis(win,(k//2)[...,np.newaxis],-1)[...,0]
+            medians[r0:r0 + block,c0:c1] = np.where(k < max(min_count,1),error_value,
+                                                    (lo + hi)/2.)
+    if not np.shares_memory(medians,out):
+        result[...] = medians.reshape(result.shape)
+    return out
+
+
+@instrumented
+def median_1D_filter(data,window_size,error_value = 0,out = None):
+    '''
+    Running 1D median filter on masked data, width = window_size
+    Return error_value where less than 3 data values
+    '''
+    return rolling_median(data,window_size,error_value = error_value,out = out)
+
+
+def _group_features(values,labels,valid):
+    '''
+    group labelled pixels (labels > 0) with a single sort by label, then
+    valid pixels first, then value
+    
+    returns flat pixel index in that order, the unique labels and the 
+    start, pixel count and valid pixel count of each label
+    '''
+    labels  = np.asarray(labels).ravel()
+    valid   = valid.ravel()
+    pixels  = np.flatnonzero(labels > 0)
+    order   = np.lexsort((values.ravel()[pixels],~valid[pixels],labels[pixels]))
+    pixels  = pixels[order]
+    unique,start,count = np.unique(labels[pixels],return_index = True,return_counts = True)
+    n_valid = np.add.reduceat(valid[pixels],start) if len(start) else count
+    return pixels,unique,start,count,n_valid
+
+
+def _group_percentile(values,start,n_valid,q,empty):
+    '''
+    q-th percentile (linear interpolation) of each group of sorted values
+    values[start:start + n_valid], empty for groups with no values
+    '''
+    pos   = start + q/100.*np.maximum(n_valid - 1,0)
+    lo    = np.floor(pos).astype(np.int64)
+    hi    = np.ceil(pos).astype(np.int64)
+    ok    = n_valid > 0
+    lo,hi = np.where(ok,lo,0),np.where(ok,hi,0)
+    if len(values) == 0:
+        return np.full(len(start),empty,dtype = float)
+    if q == 50:
+        ## as np.median: mean of the two middle values
+        result = (values[lo] + values[hi])/2.
+    else:
+        result = values[lo] + (pos - lo)*(values[hi] - values[lo])
+    return np.where(ok,result,empty)
+
+
+@instrumented
+def feature_table(Sv,labels,noise_level = -999,percentiles = (5,25,75,95)):
+    '''
+    :param Sv: gridded Sv values (dB re 1m^-1)
+    :type  Sv: numpy.array
+    
+    :param labels: labelled features (0 - no feature)
+    :type  labels: 2D numpy.array of int
+    
+    :param noise_level: level of background noise (db re 1m^-1)
+    :type  noise_level: float
+    
+    :param percentiles: Sv percentiles to include (0-100)
+    :type  percentiles: sequence of float
+    
+    :return
+    :param table: one record per label with fields
+                  label        - feature label
+                  count        - pixels
+                  n_valid      - pixels with Sv above noise_level
+                  mean_Sv      - mean Sv (mean in linear domain, dB)
+                  median_Sv    - median Sv (linear domain, dB)
+                  p[q]_Sv      - Sv percentiles (linear domain, dB)
+                  ping_min/max - first/last ping (column)
+                  row_min/max  - first/last row (depth sample)
+                  centroid_row - Sv weighted (linear) mean row
+                  Sv statistics are noise_level where n_valid = 0
+    :type  table: numpy structured array
+    
+    desc: per-feature statistics in a single pass: labelled pixels are 
+          sorted by (label,Sv) once and every statistic is a grouped 
+          reduction of that order. See paint_features to map a field
+          back onto the echogram.
+    
+    defined by RP
+    
+    status: test
+    '''
+    Sv      = np.asarray(Sv,dtype = float)
+    row,col = Sv.shape
+    valid   = np.isfinite(Sv) & (Sv > noise_level)
+    ## sort by label then Sv: one order for every statistic
+    pixels,unique,start,count,n_valid = _group_features(Sv,labels,valid)
+    instrument.count('labels',len(unique))
+    
+    ## linear values (valid first and in ascending order within each label)
+    linear  = np.where(valid.ravel()[pixels],10**(Sv.ravel()[pixels]/10.),0)
+    r,c     = pixels//col,pixels%col
+    
+    def to_dB(x):
+        with np.errstate(divide = 'ignore',invalid = 'ignore'):
+            return np.where(n_valid > 0,10*np.log10(x),noise_level)
+    
+    fields = [('label',np.asarray(labels).dtype),('count',np.int64),('n_valid',np.int64),
+              ('mean_Sv',float),('median_Sv',float)] + \
+             [('p%g_Sv' % q,float) for q in percentiles] + \
+             [('ping_min',np.int32),('ping_max',np.int32),('row_min',np.int32),
+              ('row_max',np.int32),('centroid_row',float)]
+    table  = np.zeros(len(unique),dtype = fields)
+    table['label']   = unique
+    table['count']   = count
+    table['n_valid'] = n_valid
+    if len(unique) == 0:
+        return table
+    
+    total  = np.add.reduceat(linear,start)
+    table['mean_Sv']   = to_dB(total/np.maximum(n_valid,1))
+    table['median_Sv'] = to_dB(_group_percentile(linear,start,n_valid,50,1))
+    for q in percentiles:
+        table['p%g_Sv' % q] = to_dB(_group_percentile(linear,start,n_valid,q,1))
+    table['ping_min'] = np.minimum.reduceat(c,start)
+    table['ping_max'] = np.maximum.reduceat(c,start)
+    table['row_min']  = np.minimum.reduceat(r,start)
+    table['row_max']  = np.maximum.reduceat(r,start)
+    weighted = np.add.reduceat(linear*r,start)
+    with np.errstate(divide = 'ignore',invalid = 'ignore'):
+        table['centroid_row'] = np.where(total > 0,weighted/total,
+                                         np.add.reduceat(r,start)/count)
+    return table
+
+
+@instrumented
+def paint_features(labels,table,field,fill = -999,out = None):
+    '''
+    :param labels: labelled features (0 - no feature)
+    :type  labels: 2D numpy.array of int
+    
+    :param table: per-feature records with a 'label' field (feature_table)
+    :type  table: numpy structured array
+    
+    :param field: name of the field to paint
+    :type  field: str
+    
+    :param fill: value where there is no feature (or no record)
+    :type  fill: float
+    
+    :param out: array to write the grid to
+    :type  out: numpy.array
+    
+    :return
+    :param grid: value of field for the feature of each pixel
+    :type  grid: 2D numpy.array
+    
+    desc: map a per-feature statistic back onto the echogram
+    '''
+    labels = np.asarray(labels)
+    dtype  = np.result_type(table[field].dtype,np.asarray(fill).dtype) if out is None \
+             else out.dtype
+    lut    = np.full(int(max(labels.max(initial = 0),table['label'].max(initial = 0))) + 1,
+                     fill,dtype = dtype)
+    lut[table['label'][table['label'] > 0]] = table[field][table['label'] > 0]
+    return _lookup(lut,labels,out)
+
+
+@instrumented
+def feature_median(Sv,mask,noise_level = -999,out = None):
     '''
     for each flagged mask component, calculates median Sv value
+    (of samples not equal to noise_level, in dB), written to out if given
     '''
-    Sv = np.ma.masked_where(Sv == noise_level,Sv)
-    Sv_median = np.ones(mask.shape) * noise_level
+    Sv     = np.asarray(Sv,dtype = float)
+    labels = np.asarray(mask)
+    if labels.dtype.kind not in 'ui':
+        labels = labels.astype(np.int64)
+    ## sort by label then Sv (NaN last), noise samples after
+    pixels,unique,start,count,n_valid = _group_features(Sv,labels,Sv != noise_level)
+    instrument.count('labels',len(unique))
+    table  = np.zeros(len(unique),dtype = [('label',np.int64),('median_Sv',float)])
+    table['label']     = unique
+    table['median_Sv'] = _group_percentile(Sv.ravel()[pixels],start,n_valid,50,
+                                           noise_level)
     
-    for label in np.unique(mask)[1:]:
-        idx = np.where(mask == label)
-        Sv_median[idx] = np.ma.median(Sv[idx])
-        
-    return Sv_median
+    if out is None:
+        out = np.empty(Sv.shape)
+    return paint_features(labels,table,'median_Sv',noise_level,out)
 
 
-def fill_feature_gaps(mask,max_gap_size = 1000):
+@instrumented
+def fill_feature_gaps(mask,max_gap_size = 1000,out = None):
     '''
     fill internal gaps of features up to a max size of 
-    max_gap_size (in pixels)
+    max_gap_size (in pixels). mask is filled in place unless out is given
     '''
-    invert_mask          = np.zeros(mask.shape)
-    invert_mask[mask==0] = 1
-    invert_mask[mask==1] = 0
-    ## fill gaps
-    invert_mask = flag(invert_mask,max_gap_size)
-    mask[invert_mask == 0] = 1
+    ## gaps: noise regions smaller than max_gap_size
+    gaps = flag(mask == 0,max_gap_size) == 0
+    if out is None:
+        out = mask
+    elif out is not mask:
+        out[...] = mask
+    out[gaps] = 1
     
-    return mask
+    return out
 
-def vertical_merge(mask,min_sep):
+@instrumented
+def vertical_merge(mask,min_sep,out = None):
     '''
-    Merge features where distance (in pixels) is less than
-    min_sep
+    :param mask: binary mask (0 - noise; >0 - signal)
+    :type  mask: 2D numpy.array
+    
+    :param min_sep: minimum seperation (rows)
+    :type  min_sep: int
+    
+    :param out: array to write the merged mask to (not mask)
+    :type  out: numpy.array
+    
+    :return
+    :param mask2: merged mask (0 - noise; 1 - signal)
+    :type  mask2: 2D numpy.array
+    
+    desc: Merge features where distance (in pixels) is less than
+          min_sep. A pixel is signal where the nearest signal above it and
+          the nearest signal below it (the pixel itself excluded) are at 
+          most min_sep rows apart. Distances come from running max/min 
+          of signal row indices along depth, so the cost is independent
+          of min_sep.
+          
+          Edges: the top and bottom min_sep rows are always noise, and the 
+          first/last row of a feature is only kept if another feature is 
+          close enough to bridge it (isolated features lose their edge 
+          rows). min_sep < 2 gives an empty mask.
+    
+    defined by RP
+    
+    status: dev
     '''
     size    = int(min_sep)
     row,col = mask.shape
-    mask2   = np.zeros(mask.shape)
-    for asize in range(1,size):
-        bsize = size - asize
-        above = np.zeros((row-2*size,col))
-        below = np.zeros((row-2*size,col))
-        for i in range(asize):
-            above += mask[size-i-1:row-size-i-1,:]
-        for i in range(bsize):   
-            below += mask[size + 1 + i:row-size+i+1,:]            
-        above[above > 0] = 1 
-        below[below > 0] = 1
-        mask2[size:row-size,:][(above + below) == 2] = 1
+    mask2   = mask_buffer(mask.shape,out)
+    if size < 2 or row <= 2*size:
+        return mask2
+    
+    signal  = np.asarray(mask) > 0
+    ## largest gap is (3*row + size) - (-2*row - size)
+    idx     = np.int16 if 5*row + 2*size < 2**15 else np.int32
+    rows    = np.arange(row,dtype = idx)[:,np.newaxis]
+    ## nearest signal row at or above / at or below each row
+    above   = np.where(signal,rows,idx(-2*row - size))
+    np.maximum.accumulate(above,axis = 0,out = above)
+    below   = np.where(signal,rows,idx(3*row + size))
+    np.minimum.accumulate(below[::-1],axis = 0,out = below[::-1])
+    
+    ## gap between the signal either side of rows size...row-size-1
+    gap     = below[size + 1:row - size + 1] - above[size - 1:row - size - 1]
+    mask2[size:row - size][gap <= size] = 1
     
     return mask2
 
 
-def label_ping(ping_mask):
+@instrumented
+def label_ping(ping_mask,out = None):
     '''
     label (flag) each seperate feature, 
     defined as signal regions divided by noise, of a single ping
     '''
-    ## blank
-    ping_label = np.zeros(ping_mask.shape)
+    signal = np.asarray(ping_mask) > 0
+    ## each feature starts where signal follows noise
+    starts = signal & ~np.concatenate(([False],signal[:-1]))
+    labels = np.cumsum(starts)*signal
+    if out is None:
+        return labels.astype(label_dtype(labels.max(initial = 0)))
+    out[...] = labels
+    return out
+
+
+@instrumented
+def ping_runs(mask):
+    '''
+    :param mask: binary mask (0 - noise; >0 - signal)
+    :type  mask: 2D numpy.array
+    
+    :return
+    :param ping,start,stop: ping (column), first row and last row + 1 of 
+                            each vertical run of signal, ordered by ping 
+                            then depth
+    :type  ping,start,stop: 1D numpy.array
+    
+    desc: run-length encode a mask along depth
+    '''
+    row,col = mask.shape
+    edges   = np.zeros((col,row + 2),dtype = np.int8)
+    edges[:,1:-1] = np.asarray(mask).T > 0
+    edges   = np.diff(edges,axis = 1).ravel() ## +1: start, -1: stop
+    start   = np.flatnonzero(edges == 1)
+    stop    = np.flatnonzero(edges == -1)
+    return start//(row + 1),start%(row + 1),stop%(row + 1)
+
+
+@instrumented
+def break_mask(mask,out = None):
+    '''
+    :param mask: binary mask (0 - noise; >0 - signal)
+    :type  mask: 2D numpy.array
     
-    ## signal
-    idx = np.where(ping_mask > 0)[0]
+    :param out: array to write the labels to
+    :type  out: numpy.array
     
-    ## if no signal exit
-    if len(idx) == 0:
-        return ping_label
+    :return
+    :param labelled_mask: labelled features (0 - noise)
+    :type  labelled_mask: 2D numpy.array (label_dtype)
     
-    ## label each feature
-    label = 1
-    vals  = [idx[0]]
-    for k,i in enumerate(idx[1:]):
-        if i != idx[k] + 1:
-            ping_label[vals] = label
-            label += 1
-            vals = [i]
-        else:
-            vals.append(i)
-    ## last one
-    ping_label[vals] = label
-    return ping_label
-
-
-def break_mask(mask):
-    '''
-    break a mask into individual features (no vertical gaps in signal)
-    '''
-    
-    mask[mask > 0]     = 1
-    row,col            = mask.shape
-    prev_col           = label_ping(mask[:,0])
-    labelled_mask      = np.zeros(mask.shape)
-    labelled_mask[:,0] = prev_col 
-    for c in range(1,col):
-        next_col        = label_ping(mask[:,c])
-        all_connections = []
-        for next_feature in np.unique(next_col)[1:]:
-            connections = []
-            next_idx = np.where(next_col == next_feature)[0]
-            for prev_feature in np.unique(prev_col)[1:]:
-                prev_idx = np.where(prev_col == prev_feature)[0]
-                for i in next_idx:
-                    if i in prev_idx:
-                        connections.append(prev_feature)
-                        break
-            all_connections.append(connections)
-        for k,con in enumerate(all_connections):
-            new = False
-            if len(con) == 1:
-                for k2,con2 in enumerate(all_connections):
-                    if k == k2:
-                        continue
-                    if con[0] in con2:
-                        new = True
-            else:## new connection
-                new = True
-            idx = np.where(next_col == k+1)[0]
-            if new:            
-                labelled_mask[idx,c] = np.max(labelled_mask) + 1
-            else:
-                labelled_mask[idx,c] = con[0]
-        prev_col = labelled_mask[:,c]
+    desc: break a mask into individual features (no vertical gaps in signal)
+    
+          Each ping is encoded as vertical runs of signal. A run continues 
+          the feature of the run it overlaps in the previous ping only when
+          the overlap is one-to-one; otherwise (new signal, split or merge) 
+          it starts a new feature. Labels are numbered in order of 
+          appearance, ping by ping from the top. Overlaps are found by 
+          interval search over all runs at once and chains of continued 
+          runs are resolved to their first run by pointer jumping, so the 
+          cost is near-linear in pixels.
+    
+    defined by RP
+    
+    status: test
+    '''
+    row,col         = mask.shape
+    ping,start,stop = ping_runs(mask)
+    nruns           = len(ping)
+    instrument.count('runs',nruns)
+    if nruns == 0:
+        return mask_buffer(mask.shape,out,dtype = label_dtype(0))
+    
+    ## runs keyed by (ping, row) in one sorted sequence
+    width     = row + 1
+    start_key = ping*width + start
+    stop_key  = ping*width + stop
+    
+    def overlapping(p):
+        ## first and last + 1 runs in ping p that overlap each run
+        lo = np.searchsorted(stop_key,p*width + start,side = 'right')
+        hi = np.searchsorted(start_key,p*width + stop,side = 'left')
+        return lo,np.maximum(hi - lo,0)
+    
+    prev,n_prev = overlapping(ping - 1)
+    _,n_next    = overlapping(ping + 1)
+    
+    ## continue a feature where the overlap is one-to-one
+    continues = n_prev == 1
+    continues[continues] = n_next[prev[continues]] == 1
+    root      = np.where(continues,prev,np.arange(nruns))
+    while True:
+        parent = root[root]
+        if np.array_equal(parent,root):
+            break
+        root = parent
+    
+    ## new features numbered in order, continued runs take their root's label
+    labels = np.cumsum(~continues,dtype = np.int64)[root]
+    labels = labels.astype(label_dtype(labels.max()))
+    
+    ## paint runs (pixels in ping-major order)
+    labelled_mask = mask_buffer(mask.shape,out,dtype = labels.dtype)
+    labelled_mask.T[np.asarray(mask).T > 0] = np.repeat(labels,stop - start)
         
     return labelled_mask
 
 
-def flag(mask,min_agg_size = 0,struct = None):
+@instrumented
+def flag(mask,min_agg_size = 0,struct = None,out = None):
     """
     remove small aggregates and label others
     """
     structure=[[1,1,1],
                [1,1,1],
                [1,1,1]]
-    if struct != None:
-        structure == struct
+    if struct is not None:
+        structure = struct
     
     ## label image
-    label_im, nb_labels    = ndimage.label(np.asfarray(mask),structure)
+    label_im, nb_labels    = ndimage.label(np.asarray(mask) != 0,structure)
+    instrument.count('features',nb_labels)
     
-    return remove_features(label_im, min_agg_size)
+    return remove_features(label_im, min_agg_size, out)
+
+def _lookup(lut,labels,out = None,block_size = 2**22):
+    '''
+    lut[labels], a block of rows at a time so index temporaries stay small
+    '''
+    labels = np.asarray(labels)
+    if out is None:
+        out = np.empty(labels.shape,dtype = lut.dtype)
+    rows   = labels.shape[0] if labels.ndim else 1
+    nrows  = max(1,int(block_size*rows/max(labels.size,1)))
+    if labels.ndim == 0 or rows <= nrows:
+        return np.take(lut,labels,out = out,mode = 'clip')
+    for r0 in range(0,rows,nrows):
+        np.take(lut,labels[r0:r0 + nrows],out = out[r0:r0 + nrows],mode = 'clip')
+    return out
 
-def remove_features(label_im, min_agg_size = 0):
+@instrumented
+def feature_sizes(label_im,block_size = 2**20):
     '''
-    remove masked features smaller than min_agg_size (in pixels)
+    number of pixels of each label 0...max(label_im), a block of rows at a time
     '''
-    mask                   = np.zeros(label_im.shape)
-    mask[label_im > 0]     = 1
-    sizes                  = ndimage.sum(mask, label_im, range(len(np.unique(label_im))))
-    mask_size              = sizes < min_agg_size
-    remove_pixel           = mask_size[label_im]
-    label_im[remove_pixel] = 0
-    labels                 = np.unique(label_im)
-    label_clean            = np.searchsorted(labels, label_im)
+    label_im = np.asarray(label_im)
+    n        = int(label_im.max(initial = 0)) + 1
+    sizes    = np.zeros(n,dtype = np.int64)
+    flat     = label_im.reshape(-1)
+    for p0 in range(0,flat.size,block_size):
+        sizes += np.bincount(flat[p0:p0 + block_size],minlength = n)
+    return sizes
+
+@instrumented
+def remove_features(label_im, min_agg_size = 0, out = None):
+    '''
+    remove masked features smaller than min_agg_size (in pixels) and 
+    renumber the remaining features 1...n in label order
+    (label_dtype, written to out if given)
+    '''
+    label_im  = np.asarray(label_im)
+    if label_im.dtype.kind not in 'ui':
+        label_im = label_im.astype(np.int64)
+    sizes     = feature_sizes(label_im)
+    keep      = sizes >= min_agg_size
+    keep[0]   = False
+    lut       = np.cumsum(keep)*keep
+    lut       = lut.astype(label_dtype(lut.max()) if out is None else out.dtype)
     
-    return label_clean
+    return _lookup(lut,label_im,out)
     
 
-def signal_row_filter(mask,window,threshold = 0.5):
+def _find_roots(parent,ids):
     '''
-    :param Sv: gridded Sv values (dB re 1m^-1)
-    :type  Sv: numpy.array
+    union-find roots of ids (pointer jumping, vectorised)
+    '''
+    roots = parent[ids]
+    while True:
+        nxt = parent[roots]
+        if np.array_equal(nxt,roots):
+            return roots
+        roots = nxt
+
+@instrumented
+def flag_tiles(mask,min_agg_size = 0,struct = None,tile_pings = None,dtype = np.uint32):
+    '''
+    :param mask: binary mask (0 - noise; >0 - signal), or iterable of ping 
+                 blocks
+    :type  mask: numpy.array or iterable of numpy.array
+    
+    :param min_agg_size: minimum feature size (pixels)
+    :type  min_agg_size: int
+    
+    :param struct: connectivity (3x3), as flag (default 8-connected)
+    :type  struct: numpy.array
+    
+    :param tile_pings: number of pings per block (default: ping blocks as 
+                       they come, 1000 pings for an array)
+    :type  tile_pings: int
+    
+    :param dtype: label dtype
+    :type  dtype: numpy.dtype
+    
+    return:
+    :param tiles: (labels,sizes) tiles, in ping order. sizes holds the 
+                  pixel count of each feature first labelled in the tile
+                  (labels previous max + 1...)
+    :type  tiles: generator of (2D numpy.array, 1D numpy.array)
+    
+    desc: flag a block of pings at a time. Each block is labelled with 
+          ndimage.label and joined to the previous block through the 
+          struct connections across the block boundary (union-find of 
+          block labels). A tile is emitted once every feature touching it
+          is closed (has no pixel in the last ping received), so sizes 
+          are final and features smaller than min_agg_size are removed. 
+          Features are numbered 1...n in order of their first pixel 
+          along pings (then depth), so tiles do not depend on the block
+          size and equal flag(mask.T,min_agg_size,struct.T).T. A feature
+          spanning many pings holds its tiles back until it ends.
+    
+    defined by RP
+    
+    status: test
+    '''
+    if tile_pings is None and hasattr(mask,'shape'):
+        tile_pings = 1000
+    structure = np.ones((3,3),dtype = int) if struct is None else np.asarray(struct)
+    ## connections from ping p, row r to ping p + 1, row r + dr
+    links     = [dr for dr in (-1,0,1) if structure[1 + dr,2]]
+    
+    ## per block label (0 = background), capacity grown by doubling
+    parent  = np.zeros(1024,dtype = np.int64) 
+    size    = np.zeros(1024,dtype = np.int64) ## pixels (roots)
+    first   = np.zeros(1024,dtype = np.int64) ## first pixel, ping*rows + row (roots)
+    final   = np.zeros(1024,dtype = np.int64) ## output label (roots), 0 = removed
+    count   = 1    ## block labels used
+    pending = []   ## (first ping,block labels,label offset) not yet emitted
+    edge    = None ## block labels of the last ping received
+    pings   = 0    ## pings received
+    n_out   = 0    ## output labels assigned
+    
+    def union(a,b):
+        ## join the features of block labels a and b
+        for x,y in zip(a,b):
+            while parent[x] != x:
+                x = parent[x]
+            while parent[y] != y:
+                y = parent[y]
+            if x == y:
+                continue
+            x,y         = min(x,y),max(x,y)
+            parent[y]   = x
+            size[x]    += size[y]
+            first[x]    = min(first[x],first[y])
+    
+    def emit(p0,labels,base):
+        ## assign output labels to the features starting in this tile
+        nonlocal n_out
+        rows    = labels.shape[0]
+        roots   = _find_roots(parent,np.arange(base + 1,base + labels.max(initial = 0) + 1))
+        new     = np.unique(roots[first[roots] >= p0*rows])
+        new     = new[np.argsort(first[new],kind = 'stable')]
+        keep    = new[size[new] >= min_agg_size]
+        final[keep] = np.arange(n_out + 1,n_out + len(keep) + 1)
+        n_out  += len(keep)
+        lut     = np.concatenate(([0],final[roots])).astype(dtype)
+        return _lookup(lut,labels),size[keep]
+    
+    for tile in _ping_tiles(mask,tile_pings):
+        rows,n      = tile.shape
+        labels,nlab = ndimage.label(np.asarray(tile) != 0,structure)
+        instrument.count('features',nlab)
+        base        = count - 1
+        count      += nlab
+        if count > len(parent):
+            grow   = max(count,2*len(parent)) - len(parent)
+            parent = np.concatenate((parent,np.zeros(grow,dtype = np.int64)))
+            size   = np.concatenate((size,np.zeros(grow,dtype = np.int64)))
+            first  = np.concatenate((first,np.zeros(grow,dtype = np.int64)))
+            final  = np.concatenate((final,np.zeros(grow,dtype = np.int64)))
+        ## new block labels: own roots, sizes and first (ping major) pixel
+        ids          = np.arange(base + 1,count)
+        parent[ids]  = ids
+        size[ids]    = np.bincount(labels.ravel(),minlength = nlab + 1)[1:]
+        flat         = labels.T.ravel()
+        nz           = np.flatnonzero(flat)
+        _,idx        = np.unique(flat[nz],return_index = True)
+        first[ids]   = pings*rows + nz[idx]
+        
+        ## join features across the block boundary
+        cur = np.where(labels[:,0] > 0,labels[:,0] + base,0)
+        if edge is not None:
+            for dr in links:
+                a = edge[max(0,-dr):rows - max(0,dr)]
+                b = cur[max(0,dr):rows - max(0,-dr)]
+                join = (a > 0) & (b > 0)
+                if join.any():
+                    union(*np.unique(np.stack((a[join],b[join])),axis = 1))
+        
+        pending.append((pings,labels,base))
+        edge    = np.where(labels[:,-1] > 0,labels[:,-1] + base,0)
+        pings  += n
+        
+        ## emit tiles with no feature reaching the last ping
+        open_   = _find_roots(parent,np.unique(edge[edge > 0]))
+        while pending:
+            p0,labels,base = pending[0]
+            ids = np.arange(base + 1,base + labels.max(initial = 0) + 1)
+            if np.isin(_find_roots(parent,ids),open_).any():
+                break
+            pending.pop(0)
+            yield emit(p0,labels,base)
+    
+    for p0,labels,base in pending:
+        yield emit(p0,labels,base)
+
+
+def _sum_dtype(dtype,n):
+    '''
+    accumulator dtype for running sums of n values of dtype
+    '''
+    dtype = np.dtype(dtype)
+    if dtype.kind == 'b':
+        return np.dtype(np.uint16 if n < 2**16 else np.uint32)
+    if dtype.kind == 'u' and dtype.itemsize <= 2:
+        return np.dtype(np.uint32 if n*np.iinfo(dtype).max < 2**32 else np.uint64)
+    if dtype.kind in 'ui':
+        return np.dtype(np.int64)
+    return np.dtype(float)
+
+
+def _box_sums(mask,axis):
+    '''
+    cumulative sums of mask along axis, with a leading line of zeros
+    (for _box_filter calls sharing them)
+    '''
+    mask  = np.asarray(mask)
+    acc   = _sum_dtype(mask.dtype,mask.shape[axis])
+    shape = list(mask.shape)
+    shape[axis] += 1
+    csum  = np.zeros(shape,dtype = acc)
+    np.cumsum(mask,axis = axis,dtype = acc,out = csum[1:] if axis == 0 else csum[:,1:])
+    return csum
+
+
+def _box_filter(mask,window,threshold,axis,inclusive,out,block_size = 2**22,csum = None):
+    '''
+    signal where any window (of length window along axis) containing the 
+    pixel has a sum > (or >= if inclusive) window*threshold
+    
+    window sums and the spread of signal windows back over their pixels 
+    are differences of cumulative sums, so the cost does not depend on 
+    window. Lines are processed in blocks of about block_size bytes.
+    csum: cumulative sums from _box_sums(mask,axis), to share between 
+    windows
+    '''
+    window = int(window)
+    mask   = np.asarray(mask)
+    n      = mask.shape[axis]
+    if window < 1 or window > n:
+        raise ValueError('window must be between 1 and %d' % n)
+    if out is None:
+        out = np.empty(mask.shape,dtype = MASK_DTYPE) ## every pixel is written
+    limit  = window*threshold
+    acc    = _sum_dtype(mask.dtype,n) if csum is None else csum.dtype
+    pos    = np.arange(n)
+    first  = np.maximum(pos - window + 1,0)       ## first window containing pixel
+    last   = np.minimum(pos,n - window) + 1       ## last window containing pixel + 1
+    
+    lines  = mask.shape[1 - axis]
+    nlines = max(1,int(block_size/(n*(acc.itemsize + 4))))
+    for l0 in range(0,lines,nlines):
+        block = np.s_[:,l0:l0 + nlines] if axis == 0 else np.s_[l0:l0 + nlines,:]
+        sums  = _box_sums(mask[block],axis) if csum is None else csum[block]
+        ## window sums
+        upper = np.take(sums,np.arange(window,n + 1),axis = axis)
+        lower = np.take(sums,np.arange(0,n - window + 1),axis = axis)
+        upper -= lower
+        del lower
+        hit   = upper >= limit if inclusive else upper > limit
+        del upper
+        ## number of signal windows containing each pixel
+        chit  = np.zeros(hit.shape[:axis] + (hit.shape[axis] + 1,) + hit.shape[axis + 1:],
+                         dtype = np.int32)
+        np.cumsum(hit,axis = axis,out = chit[1:] if axis == 0 else chit[:,1:])
+        count = np.take(chit,last,axis = axis) - np.take(chit,first,axis = axis)
+        out[block] = count > 0
+    
+    return out
+
+
+@instrumented
+def signal_row_filter(mask,window,threshold = 0.5,out = None):
+    '''
+    :param mask: binary mask (0 - noise; 1 - signal)
+    :type  mask: numpy.array
     
     :param window: size in numbwer of pings/columns of analysis window
     :type  window: int
@@ -228,40 +909,25 @@ def signal_row_filter(mask,window,threshold = 0.5):
                         to assign as signal value
     :type  threshold: float
     
-    :param noise_level: level of background noise (db re 1m^-1)
-    :type  noise_level: float
+    :param out: array to write the filtered mask to (may be mask)
+    :type  out: numpy.array
 
-    desc: isolate signal rows
+    desc: isolate signal rows: every window of pings with a sum greater
+          than window*threshold is set to signal, all other pixels to noise.
+          Window sums are taken from cumulative sums, so the cost is 
+          independent of window; bool/uint8 masks are summed as integers.
     
     defined by RP
     
     status: dev
     '''
-    window        = int(window)
-    row,col       = mask.shape
-    filtered_mask = np.zeros((mask.shape))
-    mask_sum      = np.zeros((row,col-window+1))
-    for i in range(window):
-        mask_sum += mask[:,i:col-(window-i-1)]
-    ##
-    mask_sum[mask_sum <= (window*threshold)] = 0  # noise
-    mask_sum[mask_sum > (window*threshold)]  = 1  # signal
-    for i in range(window):
-        filtered_mask[:,i:col-(window-i-1)] += mask_sum
-    filtered_mask[filtered_mask > 0] = 1
-        
-    #for r in range(row):
-    #    for c in range(int(window/2),int(col-window/2) +1,1):
-    #        col_weight = sum(mask[r,c-int(window/2):c+int(window/2)+1])
-    #        if col_weight > (window*threshold):
-    #            filtered_mask[r,c-int(window/2):c+int(window/2)+1] = 1
-                
-    return filtered_mask
+    return _box_filter(mask,window,threshold,1,False,out)
 
-def signal_column_filter(mask,window,threshold = 0.5):
+@instrumented
+def signal_column_filter(mask,window,threshold = 0.5,out = None):
     '''
-    :param Sv: gridded Sv values (dB re 1m^-1)
-    :type  Sv: numpy.array
+    :param mask: binary mask (0 - noise; 1 - signal)
+    :type  mask: numpy.array
     
     :param window: size in numbwer of samples/rows of analysis window
     :type  window: int
@@ -270,95 +936,391 @@ def signal_column_filter(mask,window,threshold = 0.5):
                         to assign as signal value
     :type  threshold: float
     
-    :param noise_level: level of background noise (db re 1m^-1)
-    :type  noise_level: float
+    :param out: array to write the filtered mask to (may be mask)
+    :type  out: numpy.array
+
+    desc: isolate signal columns: every window of samples with a sum of at 
+          least window*threshold is set to signal, all other pixels to 
+          noise. Window sums are taken from cumulative sums, so the cost is
+          independent of window; bool/uint8 masks are summed as integers.
+    
+    defined by RP
+    
+    status: dev
+    '''
+    return _box_filter(mask,window,threshold,0,True,out)
+
+@instrumented
+def signal_rect_filter(mask,row_window,column_window,row_threshold = 0.5,
+                       column_threshold = 0.5,out = None):
+    '''
+    :param mask: binary mask (0 - noise; 1 - signal)
+    :type  mask: numpy.array
+    
+    :param row_window: pings in the signal_row_filter window
+    :type  row_window: int
+    
+    :param column_window: samples in the signal_column_filter window
+    :type  column_window: int
+    
+    :param row_threshold, column_threshold: thresholds of the two filters
+    :type  row_threshold, column_threshold: float
+    
+    :param out: array to write the filtered mask to (may be mask)
+    :type  out: numpy.array
 
-    desc: isolate signal rows
+    desc: signal_row_filter followed by signal_column_filter, with the 
+          intermediate mask held as uint8
     
     defined by RP
     
     status: dev
     '''
-    #if erosion:
-    window        = int(window) 
-    row,col       = mask.shape
-    filtered_mask = np.zeros((mask.shape))
-    mask_sum      = np.zeros((row-window+1,col))
-    for i in range(window):
-        mask_sum += mask[i:row-(window-i-1),:]
-    ## 
-    mask_sum[mask_sum < (window*threshold)] = 0  # noise
-    mask_sum[mask_sum >= (window*threshold)]  = 1  # signal
-    for i in range(window):
-        filtered_mask[i:row-(window-i-1),:] += mask_sum
-    filtered_mask[filtered_mask > 0] = 1
-    ## extend
-    #top      = mask_sum[0:int(window/2),:]
-    #bottom   = mask_sum[(row - window - int(window/2)):,:]
-    #mask_sum = np.vstack((top,mask_sum,bottom))
-
-    
-    ## create mask
-    #filtered_mask[mask_sum > (window*threshold)] = 1
-    #else:
-    #    row,col       = mask.shape
-    #    filtered_mask = np.zeros((mask.shape))
-    #    for c in range(col):
-    #        for r in range(int(window/2),int(row-window/2) +1,1):
-    #            row_weight = sum(mask[r-int(window/2):r+int(window/2)+1,c])
-    #            if row_weight > (window*threshold):
-    #                filtered_mask[r-int(window/2):r+int(window/2)+1,c] = 1
-                
-    return filtered_mask
-
-
-def remove_noise(mask,noise_mask):
-    '''
-    '''
-    mask[noise_mask == 0] = 0
-    return mask
-
-def get_signal_mask(Sv,noise_level = -999):
-    '''
-    '''
-    signal_mask                    = np.ones((Sv.shape))
-    signal_mask[Sv == noise_level] = 0
+    rows = _box_filter(mask,row_window,row_threshold,1,False,
+                       np.empty(np.shape(mask),dtype = np.uint8))
+    return _box_filter(rows,column_window,column_threshold,0,True,out)
+
+
+@instrumented
+def remove_noise(mask,noise_mask,out = None):
+    '''
+    set mask to 0 where noise_mask is 0, in place unless out is given
+    '''
+    if out is None:
+        out = mask
+    elif out is not mask:
+        out[...] = mask
+    out[noise_mask == 0] = 0
+    return out
+
+@instrumented
+def get_signal_mask(Sv,noise_level = -999,out = None):
+    '''
+    binary mask, 0 where Sv is noise_level
+    '''
+    signal_mask                    = mask_buffer(Sv.shape,out,fill = 1)
+    signal_mask[np.asarray(Sv) == noise_level] = 0
     return signal_mask
 
 
-def merge_binary(masks):
+def _depth_integral(values,sample_int,edges):
+    ## integral over depth (axis -2) of values, constant over each sample,
+    ## between consecutive depths in edges (m)
+    rows  = values.shape[-2]
+    csum  = np.zeros(values.shape[:-2] + (rows + 1,values.shape[-1]))
+    np.cumsum(values,axis = -2,out = csum[...,1:,:])
+    pos   = np.clip(edges/float(sample_int),0,rows)
+    i     = np.minimum(pos.astype(int),rows - 1)
+    frac  = (pos - i)[:,np.newaxis]
+    below = csum[...,i,:]
+    below += frac*(csum[...,i + 1,:] - below)
+    return np.diff(below,axis = -2)*sample_int
+
+
+def _ping_blocks(shape,block_size):
+    ## ping slices of about block_size elements of an array of shape
+    step = max(1,block_size//max(1,int(np.prod(shape[:-1]))))
+    return [slice(p0,p0 + step) for p0 in range(0,shape[-1],step)]
+
+
+def _grid_rows(rows,sample_int,new_sample_int):
+    ## rows of new_sample_int covering rows of sample_int
+    return int(np.ceil(rows*sample_int/float(new_sample_int) - 1e-9))
+
+
+@instrumented
+def regrid_Sv(Sv,sample_int,new_sample_int,rows = None,noise_level = -999,out = None,
+              block_size = 2**22):
+    '''
+    :param Sv: gridded Sv values (dB re 1m^-1), depth along axis -2
+               (2D (depth, ping) or 3D (frequency, depth, ping))
+    :type  Sv: numpy.array
+
+    :param sample_int, new_sample_int: sample interval of Sv and of the
+                                       new grid (m)
+    :type  sample_int, new_sample_int: float
+
+    :param rows: rows of the new grid (default: covering the depth of Sv)
+    :type  rows: int
+
+    :param noise_level: level of background noise (db re 1m^-1)
+    :type  noise_level: float
+
+    :param out: array to write the new Sv to
+    :type  out: numpy.array
+
+    :return
+    :param Sv: Sv on the new grid
+    :type  Sv: numpy.array
+
+    desc: each new sample is the mean (linear domain) of the valid Sv
+          (above noise_level, finite, not masked) over its depth
+          interval, weighted by overlap. Means come from the
+          cumulative integral of Sv along depth, so the cost is
+          independent of the ratio of the sample intervals. New samples
+          with no valid Sv (or below the bottom of Sv) are noise_level.
+          Pings are regridded in blocks of about block_size samples.
+
+    defined by RP
+
+    status: test
+    '''
+    Sv     = np.asanyarray(Sv)
+    if rows is None:
+        rows = _grid_rows(Sv.shape[-2],sample_int,new_sample_int)
+    edges  = np.arange(rows + 1)*float(new_sample_int)
+    out    = mask_buffer(Sv.shape[:-2] + (rows,Sv.shape[-1]),out,fill = noise_level,
+                         dtype = float)
+    ## blocks of pings: temporaries of block_size elements
+    for block in _ping_blocks(Sv.shape,block_size):
+        data   = np.ma.getdata(Sv[...,block]).astype(float)
+        with np.errstate(invalid = 'ignore'):
+            valid = np.isfinite(data) & (data > noise_level) & \
+                    ~np.ma.getmaskarray(Sv[...,block])
+        data[~valid] = -np.inf
+        data  /= 10.
+        linear = np.power(10.,data,out = data)
+        total  = _depth_integral(linear,sample_int,edges)
+        weight = _depth_integral(valid,sample_int,edges)
+        with np.errstate(divide = 'ignore',invalid = 'ignore'):
+            result = 10*np.log10(total/weight)
+        result[~(weight > 1e-9*new_sample_int)] = noise_level
+        out[...,block] = result
+    return out
+
+
+@instrumented
+def regrid_mask(mask,sample_int,new_sample_int,rows = None,threshold = 0.5,out = None,
+                block_size = 2**22):
+    '''
+    :param mask: binary mask (0 - noise; >0 - signal), depth along axis -2
+    :type  mask: numpy.array
+
+    :param sample_int, new_sample_int: sample interval of mask and of the
+                                       new grid (m)
+    :type  sample_int, new_sample_int: float
+
+    :param rows: rows of the new grid (default: covering the depth of mask)
+    :type  rows: int
+
+    :param threshold: fraction of a new sample that must be signal
+    :type  threshold: float
+
+    :param out: array to write the mask to
+    :type  out: numpy.array
+
+    :return
+    :param mask: binary mask on the new grid (0 - noise; 1 - signal)
+    :type  mask: numpy.array
+
+    desc: a new sample is signal where signal covers at least threshold
+          of its depth interval (cumulative integral and ping blocks, as
+          regrid_Sv)
+
+    defined by RP
+
+    status: test
+    '''
+    mask   = np.asarray(mask)
+    if rows is None:
+        rows = _grid_rows(mask.shape[-2],sample_int,new_sample_int)
+    edges  = np.arange(rows + 1)*float(new_sample_int)
+    result = mask_buffer(mask.shape[:-2] + (rows,mask.shape[-1]),out)
+    for block in _ping_blocks(mask.shape,block_size):
+        cover = _depth_integral(mask[...,block] != 0,sample_int,edges)
+        np.greater_equal(cover,threshold*new_sample_int - 1e-9,out = result[...,block],
+                         casting = 'unsafe')
+    return result
+
+
+@instrumented
+def stack_Sv(Sv,sample_int,new_sample_int = None,rows = None,noise_level = -999):
+    '''
+    :param Sv: Sv (dB re 1m^-1) of each frequency, (depth, ping) arrays with
+               the same pings (or a 3D (frequency, depth, ping) array)
+    :type  Sv: list of numpy.array
+
+    :param sample_int: sample interval (m) of each frequency, or one for all
+    :type  sample_int: float or list of float
+
+    :param new_sample_int: sample interval of the stack (default: the
+                           finest of sample_int)
+    :type  new_sample_int: float
+
+    :param rows: rows of the stack (default: covering the deepest frequency)
+    :type  rows: int
+
+    :param noise_level: level of background noise (db re 1m^-1)
+    :type  noise_level: float
+
+    :return
+    :param stack: Sv of every frequency on the common grid
+    :type  stack: 3D numpy.array (frequency, depth, ping)
+
+    :param new_sample_int: sample interval of the stack (m)
+    :type  new_sample_int: float
+
+    desc: frequencies logged with different vertical resolution are
+          regridded (regrid_Sv) onto one grid, rather than truncated
+          or padded row by row. Frequencies already on the grid are
+          copied; depths beyond a frequency are noise_level. The stack
+          is the input of the 3D forms of the binary_* masks.
+
+    defined by RP
+
+    status: test
+    '''
+    n          = len(Sv)
+    sample_int = np.broadcast_to(np.asarray(sample_int,dtype = float),(n,))
+    if new_sample_int is None:
+        new_sample_int = float(sample_int.min())
+    pings = {np.shape(s)[-1] for s in Sv}
+    if len(pings) != 1:
+        raise ValueError('every frequency must have the same number of pings')
+    if rows is None:
+        rows = max(_grid_rows(np.shape(s)[-2],si,new_sample_int) for s,si in zip(Sv,sample_int))
+    stack = np.full((n,rows,pings.pop()),noise_level,dtype = float)
+    for k,(s,si) in enumerate(zip(Sv,sample_int)):
+        if si == new_sample_int:
+            r = min(rows,np.shape(s)[-2])
+            stack[k,:r] = np.ma.filled(np.asanyarray(s)[:r],noise_level)
+        else:
+            regrid_Sv(s,si,new_sample_int,rows,noise_level,out = stack[k])
+    return stack,new_sample_int
+
+def _bit_dtype(n_masks):
+    '''
+    smallest unsigned integer dtype holding n_masks bits
+    '''
+    for dtype in (np.uint8,np.uint16,np.uint32,np.uint64):
+        if n_masks <= np.iinfo(dtype).bits:
+            return np.dtype(dtype)
+    raise ValueError('at most 64 masks can be merged')
+
+
+@instrumented
+def merge_binary(masks,out = None,sample_int = None):
     '''
     :param masks: list of masks              
     :type  masks: list[numpy.array,...]
     
+    :param out: array to write the merged mask to (unsigned, enough bits)
+    :type  out: numpy.array
+    
+    :param sample_int: sample interval (m) of each mask, masks on another 
+                       grid than the first are regridded onto it 
+                       (regrid_mask)
+    :type  sample_int: list of float
+    
     :return
     :param output_mask: mask of integers, base2 binary representation of each integer 
                         corresponds to value of each mask input, in the same order.
                         e.g. '0101011', is represented by a unique integer, 43 and 
                         correspond to mask values of 0 for the first mask, 1 for the 
                         second mask etc.
-    :type  output_mask: numpy.array of integers
+    :type  output_mask: numpy.array of unsigned integers, the smallest type
+                        holding one bit per mask (up to 64 masks)
     
     NOTE: the shape of the mask is determined by the first mask in the list
-          all masks should have the same number of columns/pings
+          all masks should have the same number of columns/pings. Without
+          sample_int rows beyond the first mask are dropped and missing 
+          rows are 0, so masks of different vertical resolution (e.g. 
+          frequencies) need sample_int
+          
+          see test_bit and decode_binary to read the masks back
     
     '''
-    ## create array of strings using first mask
-    output_mask     = masks[0].astype('S1')
-    out_row,out_col = output_mask.shape
+    dtype           = _bit_dtype(len(masks)) if out is None else out.dtype
+    out_row,out_col = masks[0].shape
+    output_mask     = mask_buffer((out_row,out_col),out,dtype = dtype)
+    
+    if sample_int is not None:
+        if len(sample_int) != len(masks):
+            raise ValueError('one sample_int per mask')
+        masks = [m if si == sample_int[0] else
+                 regrid_mask(m,si,sample_int[0],out_row) for m,si in zip(masks,sample_int)]
     
-    for m in masks[1:]:
-        row,col                              = m.shape
-        mask_new                             = np.zeros((out_row,out_col)) 
-        mask_new[0:min(row,out_row),:]       = m[0:min(row,out_row),:]           
-        output_mask                          = np.core.defchararray.add\
-        (output_mask, mask_new.astype('S1'))
-    ## change to integers base 2
-    output_mask = np.reshape(np.array([int(x,2) for x in \
-                                       output_mask.flatten()]),output_mask.shape)
+    ## first mask in the most significant bit
+    for m in masks:
+        row    = min(m.shape[0],out_row)
+        output_mask <<= dtype.type(1)
+        output_mask[0:row,:] |= (np.asarray(m[0:row,:]) != 0).astype(dtype)
     
     return output_mask
+
+
+@instrumented
+def test_bit(output_mask,index,n_masks,out = None):
+    '''
+    :param output_mask: merged mask (merge_binary)
+    :type  output_mask: numpy.array
+    
+    :param index: position of the mask in the list given to merge_binary
+    :type  index: int
+    
+    :param n_masks: number of masks merged
+    :type  n_masks: int
+    
+    :param out: array to write the mask to
+    :type  out: numpy.array
     
+    :return
+    :param mask: value of mask index (True - 1; False - 0)
+    :type  mask: numpy.array of bool
+    '''
+    if not 0 <= index < n_masks:
+        raise IndexError('mask index out of range')
+    dtype = np.asarray(output_mask).dtype
+    shift = np.array(n_masks - 1 - index,dtype = dtype)
+    return np.not_equal((output_mask >> shift) & np.array(1,dtype = dtype),0,out = out)
+
+
+@instrumented
+def decode_binary(output_mask,n_masks):
+    '''
+    :param output_mask: merged mask (merge_binary)
+    :type  output_mask: numpy.array
+    
+    :param n_masks: number of masks merged
+    :type  n_masks: int
+    
+    :return
+    :param masks: the merged masks, in the order given to merge_binary
+    :type  masks: list[numpy.array of bool,...]
+    '''
+    return [test_bit(output_mask,k,n_masks) for k in range(n_masks)]
+
+
+@instrumented
+def mask_agreement(mask,reference):
+    '''
+    :param mask: binary mask (0 - noise; 1 - signal)
+    :type  mask: numpy.array
     
+    :param reference: binary mask to compare against
+    :type  reference: numpy.array
+    
+    :return
+    :param report: agreement - proportion of pixels with the same value
+                   iou       - intersection over union of signal pixels
+                               (1 if neither mask has signal)
+                   signal, reference_signal - signal pixel counts
+                   false_signal, missed_signal - signal only in mask/reference
+    :type  report: dict
     
-    
\ No newline at end of file
+    desc: compare two binary masks
+    
+    defined by RP
+    
+    status: test
+    '''
+    a            = np.asarray(mask) > 0
+    b            = np.asarray(reference) > 0
+    intersection = int(np.count_nonzero(a & b))
+    union        = int(np.count_nonzero(a | b))
+    return {'agreement'       : 1 - (union - intersection)/float(max(a.size,1)),
+            'iou'             : intersection/float(union) if union else 1.0,
+            'signal'          : int(np.count_nonzero(a)),
+            'reference_signal': int(np.count_nonzero(b)),
+            'false_signal'    : int(np.count_nonzero(a & ~b)),
+            'missed_signal'   : int(np.count_nonzero(b & ~a))}
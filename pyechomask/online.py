@@ -0,0 +1,246 @@
+# -*- coding: utf-8 -*-
+"""
+.. :module:: online
+    :synopsis: SSLEM masks updated as pings arrive
+
+| Developed by: Roland Proud (RP) <rp43@st-andrews.ac.uk>
+|               Pelagic Ecology Research Group, University of St Andrews
+| Contributors:
+|
+| Maintained by:
+| Modification History:
+|
+
+e.g.
+    sslem = OnlineSSLEM(pl = 1.024,sample_int = 0.2,min_sep = 10,
+                        max_thickness = 100,min_size = 50,min_thickness = 5)
+    for ping in echosounder:
+        mask,bottom = sslem.push(ping)  ## finalised pings, may be none
+    mask,bottom = sslem.flush()         ## end of transect
+"""
+
+import numpy as np
+
+from pyechomask.masks import binary_pulse, binary_signal, _seabed_candidates, \
+        _seabed_mask
+from pyechomask.manipulate import MASK_DTYPE, median_1D_windows, windowed_median, \
+        signal_row_filter, signal_column_filter
+
+
+class OnlineSSLEM(object):
+    '''
+    incremental SSLEM signal mask (examples/SSLEM.py up to the row and
+    column filters) for pings arriving one or a few at a time
+
+    :param pl: pulse length (ms)
+    :type  pl: float
+
+    :param sample_int: sample interval (m)
+    :type  sample_int: float
+
+    :param min_sep, max_thickness: binary_signal parameters (m)
+    :type  min_sep, max_thickness: float
+
+    :param min_size: row filter window (pings), threshold row_threshold
+    :type  min_size: int
+
+    :param min_thickness: column filter window (m), threshold
+                          column_threshold
+    :type  min_thickness: float
+
+    :param noise_level: level of background noise (db re 1m^-1)
+    :type  noise_level: float
+
+    :param min_Sv, max_Sv: Sv below min_Sv (before seabed detection) and
+                           above max_Sv (after) are set to noise_level,
+                           None for no threshold
+    :type  min_Sv, max_Sv: float
+
+    :param seabed: detect and mask the seabed (binary_seabed, with
+                   min_depth, seabed_threshold, seabed_buffer (default
+                   min_sep in rows) and seabed_window)
+    :type  seabed: bool
+
+    desc: each ping passes through the stages
+
+            binary_pulse  -> binary_seabed -> binary_signal
+                          -> signal_row_filter -> signal_column_filter
+
+          holding only the pings each stage still needs: the running
+          median of the seabed line waits for seabed_window/2 + 1 pings
+          after a ping and the row filter for min_size - 1 signal pings,
+          the other stages work on one ping at a time. The work and
+          memory per ping are constant, and emitted pings are identical
+          to the batch functions applied to the whole transect. A 
+          transect shorter than min_size is row filtered with a window 
+          of its length.
+
+    defined by RP
+
+    status: test
+    '''
+
+    def __init__(self,pl,sample_int,min_sep,max_thickness,min_size,min_thickness,
+                 noise_level = -999,min_Sv = None,max_Sv = None,max_steps = 10,
+                 row_threshold = 0.5,column_threshold = 1,seabed = True,min_depth = 0,
+                 seabed_threshold = -40,seabed_buffer = None,seabed_window = 10):
+        self.pl               = pl
+        self.sample_int       = sample_int
+        self.min_sep          = min_sep
+        self.max_thickness    = max_thickness
+        self.max_steps        = max_steps
+        self.min_size         = max(1,int(min_size))
+        self.min_thickness    = max(1,int(min_thickness/sample_int)) ## rows
+        self.row_threshold    = row_threshold
+        self.column_threshold = column_threshold
+        self.noise_level      = noise_level
+        self.min_Sv           = min_Sv
+        self.max_Sv           = max_Sv
+        self.seabed           = seabed
+        self.min_depth        = min_depth
+        self.seabed_threshold = seabed_threshold
+        self.seabed_buffer    = (int(min_sep/sample_int) if seabed_buffer is None
+                                 else seabed_buffer)
+        self.seabed_window    = seabed_window
+        self.reset()
+
+    def reset(self):
+        '''
+        start a new transect
+        '''
+        self.rows     = None
+        self.received = 0 ## pings pushed
+        self.emitted  = 0 ## pings returned
+        ## seabed stage: Sv and candidates of pings base...received-1,
+        ## pings before done are history for the running median
+        self._Sv      = None
+        self._cand    = np.zeros(0,dtype = np.int32)
+        self._base    = 0
+        self._done    = 0
+        ## row filter stage: signal and bottom of pings sbase..., pings
+        ## before emitted are history
+        self._signal  = None
+        self._bottom  = np.zeros(0,dtype = np.int32)
+        self._sbase   = 0
+
+    @property
+    def latency(self):
+        '''
+        pings between a ping being pushed and it being emitted
+        '''
+        size = int(max(self.seabed_window + 1 - self.seabed_window%2,3)/2)
+        return (size + 1 if self.seabed else 0) + self.min_size - 1
+
+    def _prepare(self,Sv):
+        ## pulse and weak signal removed
+        Sv = np.array(Sv,dtype = float)
+        Sv[binary_pulse(Sv,self.noise_level) == 0] = self.noise_level
+        if self.min_Sv is not None:
+            Sv[Sv < self.min_Sv] = self.noise_level
+        return Sv
+
+    def _signal_mask(self,Sv,bottom):
+        ## seabed and strong signal removed, signal pixels
+        if self.seabed:
+            Sv[_seabed_mask(Sv.shape[0],bottom,self.seabed_buffer) == 0] = self.noise_level
+        if self.max_Sv is not None:
+            Sv[Sv > self.max_Sv] = self.noise_level
+        return binary_signal(Sv,self.pl,self.sample_int,self.min_sep,self.max_thickness,
+                             self.max_steps)
+
+    def _seabed_stage(self,final):
+        ## Sv and bottom line of pings with a final seabed line
+        total = self._base + len(self._cand)
+        if not self.seabed:
+            stop,self._done = total,total
+            Sv,self._Sv     = self._Sv,self._Sv[:,0:0]
+            self._base      = total
+            self._cand      = self._cand[0:0]
+            return Sv,np.zeros(Sv.shape[1],dtype = np.int32)
+
+        size = int(max(self.seabed_window + 1 - self.seabed_window%2,3)/2)
+        stop = total if final else max(self._done,total - size - 1)
+        n    = total if final else total + size + 1
+        start,end = median_1D_windows(n,self.seabed_window,self._done,stop)
+        bottom    = windowed_median(np.ma.masked_equal(self._cand,0),start - self._base,
+                                    end - self._base).astype(np.int32)
+        Sv        = self._Sv[:,self._done - self._base:stop - self._base]
+        ## keep size pings of history
+        self._done = stop
+        keep       = max(0,stop - size) - self._base
+        self._Sv   = self._Sv[:,keep:]
+        self._cand = self._cand[keep:]
+        self._base += keep
+        return Sv,bottom
+
+    def _row_stage(self,final):
+        ## row and column filtered signal of pings with a final row filter
+        window = self.min_size
+        total  = self._sbase + self._signal.shape[1]
+        stop   = total if final else max(self.emitted,total - window + 1)
+        if stop == self.emitted:
+            return np.zeros((self.rows,0),dtype = MASK_DTYPE),self._bottom[0:0]
+        signal = signal_row_filter(self._signal,min(window,self._signal.shape[1]),
+                                   self.row_threshold)
+        signal = signal[:,self.emitted - self._sbase:stop - self._sbase]
+        signal = signal_column_filter(signal,self.min_thickness,self.column_threshold,
+                                      out = signal)
+        bottom = self._bottom[self.emitted - self._sbase:stop - self._sbase]
+        ## keep window - 1 pings of history
+        self.emitted = stop
+        keep         = max(0,stop - window + 1) - self._sbase
+        self._signal = self._signal[:,keep:]
+        self._bottom = self._bottom[keep:]
+        self._sbase += keep
+        return signal,bottom
+
+    def _run(self,final):
+        Sv,bottom = self._seabed_stage(final)
+        if len(bottom):
+            signal       = self._signal_mask(np.array(Sv),bottom)
+            self._signal = np.hstack((self._signal,signal))
+            self._bottom = np.concatenate((self._bottom,bottom))
+        return self._row_stage(final)
+
+    def push(self,Sv):
+        '''
+        :param Sv: new pings (dB re 1m^-1), one ping (1D) or a block of
+                   pings (depth, ping)
+        :type  Sv: numpy.array
+
+        return:
+        :param mask: signal mask of the pings finalised by this push
+                     (0 - noise; 1 - signal), pings emitted...
+        :type  mask: 2D numpy.array (uint8)
+
+        :param bottom: seabed line of the same pings (0 - none)
+        :type  bottom: 1D numpy.array (int32)
+        '''
+        Sv = np.asanyarray(Sv)
+        if Sv.ndim == 1:
+            Sv = Sv[:,np.newaxis]
+        if self.rows is None:
+            self.rows    = Sv.shape[0]
+            self._Sv     = np.zeros((self.rows,0))
+            self._signal = np.zeros((self.rows,0),dtype = MASK_DTYPE)
+        elif Sv.shape[0] != self.rows:
+            raise ValueError('pings must have %d samples' % self.rows)
+
+        Sv             = self._prepare(Sv)
+        self._Sv       = np.hstack((self._Sv,Sv))
+        if self.seabed:
+            self._cand = np.concatenate((self._cand,_seabed_candidates(
+                            Sv,self.min_depth,self.seabed_threshold,self.noise_level)))
+        else:
+            self._cand = np.zeros(self._Sv.shape[1],dtype = np.int32)
+        self.received += Sv.shape[1]
+        return self._run(False)
+
+    def flush(self):
+        '''
+        finalise and return the remaining pings (mask,bottom), end of transect
+        '''
+        if self.rows is None or self.emitted == self.received:
+            rows = 0 if self.rows is None else self.rows
+            return np.zeros((rows,0),dtype = MASK_DTYPE),np.zeros(0,dtype = np.int32)
+        return self._run(True)
@@ -0,0 +1,370 @@
+# -*- coding: utf-8 -*-
+"""
+.. :module:: pipeline
+    :synopsis: declarative mask pipelines with cached stage results
+
+| Developed by: Roland Proud (RP) <rp43@st-andrews.ac.uk>
+|               Pelagic Ecology Research Group, University of St Andrews
+| Contributors:
+|
+| Maintained by:
+| Modification History:
+|
+
+A pipeline is a list of stages, each a mask or manipulate function applied
+to earlier results ('Sv' is the input echogram) with fixed or derived
+parameters. Every stage result is keyed by a hash of the input echogram,
+the stage function and the parameters of the stage and all stages before
+it, so changing a parameter reruns only the stages that depend on it.
+
+e.g.
+    sslem  = sslem_pipeline(pl = 16.384,sample_int = 0.4)
+    result = sslem.run(Sv,outputs = ['ssl','median'])   ## all stages
+    result = sslem.run(Sv,outputs = ['ssl','median'],   ## row filter onwards
+                       min_size = 50)
+    labels = result['ssl']
+"""
+
+import hashlib
+from collections import OrderedDict
+
+import numpy as np
+
+from pyechomask import instrument
+from pyechomask.masks import binary_pulse, binary_seabed, binary_signal
+from pyechomask.manipulate import MASK_DTYPE, signal_row_filter, signal_column_filter, \
+        flag, vertical_merge, fill_feature_gaps, break_mask, remove_features, \
+        feature_median
+
+
+def clean_Sv(Sv,mask = None,min_Sv = None,max_Sv = None,noise_level = -999,out = None):
+    '''
+    copy of Sv (or out) with noise_level where mask is 0, below min_Sv
+    and above max_Sv (None: not applied)
+    '''
+    Sv  = np.asanyarray(Sv)
+    if out is None:
+        out = np.array(Sv,dtype = float)
+    else:
+        out[...] = Sv
+    if mask is not None:
+        out[np.asarray(mask) == 0] = noise_level
+    if min_Sv is not None:
+        out[out < min_Sv] = noise_level
+    if max_Sv is not None:
+        out[out > max_Sv] = noise_level
+    return out
+
+
+class Stage(object):
+    '''
+    :param name: name of the result (or tuple of names, one per value
+                 returned)
+    :type  name: str or tuple of str
+
+    :param func: mask or manipulate function
+    :type  func: function
+
+    :param inputs: names of earlier results passed as positional arguments
+    :type  inputs: tuple of str
+
+    :param params: keyword arguments. Callable values are derived from
+                   the pipeline parameters: value(params)
+    :type  params: dict
+
+    :param dtype: output dtype when func takes out =, None if it does not
+                  (or the output dtype is not known in advance)
+    :type  dtype: numpy.dtype
+
+    :param inplace: out may be the first input
+    :type  inplace: bool
+    '''
+
+    def __init__(self,name,func,inputs = ('Sv',),params = None,dtype = None,inplace = False):
+        self.name    = name
+        self.names   = name if isinstance(name,tuple) else (name,)
+        self.func    = func
+        self.inputs  = tuple(inputs)
+        self.params  = dict(params or {})
+        self.dtype   = dtype
+        self.inplace = inplace
+
+    def __repr__(self):
+        return 'Stage(%r, %s)' % (self.name,self.func.__name__)
+
+    def kwargs(self,params):
+        return {k:(v(params) if callable(v) else v) for k,v in self.params.items()}
+
+    def key(self,input_keys,kwargs):
+        ## arrays by contents: their repr elides the middle of large arrays
+        text = repr((self.func.__module__,self.func.__name__,self.names,
+                     tuple(input_keys),sorted((k,_param_key(v)) for k,v in kwargs.items())))
+        return hashlib.blake2b(text.encode()).hexdigest()
+
+
+class ResultCache(object):
+    '''
+    LRU store of stage results, keyed by stage key, holding at most
+    max_bytes of arrays. Cached arrays are read-only.
+    '''
+
+    def __init__(self,max_bytes = 2**30):
+        self.max_bytes = max_bytes
+        self.nbytes    = 0
+        self.hits      = 0
+        self.misses    = 0
+        self._results  = OrderedDict()
+
+    def __len__(self):
+        return len(self._results)
+
+    def __contains__(self,key):
+        return key in self._results
+
+    def clear(self):
+        self._results.clear()
+        self.nbytes = 0
+
+    def get(self,key):
+        result = self._results.get(key)
+        if result is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self._results.move_to_end(key)
+        return result
+
+    def put(self,key,result):
+        '''
+        store result (tuple of values), True if stored
+        '''
+        nbytes = sum(getattr(v,'nbytes',0) for v in result)
+        if key in self._results or nbytes > self.max_bytes:
+            return key in self._results
+        for v in result:
+            if isinstance(v,np.ndarray):
+                v.flags.writeable = False
+        self._results[key] = (result,nbytes)
+        self.nbytes       += nbytes
+        ## evict least recently used
+        while self.nbytes > self.max_bytes:
+            _,(_,old)    = self._results.popitem(last = False)
+            self.nbytes -= old
+        return True
+
+
+def _fingerprint(Sv):
+    Sv   = np.ascontiguousarray(np.asanyarray(Sv))
+    text = repr((Sv.shape,Sv.dtype.str)).encode()
+    return hashlib.blake2b(text + hashlib.blake2b(Sv.view(np.uint8)).digest()).hexdigest()
+
+
+def _param_key(value):
+    ## stage parameter for Stage.key: arrays (and their masks) by contents
+    if isinstance(value,np.ndarray):
+        if np.ma.isMaskedArray(value):
+            return ('masked',_fingerprint(np.ma.getdata(value)),
+                    _fingerprint(np.ma.getmaskarray(value)))
+        return ('array',_fingerprint(value))
+    if isinstance(value,(list,tuple)):
+        return (type(value).__name__,tuple(_param_key(v) for v in value))
+    return value
+
+
+class Pipeline(object):
+    '''
+    :param stages: stages, in execution order
+    :type  stages: list of Stage
+
+    :param params: pipeline parameters (read by derived stage parameters)
+    :type  params: dict
+
+    :param cache_bytes: size of the stage result cache (0: no cache)
+    :type  cache_bytes: int
+
+    desc: run(Sv) executes the stages whose key (input echogram, stage
+          and upstream parameters) is not cached. Results that are
+          neither cached, returned nor needed by a later stage go to a
+          buffer pool and are reused as out = of later stages (and of
+          later runs), so without a cache a run holds a few full size
+          arrays rather than one per stage. executed lists the stages
+          run by the last call.
+
+    defined by RP
+
+    status: test
+    '''
+
+    def __init__(self,stages,params = None,cache_bytes = 2**30):
+        self.stages   = list(stages)
+        self.params   = dict(params or {})
+        self.cache    = ResultCache(cache_bytes)
+        self.executed = []
+        self._pool    = []
+        names         = {'Sv'}
+        for stage in self.stages:
+            missing = set(stage.inputs) - names
+            if missing:
+                raise ValueError('stage %r needs %s before it' % (stage.name,sorted(missing)))
+            names.update(stage.names)
+
+    def __repr__(self):
+        return 'Pipeline(%s)' % ' -> '.join(str(s.name) for s in self.stages)
+
+    def set(self,**params):
+        '''
+        update pipeline parameters
+        '''
+        unknown = set(params) - set(self.params)
+        if unknown:
+            raise KeyError('unknown parameters %s' % sorted(unknown))
+        self.params.update(params)
+
+    def _buffer(self,shape,dtype):
+        for i,b in enumerate(self._pool):
+            if b.shape == shape and b.dtype == dtype:
+                return self._pool.pop(i)
+        return np.empty(shape,dtype = dtype)
+
+    def _release(self,value,shape,cached):
+        ## buffers a later stage can write to, at most one per such stage
+        dtypes = [np.dtype(s.dtype) for s in self.stages if s.dtype is not None]
+        if (len(self._pool) < len(dtypes) and isinstance(value,np.ndarray)
+                and value.base is None and value.flags.writeable
+                and value.shape == shape and value.dtype in dtypes
+                and not any(value is c for c in cached)):
+            self._pool.append(value)
+
+    def run(self,Sv,outputs = None,**params):
+        '''
+        :param Sv: gridded Sv values (dB re 1m^-1)
+        :type  Sv: numpy.array
+
+        :param outputs: names of results to return (default: the last stage)
+        :type  outputs: list of str
+
+        :param params: pipeline parameters to update before the run
+
+        return:
+        :param result: results by name
+        :type  result: dict
+        '''
+        self.set(**params)
+        outputs  = list(self.stages[-1].names if outputs is None else outputs)
+        Sv       = np.asanyarray(Sv)
+        values   = {'Sv':Sv}
+        keys     = {'Sv':_fingerprint(Sv)}
+        cached   = []
+        ## last stage reading each result
+        last_use = {}
+        for i,stage in enumerate(self.stages):
+            for name in stage.inputs:
+                last_use[name] = i
+        self.executed = []
+
+        for i,stage in enumerate(self.stages):
+            kwargs = stage.kwargs(self.params)
+            key    = stage.key([keys[n] for n in stage.inputs],kwargs)
+            hit    = self.cache.get(key)
+            args   = [values[n] for n in stage.inputs]
+            free   = [n for n in stage.inputs if last_use[n] == i and n not in outputs
+                      and n != 'Sv']
+            if hit is not None:
+                result = hit[0]
+            else:
+                self.executed.append(stage.name)
+                if stage.dtype is not None:
+                    first = stage.inputs[0]
+                    if (stage.inplace and first in free and args[0].flags.writeable
+                            and args[0].dtype == stage.dtype
+                            and not any(args[0] is c for c in cached)):
+                        out = args[0]
+                        free.remove(first)
+                    else:
+                        out = self._buffer(Sv.shape,np.dtype(stage.dtype))
+                    kwargs['out'] = out
+                with instrument.span('pipeline.' + ','.join(stage.names)):
+                    result = stage.func(*args,**kwargs)
+                if len(stage.names) == 1:
+                    result = (result,)
+                if self.cache.put(key,result):
+                    cached.extend(result)
+            for name,value in zip(stage.names,result):
+                values[name] = value
+                keys[name]   = key + ':' + name
+            ## results not read again go to the pool
+            for name in free:
+                self._release(values.pop(name),Sv.shape,cached)
+
+        return {name:values[name] for name in outputs}
+
+
+def sslem_pipeline(pl,sample_int,min_sep = 20,max_thickness = 300,min_size = 100,
+                   min_thickness = 50,noise_level = -999,min_Sv = -90,max_Sv = -50,
+                   seabed_window = 10,max_steps = 10,cache_bytes = 2**30):
+    '''
+    :param pl: pulse length (ms)
+    :type  pl: float
+
+    :param sample_int: sample interval (m)
+    :type  sample_int: float
+
+    :param min_sep, max_thickness, min_size, min_thickness: SSLEM
+                   optimisation parameters (examples/SSLEM.py)
+    :type  min_sep, max_thickness, min_size, min_thickness: float
+
+    return:
+    :param pipeline: SSLEM pipeline, results pulse, Sv_pulse, seabed,
+                     bottom, Sv_clean, signal, rows, columns, flags,
+                     merged, filled, labels, ssl (SSL labels) and median
+                     (SSL median Sv), the last stage
+    :type  pipeline: Pipeline
+
+    desc: the steps of examples/SSLEM.py (the transmit pulse is detected
+          with binary_pulse) as a Pipeline. All parameters can be changed
+          in run(Sv,...).
+
+    defined by RP
+
+    status: test
+    '''
+    params = dict(pl = pl,sample_int = sample_int,min_sep = min_sep,
+                  max_thickness = max_thickness,min_size = min_size,
+                  min_thickness = min_thickness,noise_level = noise_level,
+                  min_Sv = min_Sv,max_Sv = max_Sv,seabed_window = seabed_window,
+                  max_steps = max_steps)
+
+    ## parameters in rows / pixels
+    sep_rows  = lambda p: int(p['min_sep']/p['sample_int'])
+    min_agg   = lambda p: p['min_size']*int(p['min_thickness']/p['sample_int'])
+    get       = lambda name: (lambda p: p[name])
+
+    stages = [
+        Stage('pulse',binary_pulse,('Sv',),{'noise_level':get('noise_level')},
+              dtype = MASK_DTYPE),
+        Stage('Sv_pulse',clean_Sv,('Sv','pulse'),{'min_Sv':get('min_Sv'),
+              'noise_level':get('noise_level')},dtype = float),
+        Stage(('seabed','bottom'),binary_seabed,('Sv_pulse',),
+              {'buffer':sep_rows,'window_size':get('seabed_window'),
+               'noise_level':get('noise_level')}),
+        Stage('Sv_clean',clean_Sv,('Sv_pulse','seabed'),{'max_Sv':get('max_Sv'),
+              'noise_level':get('noise_level')},dtype = float,inplace = True),
+        Stage('signal',binary_signal,('Sv_clean',),
+              {'pl':get('pl'),'sample_int':get('sample_int'),'min_sep':get('min_sep'),
+               'max_thickness':get('max_thickness'),'max_steps':get('max_steps')},
+              dtype = MASK_DTYPE),
+        Stage('rows',signal_row_filter,('signal',),{'window':get('min_size'),
+              'threshold':0.5},dtype = MASK_DTYPE,inplace = True),
+        Stage('columns',signal_column_filter,('rows',),
+              {'window':lambda p: int(p['min_thickness']/p['sample_int']),'threshold':1},
+              dtype = MASK_DTYPE,inplace = True),
+        Stage('flags',flag,('columns',),{'min_agg_size':min_agg}),
+        Stage('merged',vertical_merge,('flags',),{'min_sep':sep_rows},dtype = MASK_DTYPE),
+        Stage('filled',fill_feature_gaps,('merged',),{'max_gap_size':min_agg},
+              dtype = MASK_DTYPE,inplace = True),
+        Stage('labels',break_mask,('filled',)),
+        Stage('ssl',remove_features,('labels',),{'min_agg_size':min_agg}),
+        Stage('median',feature_median,('Sv_clean','ssl'),
+              {'noise_level':get('noise_level')},dtype = float),
+    ]
+    return Pipeline(stages,params,cache_bytes)
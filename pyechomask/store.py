@@ -0,0 +1,304 @@
+# -*- coding: utf-8 -*-
+"""
+.. :module:: store
+    :synopsis: chunked on-disk echogram store and lazy loader
+
+| Developed by: Roland Proud (RP) <rp43@st-andrews.ac.uk>
+|               Pelagic Ecology Research Group, University of St Andrews
+| Contributors:
+|
+| Maintained by:
+| Modification History:
+|
+
+An echogram store is a directory holding
+
+    header.json          - shape, dtype, chunking and observation metadata
+                           (sample_int, noise_level, frequency)
+    chunk_00000.raw ...  - raw little-endian Sv values of chunk_pings pings,
+                           (rows, pings) C order, optionally zlib compressed
+    ping_times.raw       - (optional) raw little-endian ping times
+
+Uncompressed chunks are read through np.memmap, so only the pings that are
+sliced are read from disk.
+
+e.g.
+    convert_pickle('./data/PS_Sv18.pklz','./data/PS_Sv18',sample_int = 0.2)
+    Sv = open_echogram('./data/PS_Sv18')
+    Sv[:,1000:2000] ## reads pings 1000...1999 only
+"""
+
+import gzip
+import json
+import os
+import pickle
+import zlib
+
+import numpy as np
+
+from pyechomask.manipulate import _ping_tiles
+
+HEADER      = 'header.json'
+PING_TIMES  = 'ping_times.raw'
+FORMAT      = 'pyechomask-echogram'
+VERSION     = 1
+
+
+def _chunk_file(index):
+    return 'chunk_%05d.raw' % index
+
+
+class Echogram(object):
+    '''
+    lazy view of an echogram store (see open_echogram). Behaves as a 2D
+    (depth, ping) array for slicing and np.asarray; data are read from
+    disk only for the pings requested.
+
+    Attributes: shape, dtype, sample_int, noise_level, frequency,
+                ping_times (1D numpy.array or None), chunk_pings, meta
+    '''
+
+    ndim = 2
+
+    def __init__(self,path):
+        self.path = path
+        with open(os.path.join(path,HEADER)) as f:
+            meta = json.load(f)
+        if meta.get('format') != FORMAT:
+            raise ValueError('%s is not a pyechomask echogram store' % path)
+        self.meta        = meta
+        self.shape       = tuple(meta['shape'])
+        self.dtype       = np.dtype(meta['dtype'])
+        self.chunk_pings = int(meta['chunk_pings'])
+        self.compression = meta.get('compression')
+        self.sample_int  = meta.get('sample_int')
+        self.noise_level = meta.get('noise_level')
+        self.frequency   = meta.get('frequency')
+        self.ping_times  = None
+        if meta.get('ping_times_dtype'):
+            self.ping_times = np.memmap(os.path.join(path,PING_TIMES),mode = 'r',
+                                        dtype = np.dtype(meta['ping_times_dtype']),
+                                        shape = (self.shape[1],))
+        self._last = (None,None) ## last decompressed chunk
+
+    def __repr__(self):
+        return 'Echogram(%r, shape = %s, dtype = %s)' % (self.path,self.shape,self.dtype)
+
+    def __len__(self):
+        return self.shape[0]
+
+    @property
+    def size(self):
+        return self.shape[0]*self.shape[1]
+
+    @property
+    def nbytes(self):
+        return self.size*self.dtype.itemsize
+
+    @property
+    def T(self):
+        return np.asarray(self).T
+
+    def chunk(self,index):
+        '''
+        pings of chunk index as a (rows, pings) array (memmap if uncompressed)
+        '''
+        p0     = index*self.chunk_pings
+        pings  = min(self.chunk_pings,self.shape[1] - p0)
+        if pings <= 0:
+            raise IndexError('chunk %d out of range' % index)
+        shape  = (self.shape[0],pings)
+        path   = os.path.join(self.path,_chunk_file(index))
+        if self.compression is None:
+            return np.memmap(path,mode = 'r',dtype = self.dtype,shape = shape)
+        if self._last[0] != index:
+            with open(path,'rb') as f:
+                raw = zlib.decompress(f.read())
+            self._last = (index,np.frombuffer(raw,dtype = self.dtype).reshape(shape))
+        return self._last[1]
+
+    def pings(self,start,stop):
+        '''
+        Sv of pings start...stop-1 (numpy.array), reading only the chunks
+        holding them
+        '''
+        start  = max(0,start)
+        stop   = min(self.shape[1],stop)
+        out    = np.empty((self.shape[0],max(0,stop - start)),dtype = self.dtype.newbyteorder('='))
+        for index in range(start//self.chunk_pings,-(-stop//self.chunk_pings)):
+            c0 = index*self.chunk_pings
+            a  = max(start,c0)
+            b  = min(stop,c0 + self.chunk_pings)
+            out[:,a - start:b - start] = self.chunk(index)[:,a - c0:b - c0]
+        return out
+
+    def __getitem__(self,key):
+        if not isinstance(key,tuple):
+            key = (key,)
+        if len(key) > 2:
+            raise IndexError('too many indices for echogram')
+        rows = key[0]
+        cols = key[1] if len(key) == 2 else slice(None)
+        if isinstance(cols,slice):
+            start,stop,step = cols.indices(self.shape[1])
+            if step > 0:
+                return self.pings(start,stop)[rows,::step]
+            cols = np.arange(start,stop,step)
+        ## integer or array ping index: read the covering range
+        idx  = np.arange(self.shape[1])[cols]
+        if idx.size == 0:
+            return self.pings(0,0)[rows][:,idx]
+        p0   = int(idx.min())
+        data = self.pings(p0,int(idx.max()) + 1)
+        return np.take(data[rows],idx - p0,axis = -1)
+
+    def __array__(self,dtype = None,copy = None):
+        data = self.pings(0,self.shape[1])
+        return data if dtype is None else data.astype(dtype,copy = False)
+
+    def __iter__(self):
+        ## rows, as for a numpy array
+        return iter(np.asarray(self))
+
+    def blocks(self,tile_pings = None):
+        '''
+        generator of ping blocks (default: one per chunk)
+        '''
+        for p0 in range(0,self.shape[1],self.chunk_pings):
+            block = self.pings(p0,p0 + self.chunk_pings)
+            yield from _ping_tiles(block,tile_pings)
+
+
+def write_echogram(path,Sv,sample_int = None,noise_level = -999,frequency = None,
+                   ping_times = None,chunk_pings = 1000,compression = None,**meta):
+    '''
+    :param path: directory of the store (created)
+    :type  path: str
+
+    :param Sv: gridded Sv values (dB re 1m^-1), or iterable of ping blocks
+    :type  Sv: numpy.array or iterable of numpy.array
+
+    :param sample_int, noise_level, frequency: observation metadata
+    :type  sample_int, noise_level, frequency: float
+
+    :param ping_times: time of each ping
+    :type  ping_times: 1D numpy.array
+
+    :param chunk_pings: pings per chunk file
+    :type  chunk_pings: int
+
+    :param compression: None or 'zlib' (compressed chunks are read whole)
+    :type  compression: str
+
+    return:
+    :param echogram: the store, opened
+    :type  echogram: Echogram
+
+    desc: write Sv to an echogram store a chunk at a time, blocks of Sv
+          are not held in memory beyond one chunk. Extra keyword
+          arguments are stored in the header.
+
+    defined by RP
+
+    status: test
+    '''
+    if compression not in (None,'zlib'):
+        raise ValueError("compression must be None or 'zlib'")
+    chunk_pings = max(1,int(chunk_pings))
+    os.makedirs(path,exist_ok = True)
+
+    rows,dtype = None,None
+    pings,index,pending = 0,0,[]
+
+    def write(chunk):
+        data = np.ascontiguousarray(chunk,dtype = dtype)
+        raw  = data.tobytes()
+        if compression == 'zlib':
+            raw = zlib.compress(raw)
+        with open(os.path.join(path,_chunk_file(index)),'wb') as f:
+            f.write(raw)
+
+    for block in _ping_tiles(Sv,chunk_pings):
+        block = np.ma.filled(np.asanyarray(block),noise_level)
+        if rows is None:
+            rows  = block.shape[0]
+            dtype = block.dtype.newbyteorder('<') if block.dtype.kind == 'f' else np.dtype('<f8')
+        elif block.shape[0] != rows:
+            raise ValueError('ping blocks must have %d rows' % rows)
+        pending.append(block)
+        pings += block.shape[1]
+        ## write full chunks
+        while sum(b.shape[1] for b in pending) >= chunk_pings:
+            data    = np.hstack(pending)
+            write(data[:,:chunk_pings])
+            pending = [data[:,chunk_pings:]]
+            index  += 1
+    if pending and sum(b.shape[1] for b in pending):
+        write(np.hstack(pending))
+    if rows is None:
+        raise ValueError('Sv has no pings')
+
+    header = {'format':FORMAT,'version':VERSION,'shape':[rows,pings],
+              'dtype':dtype.str,'chunk_pings':chunk_pings,'compression':compression,
+              'sample_int':sample_int,'noise_level':noise_level,'frequency':frequency,
+              'ping_times_dtype':None}
+    if ping_times is not None:
+        ping_times = np.asarray(ping_times)
+        if ping_times.shape != (pings,):
+            raise ValueError('ping_times must have one value per ping (%d)' % pings)
+        ping_times = ping_times.astype(ping_times.dtype.newbyteorder('<'))
+        ping_times.tofile(os.path.join(path,PING_TIMES))
+        header['ping_times_dtype'] = ping_times.dtype.str
+    header.update(meta)
+    with open(os.path.join(path,HEADER),'w') as f:
+        json.dump(header,f,indent = 1)
+
+    return Echogram(path)
+
+
+def open_echogram(path):
+    '''
+    open an echogram store (lazy, see Echogram)
+    '''
+    return Echogram(path)
+
+
+def load_pickle(filepath):
+    '''
+    Sv from a (gzip) pickle file, as the examples load them
+    '''
+    with open(filepath,'rb') as f:
+        gzipped = f.read(2) == b'\x1f\x8b'
+    with (gzip.open if gzipped else open)(filepath,'rb') as f:
+        return pickle.load(f,encoding = 'bytes')
+
+
+def convert_pickle(filepath,path,transpose = False,**kwargs):
+    '''
+    :param filepath: (gzip) pickle of a gridded Sv array, e.g.
+                     './data/PS_Sv18.pklz'
+    :type  filepath: str
+
+    :param path: directory of the store
+    :type  path: str
+
+    :param transpose: pickle holds (ping, depth) values
+                      (e.g. './data/krill-Sv38.pkl')
+    :type  transpose: bool
+
+    return:
+    :param echogram: the store, opened
+    :type  echogram: Echogram
+
+    desc: convert an example pickle to an echogram store, keyword
+          arguments as write_echogram (sample_int, noise_level,...)
+
+    defined by RP
+
+    status: test
+    '''
+    Sv = load_pickle(filepath)
+    if transpose:
+        Sv = Sv.T
+    kwargs.setdefault('source',os.path.basename(filepath))
+    return write_echogram(path,Sv,**kwargs)
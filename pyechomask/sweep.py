@@ -0,0 +1,242 @@
+# -*- coding: utf-8 -*-
+"""
+.. :module:: sweep
+    :synopsis: SSLEM optimisation parameter sweeps with shared work
+
+| Developed by: Roland Proud (RP) <rp43@st-andrews.ac.uk>
+|               Pelagic Ecology Research Group, University of St Andrews
+| Contributors:
+|
+| Maintained by:
+| Modification History:
+|
+
+e.g.
+    table = sslem_sweep(Sv,pl = 16.384,sample_int = 0.4,min_sep = [10,20,30],
+                        max_thickness = [200,300],min_size = [50,100,200],
+                        min_thickness = [20,50],n_jobs = 4)
+    best  = table[np.argmax(table['n_ssl'])]
+"""
+
+import hashlib
+import itertools
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+
+import numpy as np
+from scipy import ndimage
+
+from pyechomask.masks import binary_pulse, binary_seabed, binary_signal, MedianPlaneCache
+from pyechomask.manipulate import _box_sums, _box_filter, remove_features, \
+        vertical_merge, fill_feature_gaps, break_mask, feature_table
+from pyechomask.pipeline import clean_Sv
+
+PARAMS  = ('min_sep','max_thickness','min_size','min_thickness')
+METRICS = [('n_ssl',np.int64),     ## number of SSLs
+           ('coverage',float),     ## fraction of pixels in an SSL
+           ('thickness',float),    ## mean SSL thickness (m): pixels/pings
+           ('duration',float),     ## mean SSL duration (pings)
+           ('depth',float),        ## mean SSL centroid depth (m)
+           ('median_Sv',float),    ## median of the SSL median Sv (dB)
+           ('time',float)]         ## wall time of the trial (s), signal mask excluded
+
+
+def _values(x):
+    return list(np.atleast_1d(x))
+
+
+def _digest(mask):
+    mask = np.ascontiguousarray(mask)
+    return hashlib.blake2b(mask.view(np.uint8)).hexdigest() + str(mask.shape)
+
+
+class _Memo(object):
+    '''
+    results of f(mask) keyed by the mask contents, for masks repeated
+    between grid points. LRU holding at most max_bytes of (read-only)
+    results; a mask being computed by one thread is waited for, not
+    computed again, by the others.
+    '''
+
+    def __init__(self,f,max_bytes = 2**28):
+        self.f          = f
+        self.max_bytes  = max_bytes
+        self.nbytes     = 0
+        self.hits       = 0
+        self._store     = OrderedDict()
+        self._pending   = {}
+        self._lock      = threading.Lock()
+
+    def __call__(self,mask):
+        key = _digest(mask)
+        with self._lock:
+            if key in self._store:
+                self.hits += 1
+                self._store.move_to_end(key)
+                return self._store[key][0]
+            future = self._pending.get(key)
+            owner  = future is None
+            if owner:
+                future = self._pending[key] = Future()
+            else:
+                self.hits += 1
+        if not owner:
+            return future.result()
+
+        try:
+            result = self.f(mask)
+        except BaseException as error:
+            with self._lock:
+                del self._pending[key]
+            future.set_exception(error)
+            raise
+        result.flags.writeable = False
+        with self._lock:
+            del self._pending[key]
+            if result.nbytes <= self.max_bytes:
+                self._store[key] = (result,result.nbytes)
+                self.nbytes     += result.nbytes
+                ## evict least recently used
+                while self.nbytes > self.max_bytes:
+                    _,(_,old)    = self._store.popitem(last = False)
+                    self.nbytes -= old
+        future.set_result(result)
+        return result
+
+
+def ssl_metrics(table,shape,sample_int,noise_level = -999):
+    '''
+    sweep metrics (METRICS, without time) of the SSLs in feature_table
+    table of an echogram of shape (rows,pings)
+    '''
+    metrics = dict(n_ssl = len(table),coverage = table['count'].sum()/float(np.prod(shape)),
+                   thickness = np.nan,duration = np.nan,depth = np.nan,median_Sv = noise_level)
+    if len(table):
+        pings = table['ping_max'] - table['ping_min'] + 1.
+        metrics.update(thickness = np.mean(table['count']/pings)*sample_int,
+                       duration  = np.mean(pings),
+                       depth     = np.mean(table['centroid_row'])*sample_int)
+        valid = table['n_valid'] > 0
+        if valid.any():
+            metrics['median_Sv'] = np.median(table['median_Sv'][valid])
+    return metrics
+
+
+def sslem_sweep(Sv,pl,sample_int,min_sep,max_thickness,min_size,min_thickness,
+                noise_level = -999,min_Sv = -90,max_Sv = -50,seabed_window = 10,
+                max_steps = 10,n_jobs = 1,cache_bytes = 2**30,memo_bytes = 2**28):
+    '''
+    :param Sv: gridded Sv values (dB re 1m^-1)
+    :type  Sv: numpy.array
+
+    :param pl: pulse length (ms)
+    :type  pl: float
+
+    :param sample_int: sample interval (m)
+    :type  sample_int: float
+
+    :param min_sep, max_thickness, min_size, min_thickness: SSLEM
+                   optimisation parameters, values or sequences of values
+                   (the grid is every combination)
+    :type  min_sep, max_thickness, min_size, min_thickness: float or list
+
+    :param n_jobs: number of threads (None: one per core)
+    :type  n_jobs: int
+
+    :param cache_bytes: median plane cache per min_sep
+    :type  cache_bytes: int
+
+    :param memo_bytes: cache of the feature labellings (each of the two)
+    :type  memo_bytes: int
+
+    return:
+    :param table: one record per combination (itertools.product order of
+                  the grid) with the parameters and METRICS
+    :type  table: numpy structured array
+
+    desc: the SSLEM recipe (pipeline.sslem_pipeline) for every grid
+          point, sharing work between points:
+            - pulse removal once, the seabed once per min_sep
+            - binary_signal median planes (MedianPlaneCache) between
+              max_thickness values with the same min_sep
+            - row filter cumulative sums between min_size values and
+              column filter sums between min_thickness values
+            - feature labellings of identical masks
+          Signal masks (one per min_sep, max_thickness) and then trials
+          (one per min_sep, max_thickness, min_size) run on n_jobs
+          threads.
+
+    defined by RP
+
+    status: test
+    '''
+    grid    = [_values(v) for v in (min_sep,max_thickness,min_size,min_thickness)]
+    workers = ThreadPoolExecutor(max_workers = n_jobs)
+    label   = _Memo(lambda m: ndimage.label(m != 0,np.ones((3,3),dtype = int))[0],memo_bytes)
+    breaks  = _Memo(break_mask,memo_bytes)
+
+    ## pulse and weak signal removed once
+    Sv      = np.asanyarray(Sv)
+    Sv      = clean_Sv(Sv,binary_pulse(Sv,noise_level),min_Sv = min_Sv,
+                       noise_level = noise_level)
+
+    def signals(sep):
+        ## seabed and strong signal removed, signal masks of every max_thickness
+        seabed,_ = binary_seabed(Sv,buffer = int(sep/sample_int),window_size = seabed_window,
+                                 noise_level = noise_level)
+        clean    = clean_Sv(Sv,seabed,max_Sv = max_Sv,noise_level = noise_level)
+        cache    = MedianPlaneCache(cache_bytes)
+        out      = {}
+        for thickness in sorted(grid[1],reverse = True): ## largest first, fills the cache
+            signal         = binary_signal(clean,pl,sample_int,sep,thickness,max_steps,
+                                           cache = cache)
+            out[thickness] = (signal,_box_sums(signal,1))
+        return clean,out
+
+    def trial(sep,thickness,size):
+        ## row filter, then every min_thickness
+        t0          = time.time()
+        clean       = cleaned[sep]
+        signal,csum = signal_masks[sep][thickness]
+        size        = int(size)
+        rows        = _box_filter(signal,size,0.5,1,False,None,csum = csum)
+        ccum        = _box_sums(rows,0)
+        sep_rows    = int(sep/sample_int)
+        shared      = time.time() - t0
+        records     = []
+        for thick in grid[3]:
+            t1       = time.time()
+            t_rows   = int(thick/sample_int)
+            min_agg  = size*t_rows
+            columns  = _box_filter(rows,t_rows,1,0,True,None,csum = ccum)
+            flags    = remove_features(label(columns),min_agg)
+            merged   = vertical_merge(flags,sep_rows)
+            filled   = fill_feature_gaps(merged,min_agg)
+            ssl      = remove_features(breaks(filled),min_agg)
+            metrics  = ssl_metrics(feature_table(clean,ssl,noise_level),ssl.shape,
+                                   sample_int,noise_level)
+            metrics['time'] = time.time() - t1 + shared/len(grid[3])
+            records.append(((sep,thickness,size,thick),metrics))
+        return records
+
+    try:
+        cleaned,signal_masks = {},{}
+        for sep,(clean,out) in zip(grid[0],workers.map(signals,grid[0])):
+            cleaned[sep],signal_masks[sep] = clean,out
+        results = {}
+        for records in workers.map(lambda p: trial(*p),itertools.product(*grid[:3])):
+            for point,metrics in records:
+                results[point] = metrics
+    finally:
+        workers.shutdown()
+
+    points = list(itertools.product(*grid))
+    table  = np.zeros(len(points),dtype = [(p,float) for p in PARAMS] + METRICS)
+    for i,point in enumerate(points):
+        for name,value in zip(PARAMS,point):
+            table[name][i] = value
+        for name,value in results[tuple(point)].items():
+            table[name][i] = value
+    return table
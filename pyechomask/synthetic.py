@@ -0,0 +1,272 @@
+# -*- coding: utf-8 -*-
+"""
+.. :module:: synthetic
+    :synopsis: synthetic echograms with ground-truth masks
+
+| Developed by: Roland Proud (RP) <rp43@st-andrews.ac.uk>
+|               Pelagic Ecology Research Group, University of St Andrews
+| Contributors:
+|
+| Maintained by:
+| Modification History:
+|
+
+A synthetic echogram holds, per ping,
+
+    pulse      - strong returns from the surface down to pulse_depth, then
+                 one sample at noise_level (as binary_pulse expects)
+    background - normally distributed Sv (background, background_sd)
+    layers     - scattering layers of given depth, thickness and Sv that
+                 drift with ping (added to the background in the linear
+                 domain)
+    impulse    - pings (impulse_rate) with impulse_Sv dB added to the
+                 water column
+    noise      - water column samples (noise_rate) set to noise_level
+    seabed     - strongest sample of the ping at the bottom line, weaker
+                 below
+
+Every component has a ground-truth mask (TRUTH) in the convention of the
+mask it tests (1 - signal; 0 - noise). Random values are drawn per group
+of GROUP_PINGS pings from a generator seeded by (seed, group), so the
+echogram depends on the seed only, not on the block size it is made in.
+
+e.g.
+    Sv,truth = synthetic_echogram(10000,rows = 400,seed = 1)
+    mask     = binary_seabed(Sv,buffer = 0)[0]
+    np.mean(mask == truth['seabed'])
+
+    ## 10^6 pings to an echogram store, a block at a time
+    write_echogram('./synthetic',(Sv for Sv,_ in synthetic_blocks(10**6,truth = False)),
+                   sample_int = 0.5)
+"""
+
+import numpy as np
+
+from pyechomask.manipulate import MASK_DTYPE, label_dtype
+
+GROUP_PINGS = 256
+TRUTH       = ('signal',   ## 1 - layer
+               'layers',   ## flag mask, layer number (1...)
+               'pulse',    ## 0 - pulse and surface noise (binary_pulse)
+               'seabed',   ## 0 - bottom line and below (binary_seabed, buffer = 0)
+               'bottom',   ## bottom line row of each ping, 0 where none
+               'impulse',  ## 0 - impulse noise (binary_impulse)
+               'noise')    ## 0 - samples at noise_level
+
+
+def random_layers(n,depth,seed = 0):
+    '''
+    n layers (depth, thickness, Sv, amplitude, period) between depth[0]
+    and depth[1] (m), evenly spread
+    '''
+    rng   = np.random.default_rng(seed)
+    top,bottom = depth
+    step  = (bottom - top)/float(max(n,1))
+    return [(top + step*(i + 0.5),
+             rng.uniform(0.1,0.3)*step,         ## thickness (m)
+             rng.uniform(-75,-60),              ## Sv (dB re 1m^-1)
+             rng.uniform(0.05,0.15)*step,       ## amplitude of depth drift (m)
+             rng.uniform(200,2000))             ## period of depth drift (pings)
+            for i in range(n)]
+
+
+def _group(g,rows,sample_int,seed,layers,pulse_rows,seabed,noise_level,background,
+           background_sd,impulse_rate,impulse_Sv,noise_rate,truth):
+    ## pings g*GROUP_PINGS...(g+1)*GROUP_PINGS-1
+    rng    = np.random.default_rng([seed,g])
+    p      = np.arange(g*GROUP_PINGS,(g + 1)*GROUP_PINGS)
+    r      = np.arange(rows)[:,np.newaxis]
+    shape  = (rows,GROUP_PINGS)
+
+    ## background and layers (linear domain)
+    linear = 10**(rng.normal(background,background_sd,shape)/10.)
+    flags  = np.zeros(shape,dtype = label_dtype(len(layers))) if truth else None
+    for i,(depth,thickness,Sv,amplitude,period) in enumerate(layers):
+        top    = (depth + amplitude*np.sin(2*np.pi*p/period + i))/sample_int
+        inside = (r >= np.round(top)) & (r < np.round(top + thickness/sample_int))
+        linear[inside] += 10**(Sv/10.)
+        if truth:
+            flags[inside] = i + 1
+    Sv     = 10*np.log10(linear)
+
+    ## seabed
+    if seabed is None:
+        bottom = np.full(GROUP_PINGS,rows,dtype = np.int32)
+    else:
+        depth,amplitude,period,seabed_Sv,decay = seabed
+        bottom = np.round((depth + amplitude*np.sin(2*np.pi*p/period))/sample_int)
+        bottom = np.clip(bottom,pulse_rows + 2,rows).astype(np.int32)
+    water  = (r > pulse_rows) & (r < bottom)
+
+    ## impulse noise
+    spikes = water & (rng.random(GROUP_PINGS) < impulse_rate)
+    Sv[spikes] += impulse_Sv
+
+    ## seabed, pulse and samples lost to noise
+    below = r >= bottom
+    if seabed is not None:
+        Sv[below] = (seabed_Sv - decay*(r - bottom))[below]
+    Sv[:pulse_rows] = -30 - 2*r[:pulse_rows] + rng.normal(0,1,(pulse_rows,GROUP_PINGS))
+    Sv[pulse_rows]  = noise_level
+    lost      = water & (rng.random(shape) < noise_rate)
+    Sv[lost]  = noise_level
+
+    if not truth:
+        return Sv,None
+    flags[~water]          = 0 ## layers under the pulse or seabed
+    bottom[bottom >= rows] = 0
+    return Sv,{'signal' :(flags > 0).astype(MASK_DTYPE),
+               'layers' :flags,
+               'pulse'  :np.broadcast_to(r >= pulse_rows,shape).astype(MASK_DTYPE),
+               'seabed' :(~below).astype(MASK_DTYPE),
+               'bottom' :bottom,
+               'impulse':(~spikes).astype(MASK_DTYPE),
+               'noise'  :(Sv > noise_level).astype(MASK_DTYPE)}
+
+
+def synthetic_blocks(pings,rows = 200,sample_int = 0.5,block_pings = 1000,seed = 0,
+                     layers = 3,pulse_depth = 3,seabed_depth = None,seabed_amplitude = None,
+                     seabed_period = 700,seabed_Sv = -20,seabed_decay = 0.5,
+                     noise_level = -999,background = -90,background_sd = 3,
+                     impulse_rate = 0.01,impulse_Sv = 25,noise_rate = 0.01,truth = True):
+    '''
+    :param pings: number of pings
+    :type  pings: int
+
+    :param rows: samples per ping
+    :type  rows: int
+
+    :param sample_int: sample interval (m)
+    :type  sample_int: float
+
+    :param block_pings: pings per yielded block (the last may be shorter)
+    :type  block_pings: int
+
+    :param seed: random seed, the echogram depends on it only
+    :type  seed: int
+
+    :param layers: number of random layers (random_layers, between the
+                   pulse and the shallowest seabed), or a list of
+                   (depth (m), thickness (m), Sv (dB re 1m^-1),
+                   amplitude (m), period (pings)): depth of the top of
+                   layer i is depth + amplitude*sin(2*pi*ping/period + i)
+    :type  layers: int or list
+
+    :param pulse_depth: depth of the transmit pulse (m)
+    :type  pulse_depth: float
+
+    :param seabed_depth, seabed_amplitude, seabed_period: bottom line
+                   depth (m) + amplitude (m)*sin(2*pi*ping/period),
+                   default depth 85% of the echogram and amplitude
+                   5%. Pings with a bottom line below the last row have
+                   no seabed; seabed_depth = -1 for no seabed at all
+    :type  seabed_depth, seabed_amplitude, seabed_period: float
+
+    :param seabed_Sv, seabed_decay: Sv at the bottom line (dB re 1m^-1)
+                   and decrease per row below it (dB)
+    :type  seabed_Sv, seabed_decay: float
+
+    :param noise_level: level of background noise (db re 1m^-1)
+    :type  noise_level: float
+
+    :param background, background_sd: mean and standard deviation of
+                   background Sv (dB re 1m^-1)
+    :type  background, background_sd: float
+
+    :param impulse_rate, impulse_Sv: fraction of pings with impulse
+                   noise and the dB added to their water column
+    :type  impulse_rate, impulse_Sv: float
+
+    :param noise_rate: fraction of water column samples set to noise_level
+    :type  noise_rate: float
+
+    :param truth: also yield ground-truth masks
+    :type  truth: bool
+
+    return:
+    :param blocks: generator of (Sv, truth) blocks of pings, truth a
+                   dict of TRUTH masks of the block (None if not truth)
+    :type  blocks: generator of (2D numpy.array, dict)
+
+    desc: synthetic echogram a block of pings at a time (memory of one
+          block and one GROUP_PINGS group), see the module description.
+          Impulse pings next to each other are not distinguishable
+          from signal by binary_impulse(method = 'ping').
+
+    defined by RP
+
+    status: test
+    '''
+    depth      = rows*sample_int
+    pulse_rows = int(round(pulse_depth/sample_int))
+    if not 0 <= pulse_rows < rows - 1:
+        raise ValueError('pulse_depth must be within the echogram')
+    if seabed_depth is None:
+        seabed_depth = 0.85*depth
+    if seabed_amplitude is None:
+        seabed_amplitude = 0.05*depth
+    seabed = None if seabed_depth < 0 else \
+             (seabed_depth,seabed_amplitude,seabed_period,seabed_Sv,seabed_decay)
+    if np.isscalar(layers):
+        shallowest = depth if seabed is None else min(depth,seabed_depth - seabed_amplitude)
+        layers     = random_layers(int(layers),(pulse_depth,shallowest),seed)
+    layers     = [tuple(layer) for layer in layers]
+    args       = (rows,sample_int,seed,layers,pulse_rows,seabed,noise_level,background,
+                  background_sd,impulse_rate,impulse_Sv,noise_rate,truth)
+
+    block_pings = max(1,int(block_pings))
+    cached      = (None,None,None) ## last group: g, Sv, truth
+    for p0 in range(0,pings,block_pings):
+        p1    = min(pings,p0 + block_pings)
+        Sv    = np.empty((rows,p1 - p0))
+        parts = {} if truth else None
+        for g in range(p0//GROUP_PINGS,-(-p1//GROUP_PINGS)):
+            if cached[0] != g:
+                cached = (g,) + _group(g,*args)
+            g0 = g*GROUP_PINGS
+            a  = max(p0,g0)
+            b  = min(p1,g0 + GROUP_PINGS)
+            Sv[:,a - p0:b - p0] = cached[1][:,a - g0:b - g0]
+            if truth:
+                for name,mask in cached[2].items():
+                    parts.setdefault(name,[]).append(mask[...,a - g0:b - g0])
+        if truth:
+            parts = {name:np.concatenate(masks,axis = -1) for name,masks in parts.items()}
+        yield Sv,parts
+
+
+def synthetic_echogram(pings,rows = 200,**kwargs):
+    '''
+    :param pings, rows: echogram shape
+    :type  pings, rows: int
+
+    keyword arguments as synthetic_blocks
+
+    return:
+    :param Sv: synthetic Sv (dB re 1m^-1)
+    :type  Sv: 2D numpy.array
+
+    :param truth: ground-truth masks (TRUTH), None if truth = False
+    :type  truth: dict
+
+    desc: the whole echogram of synthetic_blocks
+
+    defined by RP
+
+    status: test
+    '''
+    kwargs.setdefault('block_pings',10*GROUP_PINGS)
+    Sv     = np.empty((rows,pings))
+    truth  = None
+    p0     = 0
+    for block,parts in synthetic_blocks(pings,rows,**kwargs):
+        p1           = p0 + block.shape[1]
+        Sv[:,p0:p1]  = block
+        if parts is not None:
+            if truth is None:
+                truth = {name:np.empty(mask.shape[:-1] + (pings,),dtype = mask.dtype)
+                         for name,mask in parts.items()}
+            for name,mask in parts.items():
+                truth[name][...,p0:p1] = mask
+        p0 = p1
+    return Sv,truth
@@ -0,0 +1,50 @@
+# -*- coding: utf-8 -*-
+
+import importlib.util
+import os
+
+BENCHMARKS = os.path.join(os.path.dirname(os.path.abspath(__file__)),'..','..',
+                          'benchmarks','run.py')
+
+
+def load_benchmarks():
+    spec   = importlib.util.spec_from_file_location('benchmarks_run',BENCHMARKS)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def test_benchmarks_cover_public_functions():
+    bench = load_benchmarks()
+    assert set(bench.public_functions()) <= set(bench.CASES)
+
+
+def test_benchmark_regressions():
+    bench    = load_benchmarks()
+    results  = bench.run(['synthetic-200','synthetic-400'],
+                         ['binary_threshold','break_mask'],verbose = False)
+    entry    = results['functions']['break_mask']
+    assert entry['synthetic-200']['time'] > 0 and entry['synthetic-200']['peak'] > 0
+    assert entry['exponent'] is not None
+    assert bench.compare(results,results) == []
+    
+    ## 10x slower / 10x the memory of the baseline
+    slower = {'functions':{f:{n:(dict(time = e['time']/10.,peak = e['peak']/10.) 
+                                 if n != 'exponent' else e) for n,e in entries.items()}
+                           for f,entries in results['functions'].items()}}
+    failures = bench.compare(results,slower,min_time = 0,min_bytes = 0)
+    assert len(failures) == 8
+
+
+def test_benchmark_exit_status(tmp_path):
+    import json
+    bench    = load_benchmarks()
+    baseline = str(tmp_path/'baseline.json')
+    args     = ['--pings','200','400','--no-bundled','--only','vertical_merge']
+    assert bench.main(args + ['--save',baseline]) == 0
+    with open(baseline) as f:
+        results = json.load(f)
+    results['functions']['vertical_merge']['exponent'] -= 1
+    with open(baseline,'w') as f:
+        json.dump(results,f)
+    assert bench.main(args + ['--baseline',baseline]) == 1
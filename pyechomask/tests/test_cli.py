@@ -0,0 +1,70 @@
+# -*- coding: utf-8 -*-
+
+import gzip
+import json
+import os
+import pickle
+
+import numpy as np
+
+from pyechomask import cli, store
+from pyechomask.pipeline import sslem_pipeline
+from pyechomask.synthetic import synthetic_echogram
+
+PARAMS = dict(pl = 1.024,sample_int = 0.5,min_sep = 5,max_thickness = 40,min_size = 20,
+              min_thickness = 2)
+
+
+def cruise(path):
+    ## two pickles and a store
+    os.makedirs(path)
+    for k in range(2):
+        with gzip.open(os.path.join(path,'D%d.pklz' % k),'wb') as f:
+            pickle.dump(synthetic_echogram(400,rows = 120,seed = k)[0],f)
+    store.write_echogram(os.path.join(path,'D2'),synthetic_echogram(300,rows = 120,seed = 2)[0],
+                         sample_int = 0.5,chunk_pings = 128)
+
+
+def test_cli(tmp_path,capsys):
+    data,out = str(tmp_path/'data'),str(tmp_path/'out')
+    cruise(data)
+    params   = str(tmp_path/'params.json')
+    with open(params,'w') as f:
+        json.dump(dict(PARAMS,outputs = ['ssl','bottom','table']),f)
+    assert cli.find_inputs([data]) == [os.path.join(data,n) for n in ('D0.pklz','D1.pklz','D2')]
+
+    ## worker processes, outputs match the pipeline
+    assert cli.main([data,'-p',params,'-o',out,'-j','2']) == 0
+    Sv       = synthetic_echogram(400,rows = 120,seed = 1)[0]
+    expected = sslem_pipeline(**PARAMS).run(Sv,outputs = ['ssl','bottom'])
+    with np.load(os.path.join(out,'D1.npz')) as result:
+        np.testing.assert_array_equal(result['ssl'],expected['ssl'])
+        np.testing.assert_array_equal(result['bottom'],expected['bottom'])
+    table    = np.genfromtxt(os.path.join(out,'D1.csv'),delimiter = ',',names = True)
+    assert len(np.atleast_1d(table)) == expected['ssl'].max()
+    with open(os.path.join(out,'D2.json')) as f:
+        assert json.load(f)['shape'] == [120,300]
+    assert 'Mpixel/s' in capsys.readouterr().out
+
+    ## resumed: current outputs skipped, changed inputs and parameters redone
+    report = cli.run(cli.find_inputs([data + '/*']),dict(PARAMS),out,verbose = False)
+    assert [r['status'] for r in report] == ['skipped']*3
+    os.utime(os.path.join(data,'D0.pklz'),(1,1))
+    report = cli.run(cli.find_inputs([data]),dict(PARAMS),out,verbose = False)
+    assert [(os.path.basename(r['path']),r['status']) for r in report] == \
+           [('D1.pklz','skipped'),('D2','skipped'),('D0.pklz','done')]
+    report = cli.run([os.path.join(data,'D2')],dict(PARAMS,min_size = 30),out,verbose = False)
+    assert report[0]['status'] == 'done'
+    ## orientation of the pickles changed: redone
+    report = cli.run([os.path.join(data,'D1.pklz')],dict(PARAMS,transpose = True),out,
+                     verbose = False)
+    assert report[0]['status'] == 'done' and report[0]['shape'] == [400,120]
+    report = cli.run([os.path.join(data,'D1.pklz')],dict(PARAMS,transpose = True),out,
+                     verbose = False)
+    assert report[0]['status'] == 'skipped'
+
+    ## unreadable input: reported, the rest done, exit status 1
+    with open(os.path.join(data,'bad.pkl'),'wb') as f:
+        f.write(b'not a pickle')
+    assert cli.main([data,'-p',params,'-o',out,'-q']) == 1
+    assert not os.path.exists(os.path.join(out,'bad.json'))
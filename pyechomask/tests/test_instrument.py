@@ -0,0 +1,65 @@
+# -*- coding: utf-8 -*-
+
+import numpy as np
+
+from pyechomask import instrument, masks, manipulate
+from pyechomask.pipeline import sslem_pipeline
+from pyechomask.synthetic import synthetic_echogram
+
+
+def test_recorder():
+    Sv,truth = synthetic_echogram(600,rows = 120,seed = 2)
+    seen     = []
+    with instrument.Recorder(memory = True,callback = seen.append) as rec:
+        signal  = masks.binary_signal(Sv,1.024,0.5,5,40)
+        seabed,_ = masks.binary_seabed(Sv)
+        tiles   = list(masks.binary_seabed_tiles(Sv,tile_pings = 250))
+        median  = manipulate.feature_median(Sv,manipulate.break_mask(signal))
+    assert seen == rec.calls
+    calls = {c.name:c for c in rec.calls}
+
+    call  = calls['masks.binary_signal']
+    ## one median plane per distinct window set, each window reading >= 1 value per pixel
+    assert call.depth == 0 and call.counts['planes'] == call.counts['sizes']
+    assert call.counts['window_samples'] >= call.counts['planes']*Sv.size
+    assert call.inputs == [((120,600),'float64')] and call.outputs == [((120,600),'uint8')]
+    assert call.bytes > Sv.nbytes and 0 < call.self_time <= call.time
+    assert 'manipulate.mask_buffer' not in calls
+    assert calls['masks.binary_seabed'].counts['pings'] == 600
+    assert calls['masks.binary_seabed_tiles'].counts == {'pings':600,'blocks':len(tiles)}
+    assert calls['manipulate.feature_median'].counts['labels'] == \
+           manipulate.break_mask(signal).max()
+
+    summary = rec.summary()
+    assert summary['manipulate.break_mask']['calls'] == 1
+    report  = rec.report()
+    assert report.splitlines()[0].startswith('function')
+    assert 'masks.binary_signal' in report and 'window_samples=' in report
+
+    ## stopped: nothing recorded, results unchanged
+    n = len(rec.calls)
+    np.testing.assert_array_equal(masks.binary_signal(Sv,1.024,0.5,5,40),signal)
+    np.testing.assert_array_equal(masks.binary_seabed(Sv)[0],seabed)
+    assert len(rec.calls) == n and not instrument._recorders
+
+    ## planes from a cache are not computed again
+    cache = masks.MedianPlaneCache()
+    with instrument.Recorder() as rec:
+        for _ in range(2):
+            masks.binary_signal(Sv,1.024,0.5,5,40,cache = cache)
+    first,second = [c.counts for c in rec.calls if c.name == 'masks.binary_signal']
+    assert first['planes'] == first['sizes'] == second['sizes'] > 0
+    assert 'planes' not in second and 'window_samples' not in second
+
+
+def test_pipeline_stages():
+    Sv,_ = synthetic_echogram(400,rows = 120,seed = 2)
+    pipe = sslem_pipeline(1.024,0.5,min_sep = 5,max_thickness = 40,min_size = 20,
+                          min_thickness = 2)
+    with instrument.Recorder() as rec:
+        pipe.run(Sv)
+    stages = [c for c in rec.calls if c.name.startswith('pipeline.')]
+    assert [c.name for c in stages] == ['pipeline.' + ','.join(s.names) for s in pipe.stages]
+    assert all(c.depth == 0 for c in stages)
+    signal = [c for c in rec.calls if c.name == 'masks.binary_signal'][0]
+    assert signal.depth == 1
@@ -0,0 +1,323 @@
+# -*- coding: utf-8 -*-
+"""
+tests for pyechomask.manipulate
+"""
+
+import numpy as np
+
+from scipy import ndimage
+
+from pyechomask import manipulate
+
+
+def brute_median(data,window_size,error_value = 0):
+    '''
+    np.median of each median_1D_filter window
+    '''
+    data       = np.ma.masked_invalid(data)
+    start,stop = manipulate.median_1D_windows(len(data),window_size)
+    result     = []
+    for a,b in zip(start,stop):
+        window = data[a:b].compressed()
+        result.append(np.median(window) if len(window) > 2 else error_value)
+    return np.array(result)
+
+
+def test_rolling_median():
+    rng = np.random.default_rng(0)
+    for n in [1,5,30,200]:
+        for window_size in [3,4,10,31]:
+            data = rng.integers(0,20,n).astype(float)
+            data[rng.random(n) < 0.2] = np.nan
+            data = np.ma.masked_where(rng.random(n) < 0.1,data)
+            np.testing.assert_array_equal(manipulate.median_1D_filter(data,window_size),
+                                          brute_median(data,window_size))
+    ## along either axis of a 2D array
+    data = rng.normal(size = (20,50))
+    data[rng.random(data.shape) < 0.3] = np.nan
+    for axis in [0,1]:
+        result   = manipulate.rolling_median(data,7,axis = axis,error_value = -1)
+        expected = np.apply_along_axis(brute_median,axis,data,7,-1)
+        np.testing.assert_array_equal(result,expected)
+    
+    ## sorted windows in small blocks and the heap (wide windows) agree
+    data = np.ma.masked_where(rng.random((6,700)) < 0.1,rng.normal(size = (6,700)))
+    data[rng.random(data.shape) < 0.2] = np.inf
+    heap = np.array([manipulate.windowed_median(line,*manipulate.median_1D_windows(700,41))
+                     for line in data])
+    block,manipulate.MEDIAN_BLOCK = manipulate.MEDIAN_BLOCK,1000
+    try:
+        np.testing.assert_array_equal(manipulate.rolling_median(data,40),heap)
+    finally:
+        manipulate.MEDIAN_BLOCK = block
+    wide = manipulate.HEAP_WINDOW + 2
+    heap = manipulate.rolling_median(data,wide,axis = 1)
+    limit,manipulate.HEAP_WINDOW = manipulate.HEAP_WINDOW,wide
+    try:
+        np.testing.assert_array_equal(manipulate.rolling_median(data,wide,axis = 1),heap)
+    finally:
+        manipulate.HEAP_WINDOW = limit
+
+
+def reference_break_mask(mask):
+    '''
+    per-ping implementation of break_mask (pyechomask 1.0.0.dev5)
+    '''
+    mask = mask.copy()
+    mask[mask > 0]     = 1
+    row,col            = mask.shape
+    prev_col           = manipulate.label_ping(mask[:,0])
+    labelled_mask      = np.zeros(mask.shape)
+    labelled_mask[:,0] = prev_col 
+    for c in range(1,col):
+        next_col        = manipulate.label_ping(mask[:,c])
+        all_connections = []
+        for next_feature in np.unique(next_col)[1:]:
+            connections = []
+            next_idx = np.where(next_col == next_feature)[0]
+            for prev_feature in np.unique(prev_col)[1:]:
+                prev_idx = np.where(prev_col == prev_feature)[0]
+                for i in next_idx:
+                    if i in prev_idx:
+                        connections.append(prev_feature)
+                        break
+            all_connections.append(connections)
+        for k,con in enumerate(all_connections):
+            new = False
+            if len(con) == 1:
+                for k2,con2 in enumerate(all_connections):
+                    if k != k2 and con[0] in con2:
+                        new = True
+            else:
+                new = True
+            idx = np.where(next_col == k+1)[0]
+            if new:            
+                labelled_mask[idx,c] = np.max(labelled_mask) + 1
+            else:
+                labelled_mask[idx,c] = con[0]
+        prev_col = labelled_mask[:,c]
+    return labelled_mask
+
+
+def random_mask(shape,seed = 0,p = 0.3):
+    '''
+    blobby random binary mask with noise in every ping
+    '''
+    from scipy import ndimage
+    rng  = np.random.default_rng(seed)
+    mask = ndimage.uniform_filter(rng.random(shape),5) > 0.5 + 0.2*(0.5 - p)
+    mask[0,:] = False
+    return mask.astype(int)
+
+
+def test_break_mask():
+    for seed,p in [(0,0.3),(1,0.5),(2,0.1)]:
+        mask     = random_mask((60,80),seed,p)
+        labelled = manipulate.break_mask(mask)
+        assert labelled.dtype == manipulate.label_dtype(labelled.max())
+        np.testing.assert_array_equal(labelled,reference_break_mask(mask))
+    np.testing.assert_array_equal(manipulate.label_ping(np.array([0,1,1,0,1,0,1])),
+                                  [0,1,1,0,2,0,3])
+    assert not manipulate.break_mask(np.zeros((5,5))).any()
+
+
+def test_feature_table():
+    rng       = np.random.default_rng(3)
+    labels    = manipulate.break_mask(random_mask((40,50),4,0.4))
+    Sv        = rng.normal(-70,5,labels.shape)
+    Sv[rng.random(Sv.shape) < 0.2] = -999
+    Sv[labels == labels.max()]     = -999 ## feature with no data
+    
+    ## per label reference (pyechomask 1.0.0.dev5 feature_median), 
+    ## features with no data are now noise_level
+    expected = np.ones(labels.shape)*-999
+    masked   = np.ma.masked_where(Sv == -999,Sv)
+    for label in np.unique(labels)[1:]:
+        idx = np.where(labels == label)
+        if masked[idx].count():
+            expected[idx] = np.ma.median(masked[idx])
+    np.testing.assert_array_equal(manipulate.feature_median(Sv,labels),expected)
+    
+    table = manipulate.feature_table(Sv,labels,percentiles = (10,90))
+    np.testing.assert_array_equal(table['label'],np.unique(labels)[1:])
+    for record in table[[0,5,-1]]:
+        rows,pings = np.where(labels == record['label'])
+        values     = Sv[rows,pings]
+        linear     = 10**(values[values > -999]/10.)
+        assert record['count'] == len(rows) and record['n_valid'] == len(linear)
+        assert (record['ping_min'],record['ping_max']) == (pings.min(),pings.max())
+        assert (record['row_min'],record['row_max']) == (rows.min(),rows.max())
+        if len(linear):
+            np.testing.assert_allclose(record['mean_Sv'],10*np.log10(linear.mean()))
+            np.testing.assert_allclose(record['median_Sv'],10*np.log10(np.median(linear)))
+            np.testing.assert_allclose(record['p90_Sv'],10*np.log10(np.percentile(linear,90)))
+            w = 10**(values/10.)*(values > -999)
+            np.testing.assert_allclose(record['centroid_row'],(w*rows).sum()/w.sum())
+        else:
+            assert record['mean_Sv'] == -999 and record['median_Sv'] == -999
+    
+    grid = manipulate.paint_features(labels,table,'count',fill = 0)
+    assert (grid[labels == 0] == 0).all()
+    assert grid[labels == table['label'][3]][0] == table['count'][3]
+
+
+def test_merge_binary():
+    rng   = np.random.default_rng(5)
+    masks = [rng.integers(0,2,(6,4)),rng.integers(0,2,(8,4)).astype(float),
+             rng.integers(0,2,(4,4))]
+    merged = manipulate.merge_binary(masks)
+    ## reference: string concatenation (pyechomask 1.0.0.dev5)
+    strings = masks[0].astype('S1')
+    for m in masks[1:]:
+        new = np.zeros(strings.shape)
+        new[0:min(m.shape[0],6),:] = m[0:min(m.shape[0],6),:]
+        strings = np.char.add(strings,new.astype('S1'))
+    expected = np.reshape([int(x,2) for x in strings.flatten()],strings.shape)
+    np.testing.assert_array_equal(merged,expected)
+    assert merged.dtype == np.uint8
+    
+    decoded = manipulate.decode_binary(merged,3)
+    np.testing.assert_array_equal(decoded[0],masks[0])
+    np.testing.assert_array_equal(decoded[1],masks[1][0:6])
+    np.testing.assert_array_equal(decoded[2][0:4],masks[2])
+    assert not decoded[2][4:].any()
+    
+    many = manipulate.merge_binary([np.ones((2,2))] + [np.zeros((2,2))]*63)
+    assert many.dtype == np.uint64 and manipulate.test_bit(many,0,64).all()
+    assert not manipulate.test_bit(many,63,64).any()
+
+
+def reference_box_filter(mask,window,threshold,axis):
+    '''
+    shifted-sum signal_row_filter (axis 1) and signal_column_filter 
+    (axis 0) of pyechomask 1.0.0.dev5
+    '''
+    mask = mask if axis == 1 else mask.T
+    row,col       = mask.shape
+    filtered_mask = np.zeros((mask.shape))
+    mask_sum      = np.zeros((row,col-window+1))
+    for i in range(window):
+        mask_sum += mask[:,i:col-(window-i-1)]
+    if axis == 1:
+        signal = mask_sum > (window*threshold)
+    else:
+        signal = mask_sum >= (window*threshold)
+    for i in range(window):
+        filtered_mask[:,i:col-(window-i-1)] += signal
+    filtered_mask[filtered_mask > 0] = 1
+    return filtered_mask if axis == 1 else filtered_mask.T
+
+
+def test_regrid():
+    rng = np.random.default_rng(2)
+    Sv  = rng.normal(-70,5,(100,7))
+    Sv[10:20,0] = -999
+    ## on the same grid, to coarser (mean of pairs, linear) and finer grids
+    np.testing.assert_allclose(manipulate.regrid_Sv(Sv,0.5,0.5),Sv)
+    coarse   = manipulate.regrid_Sv(Sv,0.5,1.0)
+    linear   = np.where(Sv > -999,10**(Sv/10.),np.nan)
+    expected = 10*np.log10(np.nanmean([linear[0::2],linear[1::2]],axis = 0))
+    np.testing.assert_allclose(coarse,np.where(np.isnan(expected),-999,expected))
+    out      = np.empty((50,7))
+    assert manipulate.regrid_Sv(Sv,0.5,1.0,out = out) is out
+    np.testing.assert_array_equal(out,coarse)
+    np.testing.assert_allclose(manipulate.regrid_Sv(Sv,1.0,0.25)[1::4],Sv)
+    ## integral (linear) over the full depth is kept
+    Sv[Sv == -999] = -80
+    fine = manipulate.regrid_Sv(Sv,0.3,0.2)
+    np.testing.assert_allclose((10**(fine/10.)*0.2).sum(axis = 0),
+                               (10**(Sv/10.)*0.3).sum(axis = 0))
+
+    mask = (Sv > -70).astype(np.uint8)
+    np.testing.assert_array_equal(manipulate.regrid_mask(mask,0.5,0.25)[::2],mask)
+    np.testing.assert_array_equal(manipulate.regrid_mask(mask,0.5,1.0,threshold = 1),
+                                  mask[0::2] & mask[1::2])
+
+    ## stack of frequencies: 200 rows of 0.5 m and 80 rows of 1 m
+    stack,sample_int = manipulate.stack_Sv([Sv,Sv[:80]],[0.5,1.0])
+    assert stack.shape == (2,160,7) and sample_int == 0.5
+    np.testing.assert_array_equal(stack[0,:100],Sv)
+    assert (stack[0,100:] == -999).all()
+    np.testing.assert_allclose(stack[1,1::2],Sv[:80])
+
+    ## merged on the grid of the first mask, not truncated
+    merged = manipulate.merge_binary([mask,mask[::2]],sample_int = [0.5,1.0])
+    np.testing.assert_array_equal(manipulate.test_bit(merged,1,2),np.repeat(mask[::2],2,0))
+
+
+def test_row_column_filters():
+    mask = random_mask((70,90),6,0.5)
+    for window,threshold in [(1,0.5),(5,0.5),(12,0.8),(70,0.1),(7,1)]:
+        for dtype in [float,bool,np.uint8]:
+            m = mask.astype(dtype)
+            np.testing.assert_array_equal(manipulate.signal_row_filter(m,window,threshold),
+                                          reference_box_filter(mask,window,threshold,1))
+            np.testing.assert_array_equal(manipulate.signal_column_filter(m,window,threshold),
+                                          reference_box_filter(mask,window,threshold,0))
+    ## in place, and rows then columns in one call
+    m    = mask.astype(np.uint8)
+    out  = manipulate.signal_row_filter(m,10,0.5,out = m)
+    assert out is m
+    np.testing.assert_array_equal(m,reference_box_filter(mask,10,0.5,1))
+    rect = manipulate.signal_rect_filter(mask,10,8,0.5,1)
+    np.testing.assert_array_equal(rect,reference_box_filter(
+        reference_box_filter(mask,10,0.5,1),8,1,0))
+
+
+def reference_vertical_merge(mask,min_sep):
+    '''
+    shifted-sum vertical_merge of pyechomask 1.0.0.dev5
+    '''
+    size    = int(min_sep)
+    row,col = mask.shape
+    mask2   = np.zeros(mask.shape)
+    for asize in range(1,size):
+        bsize = size - asize
+        above = np.zeros((row-2*size,col))
+        below = np.zeros((row-2*size,col))
+        for i in range(asize):
+            above += mask[size-i-1:row-size-i-1,:]
+        for i in range(bsize):   
+            below += mask[size + 1 + i:row-size+i+1,:]            
+        above[above > 0] = 1 
+        below[below > 0] = 1
+        mask2[size:row-size,:][(above + below) == 2] = 1
+    return mask2
+
+
+def test_vertical_merge():
+    for seed,p in [(7,0.2),(8,0.5)]:
+        mask = random_mask((80,40),seed,p)
+        mask[np.random.default_rng(seed).random(mask.shape) < 0.05] = 1
+        for min_sep in [0,1,2,5,13]:
+            np.testing.assert_array_equal(manipulate.vertical_merge(mask,min_sep),
+                                          reference_vertical_merge(mask,min_sep))
+
+    ## tall masks: gaps of empty columns must not wrap around (int16)
+    mask = np.zeros((8000,3),dtype = np.uint8)
+    mask[4000:4010,1] = 1
+    merged = manipulate.vertical_merge(mask,10)
+    np.testing.assert_array_equal(merged.sum(axis = 0),[0,8,0])
+    np.testing.assert_array_equal(merged,reference_vertical_merge(mask,10))
+
+
+def test_flag_tiles():
+    cross = np.array([[0,1,0],[1,1,1],[0,1,0]])
+    for seed,p in [(0,0.3),(1,0.5),(2,0.6)]:
+        mask = random_mask((50,120),seed,p)
+        for struct in [None,cross]:
+            ## struct is used (pyechomask 1.0.0.dev5 ignored it)
+            labels,n = ndimage.label(mask,cross if struct is None else struct)
+            flagged  = manipulate.flag(mask,struct = struct)
+            assert (flagged.max() == n) == (struct is not None)
+            
+            expected = manipulate.flag(mask.T,8,None if struct is None else struct.T).T
+            for tile_pings in [1,7,120]:
+                tiles  = list(manipulate.flag_tiles(mask,8,struct,tile_pings))
+                np.testing.assert_array_equal(np.hstack([t[0] for t in tiles]),expected)
+                np.testing.assert_array_equal(np.concatenate([t[1] for t in tiles]),
+                                              manipulate.feature_sizes(expected)[1:])
+    ## blocks as they arrive
+    tiles = manipulate.flag_tiles(np.hsplit(mask,[5,6,60]),8)
+    np.testing.assert_array_equal(np.hstack([t[0] for t in tiles]),
+                                  manipulate.flag(mask.T,8).T)
@@ -5,4 +5,316 @@ Created on Thu Jul 27 20:07:10 2017
 @author: Roland Proud
 """
 
-import pyechomask
\ No newline at end of file
+import numpy as np
+
+import pyechomask
+from pyechomask import masks
+
+
+def echogram(rows = 120,pings = 40,seed = 0):
+    '''
+    random Sv with a layer, noise values and a few invalid samples
+    '''
+    rng           = np.random.default_rng(seed)
+    Sv            = rng.normal(-80,6,(rows,pings))
+    Sv[40:60,:]  += 15
+    Sv[rng.random((rows,pings)) < 0.05] = -999
+    Sv[rng.random((rows,pings)) < 0.01] = np.nan
+    return Sv
+
+
+def rng_spikes(shape,seed = 1):
+    return np.random.default_rng(seed).random(shape) < 0.02
+
+
+def reference_binary_signal(Sv,pl,sample_int,min_sep,max_thickness,max_steps = 10):
+    '''
+    stacked-copies implementation of binary_signal (pyechomask 1.0.0.dev5)
+    '''
+    min_sep       = int(min_sep/sample_int)
+    max_thickness = int(max_thickness/sample_int)
+    sizes = range(min_sep,int(np.ceil(max_thickness/2 + 1.5*min_sep)),min_sep)
+    linear  = np.ma.masked_invalid(10**(Sv/10.))
+    step    = int(np.ceil(0.5*pl/1000./(sample_int/1500.))) 
+    maxL    = max(sizes)
+    row,col = linear.shape
+    image   = np.ma.vstack((linear[0:maxL,:][::-1],linear,linear[row-maxL:,:][::-1]))
+    signal  = np.zeros(linear.shape)
+    for size1 in sizes:
+        step1      = max([int(np.ceil(size1/max_steps)),step]) 
+        sizeRange1 = np.arange(step,int(size1)+1,step1)
+        mu1 = np.zeros((len(sizeRange1),row,col))
+        for k,l in enumerate(sizeRange1):
+            mu1[k,:] = image[maxL-l:row + maxL-l,:]
+        for size2 in sizes:
+            step2      = max([int(np.ceil(size2/max_steps)),step])  
+            sizeRange2 = np.arange(step,int(size2)+1,step2)
+            mu2 = np.zeros((len(sizeRange2),row,col))
+            for k,l in enumerate(-sizeRange2):
+                mu2[k,:] = image[maxL-l:row + maxL-l,:]
+            sig = (linear > np.ma.median(mu1,axis = 0)) * \
+                  (linear > np.ma.median(mu2,axis = 0))
+            signal[sig == True] = 1
+    return signal
+
+
+def test_import():
+    assert pyechomask.masks is masks
+
+
+def test_binary_signal_matches_reference():
+    Sv = echogram()
+    for pl,sample_int,min_sep,max_thickness in [(1.024,1,5,40),(0.256,0.5,4,30),
+                                                 (4.096,1,3,25)]:
+        expected = reference_binary_signal(Sv,pl,sample_int,min_sep,max_thickness)
+        signal   = masks.binary_signal(Sv,pl,sample_int,min_sep,max_thickness)
+        np.testing.assert_array_equal(signal,expected)
+
+
+def test_binary_signal_cache_reuse():
+    Sv    = echogram()
+    cache = masks.MedianPlaneCache()
+    for min_sep,max_thickness in [(5,40),(5,30),(10,40)]:
+        signal = masks.binary_signal(Sv,1.024,1,min_sep,max_thickness,cache = cache)
+        np.testing.assert_array_equal(signal,masks.binary_signal(Sv,1.024,1,min_sep,max_thickness))
+    assert cache.hits > 0
+    ## budget and a different echogram
+    small = masks.MedianPlaneCache(max_bytes = Sv.nbytes)
+    masks.binary_signal(Sv,1.024,1,5,40,cache = small)
+    assert len(small) == 1 and small.nbytes <= Sv.nbytes
+    masks.binary_signal(Sv + 1,1.024,1,5,40,cache = cache)
+    assert cache.nbytes <= cache.max_bytes and cache.misses > 0
+
+
+
+def test_binary_signal_without_cache(monkeypatch):
+    ## no cache given: the echogram is not hashed
+    Sv       = echogram()
+    expected = masks.binary_signal(Sv,1.024,1,5,40,cache = masks.MedianPlaneCache())
+    def bind(self,data):
+        raise AssertionError('bind called without a cache')
+    monkeypatch.setattr(masks.MedianPlaneCache,'bind',bind)
+    np.testing.assert_array_equal(masks.binary_signal(Sv,1.024,1,5,40),expected)
+
+
+def test_binary_signal_tiles():
+    Sv       = echogram(pings = 45)
+    expected = masks.binary_signal(Sv,1.024,1,5,40)
+    tiles    = list(masks.binary_signal_tiles(Sv,1.024,1,5,40,tile_pings = 10))
+    assert [t.shape[1] for t in tiles] == [10,10,10,10,5]
+    np.testing.assert_array_equal(np.hstack(tiles),expected)
+    ## generator of ping blocks, bounded by memory
+    blocks = (Sv[:,p:p + 15] for p in range(0,45,15))
+    tiles  = list(masks.binary_signal_tiles(blocks,1.024,1,5,40,
+                  max_memory = 7*Sv.shape[0]*masks.SIGNAL_BYTES_PER_PIXEL))
+    assert max(t.shape[1] for t in tiles) == 7
+    np.testing.assert_array_equal(np.hstack(tiles),expected)
+
+
+def test_binary_signal_parallel():
+    Sv       = echogram(pings = 30)
+    expected = masks.binary_signal(Sv,1.024,1,5,40)
+    for executor in ['thread','process']:
+        signal = masks.binary_signal(Sv,1.024,1,5,40,n_jobs = 2,executor = executor)
+        np.testing.assert_array_equal(signal,expected)
+
+
+def test_binary_signal_mean():
+    Sv     = echogram()
+    signal = masks.binary_signal(Sv,1.024,1,5,40,method = 'mean')
+    ## brute force window means on the mirrored image
+    linear   = np.ma.masked_invalid(10**(Sv/10.))
+    image    = np.vstack((linear.data[0:40][::-1],linear.data,linear.data[-40:][::-1]))
+    row      = Sv.shape[0]
+    upper    = np.full(Sv.shape,np.inf)
+    lower    = np.full(Sv.shape,np.inf)
+    for size in range(5,int(np.ceil(40/2 + 1.5*5)),5):
+        offsets = np.arange(1,size + 1,int(np.ceil(size/10)))
+        above   = np.mean([image[40 - l:40 - l + row] for l in offsets],axis = 0)
+        below   = np.mean([image[40 + l:40 + l + row] for l in offsets],axis = 0)
+        upper   = np.fmin(upper,above)
+        lower   = np.fmin(lower,below)
+    with np.errstate(invalid = 'ignore'):
+        expected = (linear > upper).filled(False) & (linear > lower).filled(False)
+    np.testing.assert_array_equal(signal,expected)
+    
+    report = masks.binary_signal_agreement(Sv,1.024,1,5,40)
+    assert 0.5 < report['agreement'] <= 1 and 0 < report['iou'] <= 1
+
+
+def test_binary_impulse():
+    Sv = echogram(pings = 37)
+    Sv[rng_spikes(Sv.shape)] += 30
+    ## per-sample reference rule
+    expected = np.ones(Sv.shape,dtype = int)
+    for s in range(1,Sv.shape[0] - 1):
+        for p in range(Sv.shape[1]):
+            if (Sv[s,p] - Sv[s-1,p] > 10) & (Sv[s,p] - Sv[s+1,p] > 10):
+                expected[s,p] = 0
+    np.testing.assert_array_equal(masks.binary_impulse(Sv,10),expected)
+    tiles = masks.binary_impulse_tiles(Sv,10,tile_pings = 8)
+    np.testing.assert_array_equal(np.hstack(list(tiles)),expected)
+    
+    ## ping to ping, tiles carry lag pings between tiles
+    for lag,smooth in [(1,1),(2,3)]:
+        mask = masks.binary_impulse(Sv,10,method = 'ping',lag = lag,smooth = smooth)
+        assert (mask[:,:lag] == 1).all() and (mask[:,-lag:] == 1).all()
+        assert (mask == 0).any()
+        for tile_pings in [1,3,8]:
+            tiles = list(masks.binary_impulse_tiles(Sv,10,'ping',lag,smooth,tile_pings))
+            np.testing.assert_array_equal(np.hstack(tiles),mask)
+
+
+def test_binary_pulse():
+    Sv       = echogram(pings = 20)
+    Sv[0:5]  = -50
+    Sv[:,3]  = -60 ## no noise sample
+    expected = np.ones(Sv.shape,dtype = int)
+    for p in range(Sv.shape[1]):
+        if p != 3:
+            expected[0:np.where(Sv[:,p] <= -999)[0][0],p] = 0
+    mask,idx = masks.binary_pulse(Sv,return_index = True)
+    expected[:,3] = 0
+    np.testing.assert_array_equal(mask,expected)
+    assert idx[3] == Sv.shape[0] and idx.dtype == np.int32
+    assert (masks.binary_pulse(Sv,no_noise = 'keep')[:,3] == 1).all()
+    try:
+        masks.binary_pulse(Sv,no_noise = 'raise')
+        assert False
+    except ValueError:
+        pass
+
+
+def reference_binary_seabed(Sv, min_depth = 0, threshold = -40, buffer = 5,window_size = 30,noise_level = -999):
+    '''
+    per-ping implementation of binary_seabed (pyechomask 1.0.0.dev5)
+    '''
+    from pyechomask.manipulate import median_1D_filter
+    mask = np.ones(Sv.shape)
+    Sv   = np.ma.masked_invalid(np.ma.masked_where(Sv <= noise_level,Sv))
+    row,col = Sv.shape
+    for c in range(col):
+        idx = np.ma.where(Sv[:,c] < (threshold - 10))
+        if len(idx[0]) == 0:
+            continue
+        Sv[0:idx[0][0],c] = noise_level
+    maxidx  = np.ma.argmax(Sv,axis = 0)
+    maxidx2 = []
+    for k,idx in enumerate(maxidx):
+        if Sv[idx,k] < threshold or idx < min_depth or np.ma.is_masked(Sv[idx,k]):
+            maxidx2.append(0)
+        else:
+            maxidx2.append(idx)
+    if np.sum(maxidx2) == 0:
+        return mask,np.array(maxidx2)
+    maxidx3 = median_1D_filter(np.ma.masked_where(np.array(maxidx2) == 0,maxidx2),window_size)
+    for k,idx in enumerate(maxidx3):
+        idx = int(idx)
+        if idx == 0:
+            continue
+        mask[max([0,idx - buffer]):,k] = 0
+    return mask,maxidx3
+
+
+def seabed_echogram(rows = 150,pings = 90,seed = 2):
+    rng    = np.random.default_rng(seed)
+    Sv     = echogram(rows,pings,seed)
+    Sv[0:4] = -30 ## pulse
+    bottom = (100 + 10*np.sin(np.arange(pings)/10.)).astype(int)
+    bottom[rng.random(pings) < 0.1] -= 30 ## spikes
+    Sv[bottom,np.arange(pings)]  = -20
+    Sv[:,rng.random(pings) < 0.1] = -999 ## dropped pings
+    return Sv
+
+
+def test_binary_seabed():
+    Sv = seabed_echogram()
+    for kwargs in [{},{'min_depth':90,'window_size':10,'buffer':3}]:
+        expected,line = reference_binary_seabed(Sv,**kwargs)
+        mask,bottom   = masks.binary_seabed(Sv,**kwargs)
+        np.testing.assert_array_equal(mask,expected)
+        np.testing.assert_array_equal(bottom,line.astype(int))
+        assert bottom.dtype == np.int32
+        for tile_pings in [1,7,40]:
+            tiles = list(masks.binary_seabed_tiles(Sv,tile_pings = tile_pings,**kwargs))
+            np.testing.assert_array_equal(np.hstack([t[0] for t in tiles]),mask)
+            np.testing.assert_array_equal(np.concatenate([t[1] for t in tiles]),bottom)
+    ## no seabed
+    mask,bottom = masks.binary_seabed(Sv,threshold = 0)
+    assert (mask == 1).all() and not bottom.any()
+
+
+def sslem_pipeline(Sv):
+    '''
+    SSLEM example pipeline (examples/SSLEM.py) on a gridded echogram
+    '''
+    from pyechomask import manipulate
+    seabed,_ = masks.binary_seabed(Sv,buffer = 5,window_size = 10)
+    Sv[seabed == 0] = -999
+    signal   = masks.binary_signal(Sv,1.024,0.5,5,50,max_steps = 10)
+    signal   = manipulate.signal_row_filter(signal,20,0.5,out = signal)
+    signal   = manipulate.signal_column_filter(signal,5,1,out = signal)
+    signal   = manipulate.flag(signal,100)
+    signal[signal > 0] = 1
+    signal   = manipulate.vertical_merge(signal,10)
+    signal   = manipulate.fill_feature_gaps(signal,100)
+    signal   = manipulate.break_mask(signal)
+    signal   = manipulate.remove_features(signal,100)
+    return signal,manipulate.feature_median(Sv,signal)
+
+
+def test_frequency_stack():
+    from pyechomask.manipulate import stack_Sv
+    from pyechomask.synthetic import synthetic_echogram
+    Sv18,_ = synthetic_echogram(300,rows = 100,sample_int = 1.0,seed = 1,pulse_depth = 6)
+    Sv38,_ = synthetic_echogram(300,rows = 200,sample_int = 0.5,seed = 2)
+    Sv70,_ = synthetic_echogram(300,rows = 200,sample_int = 0.5,seed = 3)
+    stack,sample_int = stack_Sv([Sv18,Sv38,Sv70],[1.0,0.5,0.5])
+    
+    ## per frequency pulse lengths, frequencies as 2D echograms
+    pl     = [4.096,1.024,1.024]
+    signal = masks.binary_signal(stack,pl,sample_int,5,40)
+    assert signal.shape == stack.shape and signal.dtype == np.uint8
+    for k in range(3):
+        np.testing.assert_array_equal(signal[k],masks.binary_signal(stack[k],pl[k],
+                                                                    sample_int,5,40))
+    np.testing.assert_array_equal(masks.binary_threshold(stack,-50,-80)[1],
+                                  masks.binary_threshold(Sv38,-50,-80))
+    
+    ## pulse: per frequency or the deepest for all
+    pulse,idx = masks.binary_pulse(stack,return_index = True)
+    np.testing.assert_array_equal(pulse[1],masks.binary_pulse(Sv38))
+    assert (idx[0] == 12).all() and (idx[1] == 6).all()
+    pulse     = masks.binary_pulse(stack,shared = True)
+    assert (pulse == pulse[0]).all() and not pulse[:,:12].any()
+    
+    ## one seabed line for every frequency
+    seabed,bottom = masks.binary_seabed(stack,buffer = 0)
+    assert (seabed == seabed[0]).all()
+    np.testing.assert_array_equal(masks.binary_seabed(stack,frequency = 1)[1],
+                                  masks.binary_seabed(Sv38)[1])
+    assert np.mean(np.abs(bottom - masks.binary_seabed(Sv38)[1]) <= 1) > 0.95
+
+
+def test_sslem_peak_memory():
+    import tracemalloc
+    rows,pings = 400,1000
+    Sv         = np.random.default_rng(0).normal(-80,3,(rows,pings))
+    Sv[80:110]              += 15
+    Sv[200:220,200:750]     += 12
+    Sv[0:10]                 = -999
+    Sv[360:]                 = -999
+    Sv[360]                  = -20
+    
+    tracemalloc.start()
+    try:
+        labels,median = sslem_pipeline(Sv)
+        peak          = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    
+    assert labels.dtype == np.uint8 and labels.max() > 0
+    assert median.shape == Sv.shape
+    ## int64/float64 masks (pyechomask 1.0.0.dev5) peaked at 296 bytes per 
+    ## pixel on this echogram
+    assert peak/Sv.size < 296/4.
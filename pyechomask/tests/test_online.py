@@ -0,0 +1,76 @@
+# -*- coding: utf-8 -*-
+
+import numpy as np
+
+from pyechomask import masks, manipulate
+from pyechomask.online import OnlineSSLEM
+
+
+def transect(rows = 150,pings = 140,seed = 0):
+    '''
+    pulse, weak/strong noise, a layer and a seabed with dropped pings
+    '''
+    rng             = np.random.default_rng(seed)
+    Sv              = rng.normal(-85,4,(rows,pings))
+    Sv[0:8]         = -30 + rng.normal(0,1,(8,pings))
+    Sv[8]           = -999
+    Sv[40:55]      += 20
+    bottom          = (110 + 8*np.sin(np.arange(pings)/15.)).astype(int)
+    bottom[rng.random(pings) < 0.1] += 20 ## spikes
+    for p,b in enumerate(bottom):
+        Sv[b:,p]    = -25
+    Sv[rng.random((rows,pings)) < 0.02] = -999
+    return Sv
+
+
+def batch_sslem(sslem,Sv):
+    '''
+    examples/SSLEM.py steps to the column filter, on the whole transect
+    '''
+    Sv        = np.array(Sv)
+    Sv[masks.binary_pulse(Sv,sslem.noise_level) == 0] = sslem.noise_level
+    if sslem.min_Sv is not None:
+        Sv[Sv < sslem.min_Sv] = sslem.noise_level
+    bottom    = np.zeros(Sv.shape[1],dtype = np.int32)
+    if sslem.seabed:
+        seabed,bottom = masks.binary_seabed(Sv,sslem.min_depth,sslem.seabed_threshold,
+                                            sslem.seabed_buffer,sslem.seabed_window,
+                                            sslem.noise_level)
+        Sv[seabed == 0] = sslem.noise_level
+    if sslem.max_Sv is not None:
+        Sv[Sv > sslem.max_Sv] = sslem.noise_level
+    signal = masks.binary_signal(Sv,sslem.pl,sslem.sample_int,sslem.min_sep,
+                                 sslem.max_thickness,sslem.max_steps)
+    signal = manipulate.signal_row_filter(signal,min(sslem.min_size,Sv.shape[1]),
+                                          sslem.row_threshold)
+    signal = manipulate.signal_column_filter(signal,sslem.min_thickness,
+                                             sslem.column_threshold)
+    return signal,bottom
+
+
+def test_online_sslem():
+    Sv = transect()
+    for kwargs in [{},{'seabed':False,'min_size':1},{'min_Sv':-90,'max_Sv':-50,
+                                                     'seabed_window':5,'min_size':30}]:
+        params = dict(pl = 1.024,sample_int = 0.5,min_sep = 4,max_thickness = 20,
+                      min_size = 9,min_thickness = 2)
+        params.update(kwargs)
+        sslem            = OnlineSSLEM(**params)
+        expected,line    = batch_sslem(sslem,Sv)
+        for block in [1,4,50]:
+            sslem.reset()
+            out,bottom,lag = [],[],0
+            for p in range(0,Sv.shape[1],block):
+                mask,b = sslem.push(Sv[:,p:p + block] if block > 1 else Sv[:,p])
+                out.append(mask)
+                bottom.append(b)
+                lag    = max(lag,sslem.received - sslem.emitted)
+                ## only the pings each stage still needs are held
+                assert sslem._Sv.shape[1] + sslem._signal.shape[1] <= 2*(sslem.latency + block)
+            mask,b = sslem.flush()
+            out.append(mask)
+            bottom.append(b)
+            assert lag <= sslem.latency + block - 1
+            np.testing.assert_array_equal(np.hstack(out),expected)
+            np.testing.assert_array_equal(np.concatenate(bottom),line)
+            assert np.hstack(out).dtype == manipulate.MASK_DTYPE
@@ -0,0 +1,83 @@
+# -*- coding: utf-8 -*-
+
+import numpy as np
+
+from pyechomask import masks, manipulate
+from pyechomask.pipeline import Pipeline, Stage, sslem_pipeline
+from pyechomask.tests.test_online import transect
+
+
+def sslem_script(Sv,pl,sample_int,min_sep,max_thickness,min_size,min_thickness,
+                 min_Sv = -90,max_Sv = -50,noise_level = -999):
+    '''
+    examples/SSLEM.py, with binary_pulse for the transmit pulse
+    '''
+    Sv                 = np.array(Sv)
+    min_thickness_rows = int(min_thickness/sample_int)
+    min_sep_rows       = int(min_sep/sample_int)
+    min_agg            = min_size*min_thickness_rows
+    Sv[masks.binary_pulse(Sv,noise_level) == 0] = noise_level
+    Sv[Sv < min_Sv]    = noise_level
+    seabed,_           = masks.binary_seabed(Sv,buffer = min_sep_rows,window_size = 10)
+    Sv[seabed == 0]    = noise_level
+    Sv[Sv > max_Sv]    = noise_level
+    signal = masks.binary_signal(Sv,pl,sample_int,min_sep,max_thickness,max_steps = 10)
+    signal = manipulate.signal_row_filter(signal,min_size,threshold = 0.5)
+    signal = manipulate.signal_column_filter(signal,min_thickness_rows,threshold = 1)
+    signal = manipulate.flag(signal,min_agg)
+    signal = manipulate.vertical_merge(signal,min_sep_rows)
+    signal = manipulate.fill_feature_gaps(signal,min_agg)
+    signal = manipulate.break_mask(signal)
+    signal = manipulate.remove_features(signal,min_agg)
+    return signal,manipulate.feature_median(Sv,signal)
+
+
+def test_sslem_pipeline():
+    Sv     = transect(pings = 200)
+    params = dict(pl = 1.024,sample_int = 0.5,min_sep = 4,max_thickness = 20,
+                  min_size = 9,min_thickness = 2)
+    for cache_bytes in [2**30,0]:
+        sslem  = sslem_pipeline(cache_bytes = cache_bytes,**params)
+        for change,first in [({},'pulse'),({'min_size':5},'rows'),({'max_Sv':-60},'Sv_clean'),
+                             ({'min_sep':3},('seabed','bottom'))]:
+            params.update(change)
+            result = sslem.run(Sv,outputs = ['ssl','median','signal'],**change)
+            ssl,median = sslem_script(Sv,**params)
+            assert ssl.max() > 1
+            np.testing.assert_array_equal(result['ssl'],ssl)
+            np.testing.assert_array_equal(result['median'],median)
+            if cache_bytes:
+                ## upstream stages come from the cache
+                assert sslem.executed[0] == first
+            else:
+                assert len(sslem.executed) == len(sslem.stages)
+        params.update(min_size = 9,max_Sv = -50,min_sep = 4)
+    
+    ## without a cache, intermediate buffers are reused
+    sslem  = sslem_pipeline(cache_bytes = 0,**params)
+    sizes  = []
+    for min_size in [9,5,7]:
+        result = sslem.run(Sv,min_size = min_size)
+        sizes.append(len(sslem._pool))
+        pool   = set(id(b) for b in sslem._pool)
+        assert id(result['median']) not in pool
+    assert 0 < sizes[-1] <= sum(s.dtype is not None for s in sslem.stages)
+
+
+def shift(Sv,offset):
+    return Sv + offset
+
+
+def test_stage_key_arrays():
+    ## array parameters differing only where their repr elides them
+    pipe    = Pipeline([Stage('shifted',shift,params = {'offset':lambda p: p['offset']})],
+                       {'offset':None})
+    Sv      = np.zeros(5000)
+    a,b     = np.zeros(5000),np.zeros(5000)
+    b[2500] = 1
+    assert repr(a) == repr(b)
+    assert pipe.run(Sv,offset = a)['shifted'][2500] == 0
+    assert pipe.run(Sv,offset = b)['shifted'][2500] == 1
+    assert pipe.executed == ['shifted']
+    pipe.run(Sv,offset = b.copy())
+    assert pipe.executed == []
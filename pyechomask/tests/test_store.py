@@ -0,0 +1,67 @@
+# -*- coding: utf-8 -*-
+
+import gzip
+import pickle
+
+import numpy as np
+
+from pyechomask import masks, manipulate, store
+
+
+def echogram(rows = 80,pings = 230,seed = 0):
+    rng          = np.random.default_rng(seed)
+    Sv           = rng.normal(-80,5,(rows,pings))
+    Sv[30:40]   += 15
+    Sv[:3]       = -999
+    Sv[70]       = -20
+    return Sv
+
+
+def test_store_round_trip(tmp_path):
+    Sv    = echogram()
+    times = np.arange(Sv.shape[1]).astype('datetime64[s]')
+    for compression in [None,'zlib']:
+        path = str(tmp_path/str(compression))
+        ## written from ping blocks, chunks do not match blocks
+        store.write_echogram(path,np.hsplit(Sv,[10,100]),sample_int = 0.5,frequency = 38,
+                             ping_times = times,chunk_pings = 64,compression = compression,
+                             vessel = 'RRS Discovery')
+        e = store.open_echogram(path)
+        assert e.shape == Sv.shape and e.dtype == np.dtype('<f8')
+        assert (e.sample_int,e.frequency,e.noise_level) == (0.5,38,-999)
+        assert e.meta['vessel'] == 'RRS Discovery'
+        np.testing.assert_array_equal(e.ping_times,times)
+        np.testing.assert_array_equal(np.asarray(e),Sv)
+        for key in [np.s_[:,60:130],np.s_[5,::7],np.s_[10:20,[3,200,64]],np.s_[:,-1],
+                    np.s_[:,::-3],np.s_[:,5:5]]:
+            np.testing.assert_array_equal(e[key],Sv[key])
+        np.testing.assert_array_equal(np.hstack(list(e.blocks(50))),Sv)
+
+
+def test_convert_pickle(tmp_path):
+    Sv = echogram()
+    with gzip.open(str(tmp_path/'Sv.pklz'),'wb') as f:
+        pickle.dump(Sv,f)
+    with open(str(tmp_path/'Sv.pkl'),'wb') as f:
+        pickle.dump(Sv.T,f)
+    e = store.convert_pickle(str(tmp_path/'Sv.pklz'),str(tmp_path/'a'),sample_int = 0.2)
+    np.testing.assert_array_equal(np.asarray(e),Sv)
+    assert e.meta['source'] == 'Sv.pklz'
+    e = store.convert_pickle(str(tmp_path/'Sv.pkl'),str(tmp_path/'b'),transpose = True)
+    np.testing.assert_array_equal(np.asarray(e),Sv)
+
+
+def test_masks_accept_echogram(tmp_path):
+    Sv = echogram()
+    e  = store.write_echogram(str(tmp_path/'e'),Sv,chunk_pings = 50)
+    for method in [lambda S: masks.binary_threshold(S,-70),
+                   lambda S: masks.binary_signal(S,1.024,0.5,5,20),
+                   lambda S: masks.binary_pulse(S),
+                   lambda S: masks.binary_seabed(S)[0],
+                   lambda S: masks.binary_impulse(S,10,'ping'),
+                   lambda S: masks.binary_impulse(S,10,'ping',smooth = 3),
+                   lambda S: masks.binary_impulse(S,10,'vertical'),
+                   lambda S: np.hstack(list(masks.binary_signal_tiles(S,1.024,0.5,5,20,
+                                                                      tile_pings = 70))),
+                   lambda S: manipulate.get_signal_mask(S)]:
+        np.testing.assert_array_equal(method(e),method(Sv))
@@ -0,0 +1,50 @@
+# -*- coding: utf-8 -*-
+
+import itertools
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from pyechomask import manipulate
+from pyechomask.pipeline import sslem_pipeline
+from pyechomask.sweep import _Memo, sslem_sweep, ssl_metrics
+from pyechomask.tests.test_online import transect
+
+
+def test_sslem_sweep():
+    Sv    = transect(pings = 160)
+    grid  = dict(min_sep = [3,4],max_thickness = [10,20],min_size = [5,9],
+                 min_thickness = [1,2])
+    for n_jobs in [1,3]:
+        table = sslem_sweep(Sv,1.024,0.5,n_jobs = n_jobs,**grid)
+        assert len(table) == 16 and (table['time'] >= 0).all()
+        assert table['n_ssl'].max() > 1
+        ## each record equals a pipeline run with its parameters
+        sslem = sslem_pipeline(pl = 1.024,sample_int = 0.5)
+        for record,point in zip(table,itertools.product(*grid.values())):
+            params  = dict(zip(grid,point))
+            assert tuple(record[list(grid)]) == point
+            result  = sslem.run(Sv,outputs = ['ssl','Sv_clean'],**params)
+            ssl     = result['ssl']
+            metrics = ssl_metrics(manipulate.feature_table(result['Sv_clean'],ssl),ssl.shape,0.5)
+            for name,value in metrics.items():
+                np.testing.assert_allclose(record[name],value)
+
+
+def test_sweep_memo():
+    ## threads with a memo bound of a few labellings: same table as serial
+    Sv     = transect(pings = 160)
+    grid   = dict(min_sep = [3,4],max_thickness = [10,20],min_size = [5,9,13],
+                  min_thickness = [1,2])
+    serial = sslem_sweep(Sv,1.024,0.5,**grid)
+    table  = sslem_sweep(Sv,1.024,0.5,n_jobs = 4,memo_bytes = 3*Sv.size*4,**grid)
+    names  = [n for n in table.dtype.names if n != 'time']
+    np.testing.assert_array_equal(table[names],serial[names])
+
+    memo   = _Memo(lambda m: m.astype(np.int32),max_bytes = 2*Sv.size*4)
+    masks  = [np.asarray(Sv > t) for t in (-80,-70,-60)]
+    with ThreadPoolExecutor(max_workers = 4) as pool:
+        calls   = [m for m in masks for _ in range(4)]
+        results = list(pool.map(memo,calls))
+    assert all((r == m).all() and not r.flags.writeable for r,m in zip(results,calls))
+    assert memo.hits == 9 and len(memo._store) == 2 and memo.nbytes <= memo.max_bytes
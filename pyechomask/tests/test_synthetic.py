@@ -0,0 +1,52 @@
+# -*- coding: utf-8 -*-
+
+import numpy as np
+
+from pyechomask import masks, store
+from pyechomask.synthetic import TRUTH, synthetic_blocks, synthetic_echogram
+
+
+def test_synthetic_deterministic():
+    Sv,truth = synthetic_echogram(700,rows = 120,seed = 3)
+    assert Sv.shape == (120,700) and set(truth) == set(TRUTH)
+    ## independent of the block size
+    blocks   = list(synthetic_blocks(700,rows = 120,seed = 3,block_pings = 97))
+    assert [b.shape[1] for b,_ in blocks] == [97]*7 + [21]
+    np.testing.assert_array_equal(np.hstack([b for b,_ in blocks]),Sv)
+    for name in TRUTH:
+        np.testing.assert_array_equal(np.concatenate([t[name] for _,t in blocks],axis = -1),
+                                      truth[name])
+    assert not np.array_equal(synthetic_echogram(700,rows = 120,seed = 4)[0],Sv)
+    Sv2,none = synthetic_echogram(700,rows = 120,seed = 3,truth = False)
+    np.testing.assert_array_equal(Sv2,Sv)
+    assert none is None
+
+
+def test_synthetic_truth():
+    Sv,truth = synthetic_echogram(2000,rows = 200,seed = 1,noise_level = -999)
+    assert truth['layers'].max() == 3 and (truth['bottom'] > 0).all()
+    np.testing.assert_array_equal(truth['noise'],Sv > -999)
+
+    ## the masks find what was put in
+    np.testing.assert_array_equal(masks.binary_pulse(Sv),truth['pulse'])
+    seabed,bottom = masks.binary_seabed(Sv,buffer = 0)
+    assert np.mean(bottom == truth['bottom']) > 0.99
+    assert np.mean(seabed == truth['seabed']) > 0.99
+    impulse = masks.binary_impulse(Sv,10,'ping')
+    assert np.mean(impulse[truth['impulse'] == 0] == 0) > 0.95
+    water   = (truth['pulse'] & truth['seabed']) > 0
+    layers  = masks.binary_threshold(Sv,-50,-80)
+    assert np.mean(layers[water] == truth['signal'][water]) > 0.95
+
+    ## no seabed, given layers
+    Sv,truth = synthetic_echogram(300,rows = 100,seabed_depth = -1,
+                                  layers = [(20,5,-60,0,100)],impulse_rate = 0)
+    assert not truth['bottom'].any() and truth['seabed'].all() and truth['impulse'].all()
+    np.testing.assert_array_equal(np.flatnonzero(truth['signal'][:,0]),np.arange(40,50))
+
+
+def test_synthetic_store(tmp_path):
+    path = str(tmp_path/'synthetic')
+    e    = store.write_echogram(path,(Sv for Sv,_ in synthetic_blocks(1500,truth = False)),
+                                sample_int = 0.5,chunk_pings = 400)
+    np.testing.assert_array_equal(np.asarray(e),synthetic_echogram(1500,truth = False)[0])
@@ -18,7 +18,9 @@ setup(name='pyechomask',
       classifiers=[
         'Development Status :: 3 - Alpha',
         #'License :: OSI Approved :: MIT License',
-        'Programming Language :: Python :: 3.6',
+        'Programming Language :: Python :: 3',
+        'Programming Language :: Python :: 3 :: Only',
+        'Programming Language :: Python :: 3.9',
         #'Topic :: Text Processing :: Linguistic',
       ],
       keywords='echosounder marine acoustics mask',
@@ -28,10 +30,13 @@ setup(name='pyechomask',
       license='MIT',
       packages=['pyechomask'],
             install_requires=[
-          'numpy',
+          'numpy>=1.20',
           'matplotlib',
           'scipy'
       ],
-      python_requires='>=3',
+      entry_points={
+          'console_scripts': ['pyechomask=pyechomask.cli:main'],
+      },
+      python_requires='>=3.9',
       include_package_data=True,
       zip_safe=False)
\ No newline at end of file